@@ -1,4 +1,4 @@
-from src import app
+from src.application import app
 
 if __name__=="__main__":
     app.run(debug=True)
@@ -0,0 +1,62 @@
+"""
+Replays historical kd_hk_transactions through rules without writing kd_hk_report.
+
+    python backtest.py --rule-id 12 --rule-id 15 --since 2024-01-01 --bucket day
+    python backtest.py --definition '{"dataPoint": "amount", "conditional": "GreaterThan", "checkValue": "500000"}'
+
+Prints hit counts, hit rate per time bucket and sample matches as JSON.
+Definitions take the /api/rule/setup payload, so a rule can be measured
+before it is saved, and are reported with negative ids.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+from src import config
+from src.infra.db_repo import DatabaseManager
+from src.infra.json_codec import dumps
+from src.services.backtest_service import BUCKET_FORMATS, BacktestService
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rule-id', type=int, action='append', default=[], help='kd_hk_rules id, repeatable')
+    parser.add_argument('--definition', action='append', default=[], help='/api/rule/setup JSON payload, repeatable')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='first DateTimeCreated to replay')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='DateTimeCreated to stop before')
+    parser.add_argument('--workers', type=int, help='worker processes, defaults to the number of cores')
+    parser.add_argument('--bucket', choices=sorted(BUCKET_FORMATS), default='day')
+    parser.add_argument('--samples', type=int, default=10, help='matches kept per rule')
+    args = parser.parse_args(argv)
+    if not args.rule_id and not args.definition:
+        parser.error('pass at least one --rule-id or --definition')
+
+    logging.basicConfig(level=logging.WARNING)
+    # one connection loads the rules and a dedicated one streams the transactions
+    db_manager = DatabaseManager(
+        server=os.getenv('DB_SERVER'),
+        database=os.getenv('DB_NAME'),
+        username=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASS'),
+        pool_size=1,
+        checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT
+    )
+    try:
+        definitions = [json.loads(definition) for definition in args.definition]
+        result = BacktestService(db_manager).run(args.rule_id, definitions, since=args.since, until=args.until,
+                                                 workers=args.workers, bucket=args.bucket,
+                                                 sample_size=args.samples)
+    except ValueError as e:
+        print(f'backtest: {e}', file=sys.stderr)
+        return 2
+    finally:
+        db_manager.close()
+    sys.stdout.buffer.write(dumps(result) + b'\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
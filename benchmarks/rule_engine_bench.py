@@ -0,0 +1,332 @@
+"""
+Rule engine microbenchmarks against an in-memory SQLite stand-in for the database.
+
+Seeds N value rules, E expression rules, M expression results and K transactions,
+then times the service calls behind /rulecheck, /rulecheck/batch, /report,
+/report/export and /anomaly/record/batch, and prints throughput with p50/p99
+latency per scenario.
+
+    python -m benchmarks.rule_engine_bench
+    python -m benchmarks.rule_engine_bench --save-baseline
+    python -m benchmarks.rule_engine_bench --baseline benchmarks/baseline.json --tolerance 0.25
+
+With a baseline, exits 1 when a scenario's p50 or p99 grew, or its throughput
+dropped, by more than the tolerance. benchmarks/baseline.json is the checked-in
+baseline, recorded with the default parameters on the reference machine whose
+fingerprint it stores. Comparing against it on a different machine exits 2
+without comparing; record a local one there with
+--save-baseline --baseline <path>, and re-record the checked-in one on the
+reference machine when a change moves the numbers on purpose.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# keep the benchmark off the shared rule snapshot of a running app
+os.environ['RULE_SNAPSHOT_PATH'] = ''
+
+import numpy as np
+from flask import g
+from src.application import app
+from src.config import WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_SECONDS
+from src.infra.write_behind import WriteBehindQueue
+from src.services.aggregate_engine import aggregate_engine
+from src.services.anomaly_engine_service import AnomalyEngine
+from src.services.expression_result_cache import expression_result_cache
+from src.services.idempotency_cache import idempotency_cache
+from src.services.rule_cache import rule_set_cache
+from src.services.rule_engine_service import RuleEngine, TRANSACTION_INSERT_QUERY
+from benchmarks.sqlite_db import SqliteDatabaseManager
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# upper-bound rules get thresholds across the whole amount range and lower-bound rules small ones,
+# so a transaction faults a handful of rules rather than half of them
+UPPER_CONDITIONALS = ['GreaterThan', 'GreaterThanOrEqualTo', 'EqualTo']
+LOWER_CONDITIONALS = ['LessThan', 'LessThanOrEqualTo']
+BANK_CODES = ['044', '058', '011', '033', '232']
+# tables the write scenarios insert into, trimmed back to the seeded rows before each run
+GROWING_TABLES = ('kd_hk_report', 'kd_hk_anomalies', 'kd_hk_transactions')
+
+
+def value_rule(rng, index):
+    if index % 10:
+        conditional, threshold = rng.choice(UPPER_CONDITIONALS), rng.randint(1, 1000000)
+    else:
+        conditional, threshold = rng.choice(LOWER_CONDITIONALS), rng.randint(1, 100)
+    return 'amount', conditional, str(threshold), f'value rule {index}', f'value_{index}'
+
+
+def seed(db, args, rng):
+    db.multiple_inserts("""
+        insert into kd_hk_rules (DataPoint, IsExpression, Conditional, CheckValue, CheckValueDatatype, Description, RuleName)
+        values (?, 0, ?, ?, 'float', ?, ?)
+    """, [value_rule(rng, i) for i in range(args.rules)])
+
+    # half the expression rules go through kd_hk_expression_result, half through the aggregate engine
+    expression_rows = []
+    for i in range(args.expression_rules):
+        if i % 2:
+            expression = ("select sum(amount) from kd_hk_transactions where amount > 100 "
+                          "and sourceaccountnumber=?")
+        else:
+            expression = ("select count(distinct destinationaccountnumber) from kd_hk_transactions "
+                          "where amount > 0 and sourceaccountnumber=?")
+        expression_rows.append(('amount', rng.choice(UPPER_CONDITIONALS), expression, f'trigger_{i}',
+                                f'expression rule {i}', f'expression_{i}', 'float'))
+    db.multiple_inserts("""
+        insert into kd_hk_rules (DataPoint, IsExpression, Conditional, Expression, TriggerName, Description, RuleName, DataPointDataType)
+        values (?, 1, ?, ?, ?, ?, ?, ?)
+    """, expression_rows)
+
+    rule_ids = [row[0] for row in db.fetch_records("select Id from kd_hk_rules where IsExpression = 0", ())]
+    table_rule_ids = [row[0] for row in db.fetch_records(
+        "select Id from kd_hk_rules where IsExpression = 1 and Expression like '%distinct%'", ())]
+    accounts = [f'{1000000000 + i}' for i in range(args.accounts)]
+
+    if table_rule_ids:
+        db.multiple_inserts("""
+            insert into kd_hk_expression_result (RuleId, ResultValue, ResultDataType, SourceAccountNumber)
+            values (?, ?, 'float', ?)
+        """, [(rng.choice(table_rule_ids), str(rng.randint(1, 50)), rng.choice(accounts))
+              for _ in range(args.expression_results)])
+
+    db.multiple_inserts("""
+        insert into kd_hk_transactions (SourceAccountNumber, DestinationAccountNumber, Amount, DestinationBankCode)
+        values (?, ?, ?, ?)
+    """, [(rng.choice(accounts), rng.choice(accounts), amount(rng), rng.choice(BANK_CODES))
+          for _ in range(args.transactions)])
+
+    start = datetime(2024, 1, 1)
+    db.multiple_inserts("""
+        insert into kd_hk_report (RuleId, PayloadType, PayloadDetails, DateInserted)
+        values (?, 'Transaction', ?, ?)
+    """, [(rng.choice(rule_ids), json.dumps(transaction(rng, accounts)), start + timedelta(seconds=i))
+          for i in range(args.reports)] if rule_ids else [])
+    return accounts
+
+
+def amount(rng):
+    return max(1, int(rng.expovariate(1 / 5000)))
+
+
+def transaction(rng, accounts):
+    return {
+        'sourceAccountNumber': rng.choice(accounts),
+        'destinationAccountNumber': rng.choice(accounts),
+        'amount': amount(rng),
+        'destinationBankCode': rng.choice(BANK_CODES)
+    }
+
+
+def anomaly(rng, accounts):
+    return {
+        'user_id': rng.choice(accounts),
+        'alert_type': rng.choice(['velocity', 'amount', 'geo']),
+        'timestamp': '2024-01-01 00:00:00',
+        'risk_score': round(rng.random(), 4)
+    }
+
+
+def reset(db, marks):
+    for table, last_id in marks.items():
+        db.single_inserts(f"delete from {table} where Id > ?", (last_id,))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(call, iterations, items_per_call=1):
+    latencies = []
+    started = time.perf_counter()
+    for index in range(iterations):
+        begin = time.perf_counter()
+        call(index)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+    return {
+        'iterations': iterations,
+        'throughput': round(iterations * items_per_call / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4)
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    db = SqliteDatabaseManager()
+    accounts = seed(db, args, rng)
+    write_behind = WriteBehindQueue(db, max_size=1000000, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                                    flush_interval=WRITE_BEHIND_FLUSH_SECONDS,
+                                    spill_dir=tempfile.mkdtemp(prefix='hawkeye_bench_'))
+    write_behind.add_listener(TRANSACTION_INSERT_QUERY, expression_result_cache.invalidate_transactions)
+    write_behind.add_listener(TRANSACTION_INSERT_QUERY, aggregate_engine.committed)
+
+    marks = {table: db.fetch_record(f"select coalesce(max(Id), 0) from {table}", ())[0] for table in GROWING_TABLES}
+    rule_set_cache.invalidate()
+    expression_result_cache.clear()
+    aggregate_engine.clear()
+
+    single = [transaction(rng, accounts) for _ in range(args.iterations)]
+    batches = [[transaction(rng, accounts) for _ in range(args.batch_size)] for _ in range(args.batch_iterations)]
+    anomalies = [[anomaly(rng, accounts) for _ in range(args.batch_size)] for _ in range(args.batch_iterations)]
+
+    results = {}
+    with app.app_context():
+        g.db_manager = db
+        g.write_behind = write_behind
+        engine = RuleEngine()
+        anomaly_engine = AnomalyEngine()
+        # load the rule set once so the first timed call does not pay for compiling it
+        engine.rule_check(dict(single[0]))
+
+        cursors = [None]
+
+        def report_page(index):
+            res = engine.get_report({'limit': 50, 'rulesCursor': cursors[-1]})
+            cursors.append(res.data['nextRulesCursor'])
+
+        def export(index):
+            generator, _ = engine.export_report({})
+            for _ in generator:
+                pass
+
+        # reads first, on the seeded tables only; the write scenarios add rows that are removed after each run
+        scenarios = [
+            ('report_page', report_page, args.iterations, 1),
+            ('report_export', export, max(1, args.batch_iterations // 4), 1),
+            ('rule_check', lambda i: engine.rule_check(dict(single[i])), args.iterations, 1),
+            ('rule_check_batch', lambda i: engine.rule_check_batch([dict(t) for t in batches[i]]),
+             args.batch_iterations, args.batch_size),
+            ('anomaly_batch', lambda i: anomaly_engine.save_records(anomalies[i]),
+             args.batch_iterations, args.batch_size),
+        ]
+        # keep the fastest of --repeat runs per scenario to damp scheduler noise
+        for _ in range(args.repeat):
+            write_behind.flush()
+            reset(db, marks)
+            cursors[:] = [None]
+            for name, call, iterations, items_per_call in scenarios:
+                # every repeat re-sends the same transactions, which would otherwise be replayed verdicts
+                idempotency_cache.clear()
+                stats = measure(call, iterations, items_per_call)
+                # drain queued writes so they are not flushed during the next scenario
+                write_behind.flush()
+                if name not in results or stats['p50_ms'] < results[name]['p50_ms']:
+                    results[name] = stats
+
+    write_behind.close()
+    db.close()
+    return results
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def fingerprint():
+    """
+    What the timings depend on besides the code: the CPU, the interpreter and the
+    libraries the scenarios spend their time in.
+    """
+    return {
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpu': cpu_model(),
+        'cpus': os.cpu_count(),
+        'python': f'{platform.python_implementation()} {platform.python_version()}',
+        'numpy': np.__version__,
+        'sqlite': sqlite3.sqlite_version
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if stats[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{name}: {key} {stats[key]} vs baseline {base[key]}')
+        if stats['throughput'] < base['throughput'] / (1 + tolerance):
+            regressions.append(f"{name}: throughput {stats['throughput']} vs baseline {base['throughput']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', type=int, default=1000, help='value rules to seed (N)')
+    parser.add_argument('--expression-rules', type=int, default=20, help='expression rules to seed')
+    parser.add_argument('--expression-results', type=int, default=20000, help='expression result rows to seed (M)')
+    parser.add_argument('--transactions', type=int, default=50000, help='historical transactions to seed (K)')
+    parser.add_argument('--reports', type=int, default=20000, help='report rows to seed')
+    parser.add_argument('--accounts', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=500, help='calls per single-item scenario')
+    parser.add_argument('--batch-iterations', type=int, default=20, help='calls per batch scenario')
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    # per-call INFO logging would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run(args)
+    print(f"{'scenario':<20}{'throughput/s':>14}{'p50 ms':>12}{'p99 ms':>12}")
+    for name, stats in results.items():
+        print(f"{name:<20}{stats['throughput']:>14}{stats['p50_ms']:>12}{stats['p99_ms']:>12}")
+
+    params = {key: value for key, value in vars(args).items()
+              if key not in ('baseline', 'save_baseline', 'tolerance')}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'fingerprint': fingerprint(), 'params': params, 'scenarios': results}, baseline_file,
+                      indent=2)
+        print(f'baseline written to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('no baseline to compare against, run with --save-baseline first')
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    current = fingerprint()
+    recorded = baseline.get('fingerprint') or {}
+    differences = [f"{key}: {recorded.get(key)} vs {value}" for key, value in current.items()
+                   if recorded.get(key) != value]
+    if differences:
+        print('baseline was recorded on a different machine, not comparing; '
+              'record one here with --save-baseline')
+        for difference in differences:
+            print(f'  {difference}')
+        return 2
+    if baseline.get('params') != params:
+        print('warning: baseline was recorded with different parameters')
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
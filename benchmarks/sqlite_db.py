@@ -0,0 +1,238 @@
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from src.infra.db_repo import DatabaseError, DatabaseManager
+
+SCHEMA = """
+    create table kd_hk_rules (
+        Id integer primary key autoincrement,
+        DataPoint nvarchar,
+        IsExpression bit default 0,
+        Conditional nvarchar,
+        CheckValue nvarchar,
+        Expression nvarchar,
+        TriggerName nvarchar,
+        IsActive bit default 1,
+        CheckValueDatatype nvarchar,
+        Description nvarchar,
+        DateCreated datetime default current_timestamp,
+        RuleName nvarchar,
+        DataPointDataType nvarchar,
+        IsShadow bit default 0
+    );
+    create table kd_hk_transactions (
+        Id integer primary key autoincrement,
+        SourceAccountNumber nvarchar,
+        DestinationAccountNumber nvarchar,
+        Amount float,
+        DestinationBankCode nvarchar,
+        DateTimeCreated datetime default current_timestamp
+    );
+    create index ix_transactions_source on kd_hk_transactions (SourceAccountNumber);
+    create table kd_hk_report (
+        Id integer primary key autoincrement,
+        RuleId int,
+        PayloadType nvarchar,
+        PayloadDetails nvarchar,
+        DateInserted datetime default current_timestamp
+    );
+    create index ix_report_date on kd_hk_report (DateInserted, Id);
+    create table kd_hk_report_rollup (
+        Id integer primary key autoincrement,
+        RuleId int,
+        Bucket nvarchar,
+        BucketStart datetime,
+        Hits int
+    );
+    create unique index ix_report_rollup on kd_hk_report_rollup (Bucket, BucketStart, RuleId);
+    create table kd_hk_report_rollup_account (
+        Id integer primary key autoincrement,
+        RuleId int,
+        BucketStart datetime,
+        SourceAccountNumber nvarchar,
+        Hits int
+    );
+    create unique index ix_report_rollup_account on kd_hk_report_rollup_account (BucketStart, RuleId, SourceAccountNumber);
+    create table kd_hk_expression_result (
+        Id integer primary key autoincrement,
+        RuleId int,
+        ResultValue nvarchar,
+        ResultDataType nvarchar,
+        SourceAccountNumber nvarchar,
+        DateTimeUpdated datetime default current_timestamp
+    );
+    create index ix_expression_result_account on kd_hk_expression_result (SourceAccountNumber);
+    create table kd_hk_anomalies (
+        id integer primary key autoincrement,
+        user_id nvarchar,
+        alert_type nvarchar,
+        risk_score float,
+        timestamp datetime
+    );
+    create index ix_anomalies_timestamp on kd_hk_anomalies (timestamp, id);
+    create table kd_hk_idempotency (
+        IdempotencyKey nvarchar primary key,
+        Response nvarchar,
+        ExpiresAt datetime not null
+    );
+"""
+
+NOLOCK_PATTERN = re.compile(r"with\s*\(\s*nolock\s*\)", re.I)
+TOP_PATTERN = re.compile(r"^(\s*select\s+)top\s*\(\s*\?\s*\)", re.I)
+DATEADD_PATTERN = re.compile(r"dateadd\s*\(\s*(\w+)\s*,\s*(-?\d+|-\?)\s*,\s*getdate\s*\(\s*\)\s*\)", re.I)
+DATEDIFF_PATTERN = re.compile(r"datediff\s*\(\s*second\s*,\s*(\w+)\s*,\s*getdate\s*\(\s*\)\s*\)", re.I)
+GETDATE_PATTERN = re.compile(r"getdate\s*\(\s*\)", re.I)
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('datetime', lambda raw: datetime.fromisoformat(raw.decode()))
+
+
+class SqliteDatabaseManager(DatabaseManager):
+    """
+    In-memory stand-in for DatabaseManager used by the benchmarks.
+
+    Overrides the blocking methods with the same return conventions (-1 when
+    no connection, None or [] on errors) and rewrites the T-SQL the services
+    send (with(nolock), top (?), getdate(), dateadd, datediff) into SQLite, so
+    the services run unchanged without a SQL Server. The async methods are
+    inherited and run the overrides on the executor.
+    """
+
+    def __init__(self, executor_workers=4):
+        # no pool to build: one shared connection serialised by a lock
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='db')
+        self._connection = sqlite3.connect(':memory:', check_same_thread=False,
+                                           detect_types=sqlite3.PARSE_DECLTYPES)
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self.checkouts = 0
+
+    def _dateadd(self, match):
+        if match.group(2) == '-?':
+            # the offset is a parameter, as in the velocity seeds
+            return f"datetime('now', '-' || ? || ' {match.group(1)}s')"
+        return f"datetime('now', '{match.group(2)} {match.group(1)}s')"
+
+    def _translate(self, query, params):
+        params = list(params or ())
+        query = NOLOCK_PATTERN.sub('', query)
+        query = DATEADD_PATTERN.sub(self._dateadd, query)
+        query = DATEDIFF_PATTERN.sub(lambda m: f"(julianday('now') - julianday({m.group(1)})) * 86400", query)
+        query = GETDATE_PATTERN.sub('current_timestamp', query)
+        if TOP_PATTERN.match(query):
+            query = TOP_PATTERN.sub(r'\1', query).rstrip().rstrip(';') + ' limit ?'
+            params.append(params.pop(0))
+        return query, params
+
+    def _execute(self, query, params):
+        self.checkouts += 1
+        query, params = self._translate(query, params)
+        return self._connection.execute(query, params)
+
+    def pool_stats(self):
+        return {
+            'idle': 1,
+            'in_use': 0,
+            'total': 1,
+            'waiters': 0,
+            'max_size': 1,
+            'min_size': 1,
+            'checkouts': self.checkouts,
+            'checkout_timeouts': 0,
+            'checkout_wait_seconds': 0.0,
+            'evictions': 0
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self._lock:
+            self._connection.close()
+
+    def single_inserts(self, query, params):
+        with self._lock:
+            try:
+                self._execute(query, params)
+                self._connection.commit()
+                return 0
+            except Exception as e:
+                self._connection.rollback()
+                print("Error in database add:", e)
+                return None
+
+    def single_insert_no_param(self, query):
+        # CREATE TRIGGER bodies are T-SQL, there is nothing to run them against here
+        return None
+
+    def single_insert_return_id(self, query, params):
+        with self._lock:
+            try:
+                cursor = self._execute(query, params)
+                self._connection.commit()
+                return cursor.lastrowid
+            except Exception as e:
+                self._connection.rollback()
+                print("Error in database add:", e)
+                return None
+
+    def multiple_inserts(self, query, params):
+        with self._lock:
+            try:
+                query, _ = self._translate(query, ())
+                self.checkouts += 1
+                self._connection.executemany(query, params)
+                self._connection.commit()
+                return 0
+            except Exception as e:
+                # the shared connection must not carry a half-applied statement into the next caller
+                self._connection.rollback()
+                print("Error in database multiple execute add:", e)
+                return -1
+
+    def fetch_records(self, query, params, strict=False):
+        with self._lock:
+            try:
+                return self._execute(query, params).fetchall()
+            except Exception as e:
+                print("Error fetching records:", e)
+                if strict:
+                    raise DatabaseError(str(e)) from e
+                return []
+
+    def stream_records(self, query, params, chunk_size=1000):
+        with self._lock:
+            try:
+                cursor = self._execute(query, params)
+            except Exception as e:
+                print("Error streaming records:", e)
+                return
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+
+    def fetch_record(self, query, params):
+        with self._lock:
+            try:
+                return self._execute(query, params).fetchone()
+            except Exception as e:
+                print("Error fetching records:", e)
+                return None
+
+    def fetch_multiple_query(self, query, params):
+        return None
+
+    def get_columns_of_table(self, table_name):
+        with self._lock:
+            try:
+                self.checkouts += 1
+                rows = self._connection.execute(f"pragma table_info({table_name})").fetchall()
+                return [(row[1], row[2]) for row in rows]
+            except Exception as e:
+                print("Error fetching records:", e)
+                return None
@@ -0,0 +1,71 @@
+"""
+Drops or recreates the per-rule AFTER INSERT triggers that keep kd_hk_expression_result current.
+
+    python expression_triggers.py drop             # before setting EXPRESSION_RECOMPUTE_ENABLED=true
+    python expression_triggers.py create           # after setting it back to false
+    python expression_triggers.py create --print   # prints the DDL without running it
+
+Run migrations/001_expression_watermark.sql before enabling the scheduler.
+`drop` does the same as migrations/002_drop_expression_triggers.sql. `create`
+recreates the triggers of the active expression rules that the aggregate and
+velocity engines do not handle, skipping triggers that already exist.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from src import config
+from src.infra.db_repo import DatabaseError, DatabaseManager
+from src.services.expression_triggers import (TRIGGER_RULES_QUERY, create_trigger_ddl, drop_trigger_ddl,
+                                              existing_triggers, needs_trigger)
+
+
+def statements(db, action):
+    """
+    :return: (trigger name, DDL) for every trigger to drop or create.
+    """
+    rules = db.fetch_records(TRIGGER_RULES_QUERY, (), strict=True)
+    existing = existing_triggers(db)
+    if action == 'drop':
+        return [(name, drop_trigger_ddl(name)) for _, name, _, _ in rules if name in existing]
+    return [(name, create_trigger_ddl(name, expression)) for _, name, expression, active in rules
+            if active and needs_trigger(expression) and name not in existing]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('action', choices=('drop', 'create'))
+    parser.add_argument('--print', action='store_true', dest='print_only', help='print the DDL instead of running it')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    db_manager = DatabaseManager(
+        server=os.getenv('DB_SERVER'),
+        database=os.getenv('DB_NAME'),
+        username=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASS'),
+        pool_size=1,
+        checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT
+    )
+    failed = 0
+    try:
+        for name, ddl in statements(db_manager, args.action):
+            if args.print_only:
+                print(ddl.strip() + '\nGO')
+                continue
+            if db_manager.single_inserts(ddl, ()) != 0:
+                failed += 1
+                print(f'{args.action} failed: {name}', file=sys.stderr)
+            else:
+                print(f'{args.action}: {name}')
+    except DatabaseError as e:
+        print(f'expression_triggers: {e}', file=sys.stderr)
+        return 2
+    finally:
+        db_manager.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+-- Watermarks of the in-app expression recompute scheduler (EXPRESSION_RECOMPUTE_ENABLED=true):
+-- the last kd_hk_transactions Id each expression rule's results cover, and when they were last recomputed.
+-- Run before enabling the scheduler.
+if object_id('dbo.kd_hk_expression_watermark', 'U') is null
+begin
+    create table dbo.kd_hk_expression_watermark (
+        RuleId int not null constraint PK_kd_hk_expression_watermark primary key,
+        LastId bigint not null,
+        LastRunAt datetime null
+    );
+end;
+GO
@@ -0,0 +1,21 @@
+-- Drops the per-rule AFTER INSERT triggers on kd_hk_transactions once the in-app scheduler
+-- recomputes kd_hk_expression_result. Same as `python expression_triggers.py drop`;
+-- `python expression_triggers.py create` recreates them when the scheduler is turned off again.
+declare @TriggerName sysname;
+declare triggers cursor local fast_forward for
+    select t.name
+    from sys.triggers t
+    inner join sys.tables tb on t.parent_id = tb.object_id
+    inner join kd_hk_rules r on r.TriggerName = t.name
+    where tb.name = 'kd_hk_transactions' and r.IsExpression = 1;
+
+open triggers;
+fetch next from triggers into @TriggerName;
+while @@FETCH_STATUS = 0
+begin
+    exec('drop trigger ' + quotename(@TriggerName));
+    fetch next from triggers into @TriggerName;
+end;
+close triggers;
+deallocate triggers;
+GO
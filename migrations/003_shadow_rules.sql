@@ -0,0 +1,22 @@
+-- Shadow rules: kd_hk_rules.IsShadow marks rules that are evaluated after the verdict without affecting it,
+-- and kd_hk_shadow_rule_stats holds their evaluations, hits, errors and cost as flushed by every worker.
+-- Run before creating shadow rules: only rules created with "shadow": true write IsShadow, so other rules
+-- can still be created before it. GET /api/rule/shadow, promotion and the shadow stats flush need both.
+if col_length('dbo.kd_hk_rules', 'IsShadow') is null
+begin
+    alter table dbo.kd_hk_rules add IsShadow bit not null constraint DF_kd_hk_rules_IsShadow default 0;
+end;
+GO
+
+if object_id('dbo.kd_hk_shadow_rule_stats', 'U') is null
+begin
+    create table dbo.kd_hk_shadow_rule_stats (
+        RuleId int not null constraint PK_kd_hk_shadow_rule_stats primary key,
+        Evaluations bigint not null,
+        Hits bigint not null,
+        Errors bigint not null,
+        TotalSeconds float not null,
+        MaxSeconds float not null
+    );
+end;
+GO
@@ -0,0 +1,76 @@
+-- Report rollups: hits per rule per hour and day, and per rule, day and source account, which
+-- GET /api/rule/report/summary reads instead of kd_hk_report. Every worker's ReportRollup adds its counts to them.
+-- The unique indexes make a host that creates a bucket row another host has just created fail its batch and
+-- retry it on the next flush, instead of adding a second row that both would then increment.
+-- Run before deploying the rollup, while no worker writes reports: the backfill counts every existing
+-- kd_hk_report row and is skipped once the tables hold any row.
+if object_id('dbo.kd_hk_report_rollup', 'U') is null
+begin
+    create table dbo.kd_hk_report_rollup (
+        Id bigint identity(1, 1) not null constraint PK_kd_hk_report_rollup primary key,
+        RuleId int not null,
+        Bucket nvarchar(8) not null,
+        BucketStart datetime not null,
+        Hits int not null
+    );
+end;
+GO
+
+if not exists (select 1 from sys.indexes where name = 'ix_report_rollup' and object_id = object_id('dbo.kd_hk_report_rollup'))
+begin
+    create unique index ix_report_rollup on dbo.kd_hk_report_rollup (Bucket, BucketStart, RuleId) include (Hits);
+end;
+GO
+
+if object_id('dbo.kd_hk_report_rollup_account', 'U') is null
+begin
+    create table dbo.kd_hk_report_rollup_account (
+        Id bigint identity(1, 1) not null constraint PK_kd_hk_report_rollup_account primary key,
+        RuleId int not null,
+        BucketStart datetime not null,
+        SourceAccountNumber nvarchar(100) not null,
+        Hits int not null
+    );
+end;
+GO
+
+if not exists (select 1 from sys.indexes where name = 'ix_report_rollup_account'
+               and object_id = object_id('dbo.kd_hk_report_rollup_account'))
+begin
+    create unique index ix_report_rollup_account
+        on dbo.kd_hk_report_rollup_account (BucketStart, RuleId, SourceAccountNumber) include (Hits);
+end;
+GO
+
+-- backfill, bucketed like ReportRollup.record: hours and days by DateInserted, accounts by the
+-- sourceaccountnumber of the stored payload
+if not exists (select 1 from dbo.kd_hk_report_rollup)
+begin
+    insert into dbo.kd_hk_report_rollup (RuleId, Bucket, BucketStart, Hits)
+    select RuleId, 'hour', dateadd(hour, datediff(hour, 0, DateInserted), 0), count(*)
+    from dbo.kd_hk_report with(nolock)
+    where RuleId is not null and DateInserted is not null
+    group by RuleId, dateadd(hour, datediff(hour, 0, DateInserted), 0);
+
+    insert into dbo.kd_hk_report_rollup (RuleId, Bucket, BucketStart, Hits)
+    select RuleId, 'day', dateadd(day, datediff(day, 0, DateInserted), 0), count(*)
+    from dbo.kd_hk_report with(nolock)
+    where RuleId is not null and DateInserted is not null
+    group by RuleId, dateadd(day, datediff(day, 0, DateInserted), 0);
+end;
+GO
+
+if not exists (select 1 from dbo.kd_hk_report_rollup_account)
+begin
+    insert into dbo.kd_hk_report_rollup_account (RuleId, BucketStart, SourceAccountNumber, Hits)
+    select RuleId, BucketStart, SourceAccountNumber, count(*)
+    from (
+        select RuleId, dateadd(day, datediff(day, 0, DateInserted), 0) as BucketStart,
+               json_value(PayloadDetails, '$.sourceaccountnumber') as SourceAccountNumber
+        from dbo.kd_hk_report with(nolock)
+        where RuleId is not null and DateInserted is not null and isjson(PayloadDetails) = 1
+    ) as report
+    where SourceAccountNumber is not null
+    group by RuleId, BucketStart, SourceAccountNumber;
+end;
+GO
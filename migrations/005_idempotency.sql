@@ -0,0 +1,13 @@
+-- Idempotency keys shared by every worker and host (IDEMPOTENCY_SHARED=true): the first check with a key
+-- inserts it, retries that reach another worker find it and replay the stored Response instead of evaluating.
+-- Rows past ExpiresAt are replaced by the next check with the same key.
+-- Run before deploying with IDEMPOTENCY_SHARED=true; without the table every worker only deduplicates its own retries.
+if object_id('dbo.kd_hk_idempotency', 'U') is null
+begin
+    create table dbo.kd_hk_idempotency (
+        IdempotencyKey nvarchar(450) not null constraint PK_kd_hk_idempotency primary key,
+        Response nvarchar(max) null,
+        ExpiresAt datetime not null
+    );
+end;
+GO
@@ -0,0 +1,119 @@
+"""
+The Flask app and the process-wide services behind it: the database pool,
+the write-behind queue, the report rollups, the expression scheduler and
+the logging listener. Importing this module starts them, so only the web
+entry points import it; tools such as backtest.py build what they need.
+"""
+import os
+import time
+from flask import Flask, g, request
+
+app = Flask(__name__)
+
+from src import config
+from src.infra.structured_logging import configure_logging
+
+configure_logging(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_SAMPLE_RATES, config.LOG_QUEUE_MAX_SIZE)
+
+from src.controllers.metrics_controller import metrics
+from src.infra.db_repo import DatabaseManager
+from src.infra.metrics import http_request_seconds, registry
+from src.infra.write_behind import WriteBehindQueue
+from src.routes import api 
+from src.services.aggregate_engine import aggregate_engine
+from src.services.expression_result_cache import expression_result_cache
+from src.services.expression_scheduler import ExpressionRecomputeScheduler, parse_staleness_limits
+from src.services.report_rollup import ReportRollup
+from src.services.rule_engine_service import REPORT_INSERT_QUERY, TRANSACTION_INSERT_QUERY
+from src.services.shadow_rules import ShadowRuleStatsStore, shadow_rule_evaluator
+from src.services.velocity_engine import velocity_engine
+app.register_blueprint(api, url_prefix='/api')
+app.register_blueprint(metrics)
+
+if config.METRICS_MULTIPROC_DIR:
+    registry.share(config.METRICS_MULTIPROC_DIR, config.METRICS_MULTIPROC_WRITE_SECONDS)
+
+db_manager = DatabaseManager(
+    server=os.getenv('DB_SERVER'),
+    database=os.getenv('DB_NAME'),
+    username=os.getenv('DB_USER'),
+    password=os.getenv('DB_PASS'),
+    pool_size=config.DB_POOL_MAX_SIZE,
+    min_pool_size=config.DB_POOL_MIN_SIZE,
+    checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT,
+    idle_validation_seconds=config.DB_POOL_IDLE_VALIDATION_SECONDS,
+    health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL,
+    executor_workers=config.DB_EXECUTOR_MAX_WORKERS
+)
+
+write_behind = WriteBehindQueue(
+    db_manager,
+    max_size=config.WRITE_BEHIND_MAX_SIZE,
+    batch_size=config.WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=config.WRITE_BEHIND_FLUSH_SECONDS,
+    spill_dir=config.WRITE_BEHIND_SPILL_DIR,
+    replay_interval=config.WRITE_BEHIND_REPLAY_SECONDS
+)
+
+# every committed report row is counted into the rollups /api/rule/report/summary reads
+report_rollup = ReportRollup(db_manager, interval=config.REPORT_ROLLUP_FLUSH_SECONDS,
+                             lock_path=config.REPORT_ROLLUP_LOCK_PATH)
+write_behind.add_listener(REPORT_INSERT_QUERY, report_rollup.record)
+# shadow rule hits and cost are added up across workers for /api/rule/shadow
+shadow_rule_evaluator.store = ShadowRuleStatsStore(db_manager, interval=config.SHADOW_RULE_STATS_FLUSH_SECONDS,
+                                                   lock_path=config.SHADOW_RULE_STATS_LOCK_PATH)
+# aggregate seeds count queued transactions until they are committed
+write_behind.add_listener(TRANSACTION_INSERT_QUERY, aggregate_engine.committed)
+
+if config.EXPRESSION_RECOMPUTE_ENABLED:
+    expression_scheduler = ExpressionRecomputeScheduler(
+        db_manager,
+        interval=config.EXPRESSION_RECOMPUTE_INTERVAL_SECONDS,
+        staleness_limits=parse_staleness_limits(config.EXPRESSION_RECOMPUTE_STALENESS_SECONDS),
+        lock_path=config.EXPRESSION_RECOMPUTE_LOCK_PATH,
+        safety_lag=config.EXPRESSION_RECOMPUTE_SAFETY_LAG_SECONDS
+    )
+    registry.gauge('hawkeye_expression_result_staleness_seconds',
+                   'Seconds since each expression rule\'s results were last recomputed by any worker.',
+                   expression_scheduler.staleness, ('rule',), multiprocess_mode='min')
+else:
+    # the insert triggers recompute the results of the inserted accounts
+    write_behind.add_listener(TRANSACTION_INSERT_QUERY, expression_result_cache.invalidate_transactions)
+
+registry.gauge('hawkeye_db_pool_connections', 'Database pool connections by state.',
+               lambda: [((state,), db_manager.pool_stats()[state]) for state in ('idle', 'in_use', 'total')],
+               ('state',))
+registry.gauge('hawkeye_db_pool_waiters', 'Callers waiting for a free database connection.',
+               lambda: db_manager.pool_stats()['waiters'])
+registry.gauge('hawkeye_shadow_rule_pending', 'Transactions waiting for shadow rule evaluation.',
+               shadow_rule_evaluator.pending)
+registry.gauge('hawkeye_shadow_rule_stats_pending', 'Shadow rules with evaluations not flushed yet.',
+               shadow_rule_evaluator.store.pending)
+registry.gauge('hawkeye_aggregate_pending_transactions',
+               'Queued transactions the aggregate seeds count until they are committed.', aggregate_engine.pending)
+registry.gauge('hawkeye_velocity_windows', 'Velocity rule windows held in memory.',
+               lambda: len(velocity_engine))
+registry.gauge('hawkeye_velocity_window_bytes', 'Estimated memory held by velocity rule windows.',
+               velocity_engine.memory_bytes)
+registry.gauge('hawkeye_report_rollup_pending', 'Report rollup rows with hits not flushed yet.',
+               report_rollup.pending)
+registry.gauge('hawkeye_write_behind_pending', 'Rows waiting in the write-behind queue.', write_behind.pending)
+registry.gauge('hawkeye_write_behind_rows', 'Rows handled by the write-behind queue since start.',
+               lambda: [(('flushed',), write_behind.flushed), (('spilled',), write_behind.spilled),
+                        (('replayed',), write_behind.replayed),
+                        (('quarantined',), write_behind.quarantined)],
+               ('outcome',))
+
+@app.before_request
+def before_request():
+    g.db_manager = db_manager
+    g.write_behind = write_behind
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def after_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started,
+                                     request.endpoint or 'unknown', request.method, response.status_code)
+    return response
\ No newline at end of file
@@ -0,0 +1,166 @@
+import os
+import tempfile
+
+# seconds before the in-process rule set is reloaded from kd_hk_rules even if no change was seen
+RULE_CACHE_REFRESH_SECONDS = int(os.getenv('RULE_CACHE_REFRESH_SECONDS', 60))
+# seconds before a failed reload is retried; the previous rule set is kept in the meantime
+RULE_CACHE_RETRY_SECONDS = float(os.getenv('RULE_CACHE_RETRY_SECONDS', 5))
+
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 3))
+# seconds a caller waits for a free connection before giving up
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT', 5))
+# idle connections older than this are validated by the background health check
+DB_POOL_IDLE_VALIDATION_SECONDS = float(os.getenv('DB_POOL_IDLE_VALIDATION_SECONDS', 30))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', 15))
+# threads behind the async DatabaseManager methods, defaults to DB_POOL_MAX_SIZE
+DB_EXECUTOR_MAX_WORKERS = int(os.getenv('DB_EXECUTOR_MAX_WORKERS', 0)) or DB_POOL_MAX_SIZE
+
+# largest number of transactions accepted by /api/rule/rulecheck/batch
+RULE_CHECK_BATCH_MAX_SIZE = int(os.getenv('RULE_CHECK_BATCH_MAX_SIZE', 1000))
+# milliseconds a rule check waits for its expression rule lookups; rules still waiting are reported unfinished, 0 waits for all
+RULE_CHECK_DEADLINE_MS = float(os.getenv('RULE_CHECK_DEADLINE_MS', 250))
+
+# /api/rule/rulecheck deduplication of retried transactions, by header or by the transaction's reference field
+IDEMPOTENCY_KEY_HEADER = os.getenv('IDEMPOTENCY_KEY_HEADER', 'Idempotency-Key')
+IDEMPOTENCY_REFERENCE_FIELD = os.getenv('IDEMPOTENCY_REFERENCE_FIELD', 'transactionreference').lower()
+# also deduplicate transactions with neither by a hash of the payload; two genuine identical
+# transfers within the TTL would then get one verdict and one kd_hk_transactions row
+IDEMPOTENCY_HASH_PAYLOADS = os.getenv('IDEMPOTENCY_HASH_PAYLOADS', 'false').lower() in ('1', 'true', 'yes')
+# 0 disables the cache
+IDEMPOTENCY_CACHE_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_CACHE_MAX_ENTRIES', 100000))
+IDEMPOTENCY_CACHE_TTL_SECONDS = float(os.getenv('IDEMPOTENCY_CACHE_TTL_SECONDS', 300))
+# seconds a duplicate waits for the in-flight check before answering 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 5))
+# share keys between workers and hosts through kd_hk_idempotency (migrations/005_idempotency.sql)
+IDEMPOTENCY_SHARED = os.getenv('IDEMPOTENCY_SHARED', 'true').lower() in ('1', 'true', 'yes')
+# seconds another worker's claim without a stored verdict holds the key, in case that worker died
+IDEMPOTENCY_CLAIM_SECONDS = float(os.getenv('IDEMPOTENCY_CLAIM_SECONDS', 30))
+IDEMPOTENCY_POLL_SECONDS = float(os.getenv('IDEMPOTENCY_POLL_SECONDS', 0.05))
+
+# shadow rules (kd_hk_rules.IsShadow = 1) run on this many background threads after the verdict
+SHADOW_RULE_WORKERS = int(os.getenv('SHADOW_RULE_WORKERS', 2))
+# transactions (or batches) waiting for shadow evaluation before new ones are dropped
+SHADOW_RULE_MAX_PENDING = int(os.getenv('SHADOW_RULE_MAX_PENDING', 10000))
+# seconds between flushes of the shadow rule stats into kd_hk_shadow_rule_stats
+SHADOW_RULE_STATS_FLUSH_SECONDS = float(os.getenv('SHADOW_RULE_STATS_FLUSH_SECONDS', 10))
+# the processes on a host take turns flushing under this lock
+SHADOW_RULE_STATS_LOCK_PATH = os.getenv(
+    'SHADOW_RULE_STATS_LOCK_PATH',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'hawkeye_shadow_rule_stats.lock')
+)
+
+# write-behind buffer for report and transaction inserts made on the rule check path
+WRITE_BEHIND_MAX_SIZE = int(os.getenv('WRITE_BEHIND_MAX_SIZE', 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv('WRITE_BEHIND_FLUSH_SECONDS', 1))
+WRITE_BEHIND_SPILL_DIR = os.getenv('WRITE_BEHIND_SPILL_DIR', 'write_behind_spill')
+# seconds between replays of spilled rows; rows the database rejects on their own are quarantined instead
+WRITE_BEHIND_REPLAY_SECONDS = float(os.getenv('WRITE_BEHIND_REPLAY_SECONDS', 30))
+
+# per source account cache of kd_hk_expression_result rows
+EXPRESSION_CACHE_MAX_ACCOUNTS = int(os.getenv('EXPRESSION_CACHE_MAX_ACCOUNTS', 100000))
+EXPRESSION_CACHE_TTL_SECONDS = float(os.getenv('EXPRESSION_CACHE_TTL_SECONDS', 30))
+
+# in-process aggregates for expression rules the aggregate engine can evaluate without triggers
+AGGREGATE_ENGINE_MAX_ACCOUNTS = int(os.getenv('AGGREGATE_ENGINE_MAX_ACCOUNTS', 100000))
+# seconds before an account's aggregates are re-read from kd_hk_transactions, so other workers'
+# transactions are counted within this long
+AGGREGATE_STATE_TTL_SECONDS = float(os.getenv('AGGREGATE_STATE_TTL_SECONDS', 30))
+# transactions queued for insert and not committed yet that seeds still count, and for how many seconds
+AGGREGATE_MAX_PENDING = int(os.getenv('AGGREGATE_MAX_PENDING', 100000))
+AGGREGATE_PENDING_SECONDS = float(os.getenv('AGGREGATE_PENDING_SECONDS', 60))
+
+# kd_hk_expression_result is recomputed by an in-app scheduler instead of per-rule insert triggers;
+# run migrations/001_expression_watermark.sql and `python expression_triggers.py drop` before enabling it
+EXPRESSION_RECOMPUTE_ENABLED = os.getenv('EXPRESSION_RECOMPUTE_ENABLED', 'false').lower() == 'true'
+EXPRESSION_RECOMPUTE_INTERVAL_SECONDS = float(os.getenv('EXPRESSION_RECOMPUTE_INTERVAL_SECONDS', 60))
+# rule_id=seconds pairs for rules whose results may be older, or must be fresher, than the interval
+EXPRESSION_RECOMPUTE_STALENESS_SECONDS = os.getenv('EXPRESSION_RECOMPUTE_STALENESS_SECONDS', '')
+# transactions newer than this are left for the next pass, so rows committed out of Id order are not skipped
+EXPRESSION_RECOMPUTE_SAFETY_LAG_SECONDS = float(os.getenv('EXPRESSION_RECOMPUTE_SAFETY_LAG_SECONDS', 10))
+# one process per host holding this lock runs the recomputation
+EXPRESSION_RECOMPUTE_LOCK_PATH = os.getenv(
+    'EXPRESSION_RECOMPUTE_LOCK_PATH',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'hawkeye_expression_recompute.lock')
+)
+
+# /api/rule/report paging and export
+REPORT_PAGE_DEFAULT_SIZE = int(os.getenv('REPORT_PAGE_DEFAULT_SIZE', 50))
+REPORT_PAGE_MAX_SIZE = int(os.getenv('REPORT_PAGE_MAX_SIZE', 500))
+REPORT_EXPORT_CHUNK_SIZE = int(os.getenv('REPORT_EXPORT_CHUNK_SIZE', 1000))
+# report rollups behind /api/rule/report/summary: seconds between flushes of the counted hits
+REPORT_ROLLUP_FLUSH_SECONDS = float(os.getenv('REPORT_ROLLUP_FLUSH_SECONDS', 10))
+# the processes on a host take turns flushing under this lock
+REPORT_ROLLUP_LOCK_PATH = os.getenv(
+    'REPORT_ROLLUP_LOCK_PATH',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'hawkeye_report_rollup.lock')
+)
+REPORT_SUMMARY_MAX_BUCKETS = int(os.getenv('REPORT_SUMMARY_MAX_BUCKETS', 744))
+REPORT_SUMMARY_MAX_TOP_ACCOUNTS = int(os.getenv('REPORT_SUMMARY_MAX_TOP_ACCOUNTS', 100))
+
+# /api/anomaly/record/batch
+ANOMALY_BATCH_MAX_SIZE = int(os.getenv('ANOMALY_BATCH_MAX_SIZE', 10000))
+ANOMALY_BATCH_CHUNK_SIZE = int(os.getenv('ANOMALY_BATCH_CHUNK_SIZE', 500))
+
+# backtest replays: rows per chunk sent to a worker, and chunks queued per worker
+BACKTEST_CHUNK_SIZE = int(os.getenv('BACKTEST_CHUNK_SIZE', 5000))
+BACKTEST_QUEUE_DEPTH = int(os.getenv('BACKTEST_QUEUE_DEPTH', 4))
+
+# per source account anomaly scoring inside rule_check
+ANOMALY_SCORING_ENABLED = os.getenv('ANOMALY_SCORING_ENABLED', 'true').lower() == 'true'
+# accounts with scoring state (roughly 300 bytes each); the least recently seen is forgotten past this
+ANOMALY_SCORER_MAX_ACCOUNTS = int(os.getenv('ANOMALY_SCORER_MAX_ACCOUNTS', 500000))
+# weight of the newest transaction in the amount and inter-arrival EWMAs
+ANOMALY_EWMA_ALPHA = float(os.getenv('ANOMALY_EWMA_ALPHA', 0.1))
+# z-scores divide by at least this fraction of the account's mean amount or gap, so steady accounts do not
+# turn cent or second differences into spikes
+ANOMALY_RELATIVE_STDDEV_FLOOR = float(os.getenv('ANOMALY_RELATIVE_STDDEV_FLOOR', 0.01))
+# and by at least this many currency units for amounts and seconds for gaps
+ANOMALY_AMOUNT_STDDEV_FLOOR = float(os.getenv('ANOMALY_AMOUNT_STDDEV_FLOOR', 1.0))
+ANOMALY_INTERVAL_STDDEV_FLOOR = float(os.getenv('ANOMALY_INTERVAL_STDDEV_FLOOR', 10.0))
+# transactions an account needs before it is scored
+ANOMALY_MIN_OBSERVATIONS = int(os.getenv('ANOMALY_MIN_OBSERVATIONS', 5))
+# destination accounts remembered per account, 1 to 255
+ANOMALY_RECENT_COUNTERPARTIES = min(255, max(1, int(os.getenv('ANOMALY_RECENT_COUNTERPARTIES', 4))))
+# added to the score when the destination is not among the recent counterparties
+ANOMALY_NEW_COUNTERPARTY_WEIGHT = float(os.getenv('ANOMALY_NEW_COUNTERPARTY_WEIGHT', 1.0))
+# scores at or above this are written to kd_hk_anomalies
+ANOMALY_SCORE_THRESHOLD = float(os.getenv('ANOMALY_SCORE_THRESHOLD', 4.0))
+
+# velocity rules: memory for (rule, account) windows; the least recently used is dropped past this
+VELOCITY_MAX_BYTES = int(os.getenv('VELOCITY_MAX_BYTES', 256 * 1024 * 1024))
+# time buckets per window, the step the window slides in
+VELOCITY_BUCKETS = max(1, int(os.getenv('VELOCITY_BUCKETS', 12)))
+# distinct velocity rules keep 2^precision HyperLogLog registers (bytes) per bucket, 4 to 16;
+# 8 is about 3KB per window with 12 buckets and within a few percent of the true count
+VELOCITY_HLL_PRECISION = min(16, max(4, int(os.getenv('VELOCITY_HLL_PRECISION', 8))))
+# seconds before a window is re-seeded from kd_hk_transactions, so other workers'
+# transactions are counted within this long
+VELOCITY_STATE_TTL_SECONDS = float(os.getenv('VELOCITY_STATE_TTL_SECONDS', 30))
+
+# seconds before information_schema is re-read for /datapoints and rule setup
+SCHEMA_CACHE_TTL_SECONDS = float(os.getenv('SCHEMA_CACHE_TTL_SECONDS', 600))
+
+# shared binary snapshot of the compiled rules, read by every worker on the host; empty disables it
+RULE_SNAPSHOT_PATH = os.getenv(
+    'RULE_SNAPSHOT_PATH',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'hawkeye_rules.snapshot')
+)
+
+# directory shared by the workers on a host: each writes its metrics there and /metrics reports them
+# merged across workers; empty reports only the worker that serves the scrape. Empty it on startup
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR', '')
+# seconds between writes of a worker's metrics to METRICS_MULTIPROC_DIR
+METRICS_MULTIPROC_WRITE_SECONDS = float(os.getenv('METRICS_MULTIPROC_WRITE_SECONDS', 5))
+
+# logging goes through a bounded queue to a background writer
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_MAX_SIZE = int(os.getenv('LOG_QUEUE_MAX_SIZE', 10000))
+# event=rate pairs; events without a rate are always logged, warnings and errors are never sampled
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES',
+                             'transaction_recorded=0.01,expression_rule_result=0.001,transaction_batch_recorded=0.1')
+
+# response encoder: 'auto' uses orjson when it is installed, 'stdlib' forces the json module
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto')
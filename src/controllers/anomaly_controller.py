@@ -1,26 +1,28 @@
-from flask import Blueprint, Response, app, g, json, logging, request
+from flask import Blueprint, request
 
-from src.dto.response_dto import ResponseDto
-from src.infra.db_repo import DatabaseManager
+from src.controllers.responses import error_response, json_response
 from src.services.anomaly_engine_service import AnomalyEngine
-from src.services.rule_engine_service import RuleEngine
 
 anomaly = Blueprint("anomaly", __name__)
 
 @anomaly.route('/record', methods=['POST'])
-def save_record():
+async def save_record():
     dataRequest = request.json
     try:
         anomaly = AnomalyEngine()
-        res = anomaly.save_record(dataRequest)
-        return Response(response=json.dumps(res.to_dict()),
-                            status=res.statuscode,
-                            mimetype='application/json'
-                            )
+        res = await anomaly.save_record_async(dataRequest)
+        return json_response(res)
     except Exception as e:
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
\ No newline at end of file
+        return error_response()
+
+@anomaly.route('/record/batch', methods=['POST'])
+async def save_records():
+    try:
+        anomaly = AnomalyEngine()
+        if request.mimetype == 'application/x-ndjson':
+            res = await anomaly.save_records_ndjson_async(request.get_data(as_text=True))
+        else:
+            res = await anomaly.save_records_async(request.json)
+        return json_response(res)
+    except Exception as e:
+        return error_response()
@@ -0,0 +1,14 @@
+from flask import Blueprint, Response
+
+from src.infra.metrics import registry
+
+metrics = Blueprint("metrics", __name__)
+
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(
+        response=registry.render(),
+        status=200,
+        mimetype='text/plain; version=0.0.4'
+    )
@@ -0,0 +1,18 @@
+from flask import Response
+
+from src.dto.response_dto import ResponseDto
+from src.infra.json_codec import dumps
+
+GENERIC_ERROR_MESSAGE = 'An error occured. Try again later'
+
+
+def json_response(res: ResponseDto):
+    return Response(response=dumps(res.to_dict()),
+                    status=res.statuscode,
+                    headers=res.headers,
+                    mimetype='application/json'
+                    )
+
+
+def error_response(message=GENERIC_ERROR_MESSAGE, status_code=500):
+    return json_response(ResponseDto(False, message, None, status_code))
@@ -1,6 +1,7 @@
-from flask import Blueprint, Response, app, json, logging, request
+from flask import Blueprint, Response, request, stream_with_context
 
-from src.dto.response_dto import ResponseDto
+from src.config import IDEMPOTENCY_KEY_HEADER
+from src.controllers.responses import error_response, json_response
 from src.services.rule_engine_service import RuleEngine
 
 rules = Blueprint("rules", __name__)
@@ -15,35 +16,15 @@ def rule_setup():
             if not data['isExpression']:
                 #print('set value type')
                 res = rules_service.set_value_type_rule(data)
-                return Response(
-                    response=json.dumps(res.to_dict()),
-                    status=res.statuscode,
-                    mimetype='application/json'
-                )
-                return
             else:
                 print('set expression type')
                 res = rules_service.set_expression_type_rule(data)
-                return Response(
-                    response=json.dumps(res.to_dict()),
-                    status=res.statuscode,
-                    mimetype='application/json'
-                )
+            return json_response(res)
         else:
-            return Response(response=json.dumps(ResponseDto(
-                False, 'Invalid Request payload. isExpression value not present', None, 400
-            ).to_dict()),
-                status=400,
-                mimetype='application/json'
-            )
+            return error_response('Invalid Request payload. isExpression value not present', 400)
     except Exception as e:
         print(e)
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
+        return error_response()
 
 
 @rules.route('/datapoints', methods=['GET'])
@@ -51,71 +32,107 @@ def get_data_points():
     try:
         rules_service = RuleEngine()
         res = rules_service.get_data_points()
-        return Response(response=json.dumps(res.to_dict()),
-                        status=res.statuscode,
-                        mimetype='application/json'
-                        )
+        response = json_response(res)
+        # answers If-None-Match / If-Modified-Since with 304 when the schema is unchanged
+        return response.make_conditional(request) if res.isSuccessful else response
     except Exception as e:
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
+        return error_response()
 
+@rules.route('/datapoints/refresh', methods=['POST'])
+def refresh_data_points():
+    try:
+        rules_service = RuleEngine()
+        res = rules_service.refresh_data_points()
+        return json_response(res)
+    except Exception as e:
+        return error_response()
+
+# sync views: under sync workers asgiref would add an event loop and a thread handoff per request, and the
+# expression lookups already run concurrently on the database executor
 @rules.route('/rulecheck', methods=['POST'])
 def checkrule():
     try:
         data = request.json
 
         rules_service = RuleEngine()
-        res = rules_service.rule_check(data)
-        return Response(response=json.dumps(res.to_dict()),
-                        status=res.statuscode,
-                        mimetype='application/json'
-                        )
+        res = rules_service.rule_check(data, request.headers.get(IDEMPOTENCY_KEY_HEADER))
+        return json_response(res)
+    except Exception as e:
+        return error_response()
+
+@rules.route('/rulecheck/batch', methods=['POST'])
+def checkrule_batch():
+    try:
+        data = request.json
+
+        rules_service = RuleEngine()
+        res = rules_service.rule_check_batch(data)
+        return json_response(res)
     except Exception as e:
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
+        return error_response()
 
 @rules.route('/rules', methods=['GET'])
 def get_rules():
     try:
         rules_service = RuleEngine()
         res = rules_service.get_rules()
-        return Response(response=json.dumps(res.to_dict()),
-                        status=res.statuscode,
-                        mimetype='application/json'
-                        )
+        return json_response(res)
     except Exception as e:
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
+        return error_response()
 
 @rules.route('/report', methods=['GET'])
 def get_repot():
     try:
         rules_service = RuleEngine()
-        res = rules_service.get_report()
-        return Response(response=json.dumps(res.to_dict()),
-                        status=res.statuscode,
+        res = rules_service.get_report(request.args)
+        return json_response(res)
+    except Exception as e:
+        return error_response()
+
+@rules.route('/report/export', methods=['GET'])
+def export_report():
+    try:
+        rules_service = RuleEngine()
+        rows, res = rules_service.export_report(request.args)
+        if res:
+            return json_response(res)
+        return Response(stream_with_context(rows),
+                        status=200,
                         mimetype='application/json'
                         )
     except Exception as e:
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
-    
+        return error_response()
+
+@rules.route('/report/summary', methods=['GET'])
+def get_report_summary():
+    try:
+        rules_service = RuleEngine()
+        res = rules_service.get_report_summary(request.args)
+        return json_response(res)
+    except Exception as e:
+        return error_response()
+
+@rules.route('/shadow', methods=['GET'])
+def get_shadow_rules():
+    try:
+        rules_service = RuleEngine()
+        res = rules_service.get_shadow_rules()
+        return json_response(res)
+    except Exception as e:
+        return error_response()
+
+@rules.route('/shadow/promote', methods=['POST'])
+def promote_rule():
+    try:
+        rules_service = RuleEngine()
+        req = request.json
+        if req.get('ruleId'):
+            res = rules_service.promote_rule(req['ruleId'])
+            return json_response(res)
+        return error_response('No ruleId passed', 400)
+    except Exception as e:
+        return error_response()
+
 @rules.route('/disable', methods=['POST'])
 def disable_rule():
     try:
@@ -124,22 +141,7 @@ def disable_rule():
         if req['ruleId']:
             ruleId = req['ruleId']
             res = rules_service.disable_rule(ruleId)
-            return Response(response=json.dumps(res.to_dict()),
-                            status=res.statuscode,
-                            mimetype='application/json'
-                            )
-        return Response(response=json.dumps(ResponseDto(
-            False, 'No ruleId passed', None, 400
-        ).to_dict()),
-            status=400,
-            mimetype='application/json'
-        )
+            return json_response(res)
+        return error_response('No ruleId passed', 400)
     except Exception as e:
-        return Response(response=json.dumps(ResponseDto(
-            False, 'An error occured. Try again later', None, 500
-        ).to_dict()),
-            status=500,
-            mimetype='application/json'
-        )
-    
-
+        return error_response()
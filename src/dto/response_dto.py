@@ -1,15 +1,23 @@
 class ResponseDto:
+    __slots__ = ('isSuccessful', 'message', 'data', 'statuscode', 'headers', 'extra')
+
     def __init__(self, isSuccessful:bool, message:str,
-                  data:object, status_code:int):
+                  data:object, status_code:int, headers:dict=None, extra:dict=None):
         self.isSuccessful = isSuccessful
         self.message = message
         self.data = data
         self.statuscode = status_code
+        self.headers = headers
+        # additional top-level response fields
+        self.extra = extra
 
     def to_dict(self):
-        return {
+        res = {
             "isSuccessful": self.isSuccessful,
             "message": self.message,
             "data": self.data, 
             "statuscode": self.statuscode
-        }
\ No newline at end of file
+        }
+        if self.extra:
+            res.update(self.extra)
+        return res
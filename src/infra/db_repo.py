@@ -1,24 +1,84 @@
+import contextvars
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pyodbc
-from pyodbc import OperationalError
+from pyodbc import InterfaceError, OperationalError
 import asyncio
+from src.infra.metrics import (current_endpoint, db_executor_wait_seconds, db_pool_timeouts, db_pool_wait_seconds,
+                               instrumented)
+
+# errors after which a connection is closed instead of going back to the pool
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+# SQLSTATE class of communication link failures, which drivers also raise as plain pyodbc.Error
+LINK_FAILURE_SQLSTATE_CLASS = '08'
+
+
+def is_connection_error(error):
+    """
+    :return: Whether the error means the connection itself is unusable. Constraint
+        violations, syntax errors and the like leave it fit to go back to the pool.
+    """
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    return (isinstance(error, pyodbc.Error) and bool(error.args)
+            and str(error.args[0]).startswith(LINK_FAILURE_SQLSTATE_CLASS))
+
+
+class DatabaseError(Exception):
+    """Raised by strict reads when the query could not be run, so callers can tell a failure from no rows."""
+
 
 class DatabaseManager:
-    def __init__(self, server, database, username, password, pool_size=3):
+    def __init__(self, server, database, username, password, pool_size=3, min_pool_size=1,
+                 checkout_timeout=5.0, idle_validation_seconds=30.0, health_check_interval=15.0,
+                 executor_workers=None):
         self.server = server
         self.database = database
         self.username = username
         self.password = password
-        self.connection_pool = []  # Pool of connections
+        self.connection_pool = deque()  # Idle connections as (connection, last_used)
         self.pool_size = pool_size  # Maximum number of connections in the pool
-        self.active_connections = 0  # Track active connections
+        self.min_pool_size = min(min_pool_size, pool_size)
+        self.checkout_timeout = checkout_timeout
+        self.idle_validation_seconds = idle_validation_seconds
+        self.health_check_interval = health_check_interval
+        self.active_connections = 0  # Track connections checked out by callers
+        self.total_connections = 0  # Idle + checked out + being created
+        self.waiters = 0
+
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.evictions = 0
+
+        self._pool_lock = threading.Condition(threading.Lock())
+        self._closed = threading.Event()
+        # runs the blocking pyodbc calls behind the *_async methods; more threads than
+        # connections would only queue on the pool, so it defaults to the pool size
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers or pool_size, thread_name_prefix='db')
 
         self._initialize_pool()
+        self._health_thread = threading.Thread(target=self._health_check_loop, name='db-pool-health', daemon=True)
+        self._health_thread.start()
     
     def _initialize_pool(self):
-        while len(self.connection_pool) < self.pool_size:
+        while True:
+            with self._pool_lock:
+                if self.total_connections >= self.min_pool_size:
+                    return
+                # reserve the slot so concurrent checkouts cannot push the pool past pool_size
+                self.total_connections += 1
             conn = self._create_connection()
-            if conn:
-                self.connection_pool.append(conn)
+            with self._pool_lock:
+                if not conn:
+                    self.total_connections -= 1
+                    self._pool_lock.notify()
+                    return
+                self.connection_pool.append((conn, time.monotonic()))
+                self._pool_lock.notify()
 
     def _create_connection(self):
         conn_str = f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={self.server};DATABASE={self.database};UID={self.username};PWD={self.password}'
@@ -30,19 +90,51 @@ class DatabaseManager:
             print("Error creating new connection:", e)
             return None
 
-    def _get_connection(self):
-        if self.connection_pool:
-            conn = self.connection_pool.pop()  # Get a connection from the pool
-            self.active_connections += 1
-            return conn
-        else:
-            # If no connections are available, try to create a new one
-            if self.active_connections < self.pool_size:
-                return self._create_connection()
-            else:
-                print("Max connection limit reached. No available connections.")
+    def _get_connection(self, timeout=None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        create_new = False
+
+        with self._pool_lock:
+            while True:
+                if self.connection_pool:
+                    conn, _ = self.connection_pool.pop()  # Most recently used first
+                    break
+                if self.total_connections < self.pool_size:
+                    # Reserve the slot now and connect outside the lock
+                    self.total_connections += 1
+                    create_new = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.checkout_timeouts += 1
+                    self.checkout_wait_seconds += time.monotonic() - started
+                    db_pool_timeouts.inc(current_endpoint())
+                    print("Max connection limit reached. Timed out waiting for a connection.")
+                    return None
+                self.waiters += 1
+                try:
+                    self._pool_lock.wait(remaining)
+                finally:
+                    self.waiters -= 1
+
+        if create_new:
+            conn = self._create_connection()
+            if not conn:
+                with self._pool_lock:
+                    self.total_connections -= 1
+                    self._pool_lock.notify()
                 return None
 
+        waited = time.monotonic() - started
+        with self._pool_lock:
+            self.active_connections += 1
+            self.checkouts += 1
+            self.checkout_wait_seconds += waited
+        db_pool_wait_seconds.observe(waited, current_endpoint())
+        return conn
+
     def _is_valid_connection(self, connection):
         try:
             # A simple query to check if the connection is still valid
@@ -52,164 +144,353 @@ class DatabaseManager:
         except Exception:
             return False
 
-    def _return_connection(self, connection):
-        if self._is_valid_connection(connection):
-            self.connection_pool.append(connection)  # Return connection to the pool
-        else:
-            print("Invalid connection. Closing it.")
-            connection.close()  # Close the invalid connection
-        self.active_connections -= 1
+    def _discard_connection(self, connection, checked_out=False):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._pool_lock:
+            if checked_out:
+                self.active_connections -= 1
+            self.total_connections -= 1
+            self.evictions += 1
+            self._pool_lock.notify()
+
+    def _return_connection(self, connection, broken=False):
+        """
+        Rolls back whatever the caller left open and puts the connection back
+        at the hot end of the pool. Connections that failed, or cannot roll
+        back, are closed instead, so a dead link is never checked out again.
+
+        :param broken: The caller hit a connection error (is_connection_error) on this connection.
+        """
+        if not broken:
+            try:
+                connection.rollback()
+            except Exception as e:
+                print("Rollback failed, discarding connection:", e)
+                broken = True
+        if broken:
+            self._discard_connection(connection, checked_out=True)
+            return
+
+        # Validation happens in the background by idle time, not on every return
+        with self._pool_lock:
+            self.active_connections -= 1
+            if self._closed.is_set():
+                self.total_connections -= 1
+            else:
+                self.connection_pool.append((connection, time.monotonic()))
+                self._pool_lock.notify()
+                return
+        connection.close()
+
+    def _health_check_loop(self):
+        while not self._closed.wait(self.health_check_interval):
+            try:
+                self._check_idle_connections()
+                self._initialize_pool()
+            except Exception as e:
+                print("Error in connection pool health check:", e)
+
+    def _check_idle_connections(self):
+        now = time.monotonic()
+        with self._pool_lock:
+            # Take stale connections out of the pool so no caller can check them out mid-validation
+            stale = [item for item in self.connection_pool if now - item[1] >= self.idle_validation_seconds]
+            if not stale:
+                return
+            fresh = [item for item in self.connection_pool if now - item[1] < self.idle_validation_seconds]
+            self.connection_pool = deque(fresh)
+
+        for conn, _ in stale:
+            if self._is_valid_connection(conn):
+                with self._pool_lock:
+                    # appendleft keeps the least recently used at the cold end
+                    self.connection_pool.appendleft((conn, time.monotonic()))
+                    self._pool_lock.notify()
+            else:
+                print("Invalid connection. Closing it.")
+                self._discard_connection(conn)
+
+    def pool_stats(self):
+        with self._pool_lock:
+            return {
+                'idle': len(self.connection_pool),
+                'in_use': self.active_connections,
+                'total': self.total_connections,
+                'waiters': self.waiters,
+                'max_size': self.pool_size,
+                'min_size': self.min_pool_size,
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.checkout_timeouts,
+                'checkout_wait_seconds': self.checkout_wait_seconds,
+                'evictions': self.evictions
+            }
+
+    def close(self):
+        self._closed.set()
+        self.executor.shutdown(wait=False)
+        with self._pool_lock:
+            idle = list(self.connection_pool)
+            self.connection_pool.clear()
+            self.total_connections -= len(idle)
+            self._pool_lock.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs a blocking call on the database executor and returns its concurrent Future.
+        The caller's context (the Flask request, for metrics labels) is carried over.
+        """
+        submitted = time.perf_counter()
+        context = contextvars.copy_context()
+
+        def call():
+            db_executor_wait_seconds.observe(time.perf_counter() - submitted, current_endpoint())
+            return func(*args, **kwargs)
+
+        return self.executor.submit(context.run, call)
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        # runs a blocking call on the database executor without blocking the event loop
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
 
     async def single_inserts_async(self, query, params):
-        conn = await asyncio.to_thread(self._get_connection)
-        if not conn:
-            return -1
+        return await self.run_in_executor(self.single_inserts, query, params)
+
+    async def single_insert_no_param_async(self, query):
+        return await self.run_in_executor(self.single_insert_no_param, query)
+
+    async def single_insert_return_id_async(self, query, params):
+        return await self.run_in_executor(self.single_insert_return_id, query, params)
 
-        cursor = conn.cursor()
+    async def multiple_inserts_async(self, query, params):
+        return await self.run_in_executor(self.multiple_inserts, query, params)
+
+    async def fetch_records_async(self, query, params, strict=False):
+        return await self.run_in_executor(self.fetch_records, query, params, strict)
+
+    async def fetch_record_async(self, query, params):
+        return await self.run_in_executor(self.fetch_record, query, params)
+
+    async def fetch_multiple_query_async(self, query, params):
+        return await self.run_in_executor(self.fetch_multiple_query, query, params)
+
+    async def get_columns_of_table_async(self, table_name):
+        return await self.run_in_executor(self.get_columns_of_table, table_name)
+
+    async def stream_records_async(self, query, params, chunk_size=1000):
+        # Async generator: each fetchmany round trip is one executor call
+        rows = self.stream_records(query, params, chunk_size)
         try:
-            # Perform the insert operation asynchronously in a separate thread
-            await asyncio.to_thread(cursor.execute, query, params)
-            await asyncio.to_thread(conn.commit)
-            return 0
-        except Exception as e:
-            print("Error in database add:", e)
-            return None
+            while True:
+                chunk = await self.run_in_executor(lambda: list(itertools.islice(rows, chunk_size)))
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield row
         finally:
-            await asyncio.to_thread(self._return_connection, conn)
+            # closes the connection even when the caller stops early
+            await self.run_in_executor(rows.close)
 
+    @instrumented
     def single_inserts(self, query, params):
         conn = self._get_connection()
         if not conn:
             return -1
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             cursor.execute(query, params)
             conn.commit()
             return 0
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error in database add:", e)
             return None
         finally:
-            self._return_connection(conn)
+            self._return_connection(conn, broken)
     
+    @instrumented
     def single_insert_no_param(self, query):
         conn = self._get_connection()
         if not conn:
             return -1
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             cursor.execute(query)
             conn.commit()
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error in single_insert_no_param:", e)
             return None
         finally:
-            self._return_connection(conn)
+            self._return_connection(conn, broken)
     
+    @instrumented
     def single_insert_return_id(self, query, params):
         conn = self._get_connection()
         if not conn:
             return -1
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             cursor.execute(query, params)
             conn.commit()
             inserted_id = cursor.fetchone()[0]
             return inserted_id
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error in database add:", e)
             return None
         finally:
-            self._return_connection(conn)
+            self._return_connection(conn, broken)
 
+    @instrumented
     def multiple_inserts(self, query, params):
+        """
+        Runs the query once per parameter tuple in one transaction.
+
+        :return: 0 once every row is committed, -1 when nothing was, including
+            when one row broke a unique key and the whole batch was rolled back.
+        """
         conn = self._get_connection()
         if not conn:
             return -1
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
+            # send the whole parameter array in one round trip instead of one per row
+            cursor.fast_executemany = True
             cursor.executemany(query, params)
             conn.commit()
             print("Sucessful insertion")
             return 0
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error in database multiple execute add:", e)
             if "Violation of UNIQUE KEY" in str(e):
-                print("Error: Duplicate entry detected. Skipping insertion.")
-                return 0.
-            else:
-                print(f"Database error occurred: {e}")
-                return -1
+                print("Error: Duplicate entry detected. The batch was rolled back.")
+            return -1
         finally:
-            self._return_connection(conn)
-            
-            
-    def fetch_records(self, query, params):
+            self._return_connection(conn, broken)
+
+    @instrumented
+    def fetch_records(self, query, params, strict=False):
+        """
+        :param strict: Raise DatabaseError instead of returning [] when no connection
+            could be checked out or the query failed.
+        """
         conn = self._get_connection()
         if not conn:
+            if strict:
+                raise DatabaseError('no database connection available')
             return []
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             cursor.execute(query, params)
             rows = cursor.fetchall()
             return rows
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error fetching records:", e)
+            if strict:
+                raise DatabaseError(str(e)) from e
             return []
         finally:
-            self._return_connection(conn)
+            self._return_connection(conn, broken)
     
+    @instrumented
+    def stream_records(self, query, params, chunk_size=1000):
+        # Generator on a dedicated connection outside the pool, which a long
+        # read would otherwise hold until the caller finishes iterating
+        conn = self._create_connection()
+        if not conn:
+            return
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        except Exception as e:
+            print("Error streaming records:", e)
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @instrumented
     def fetch_record(self, query, params):
         conn = self._get_connection()
         if not conn:
             return None
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             cursor.execute(query, params)
             rows = cursor.fetchone()
             return rows
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error fetching records:", e)
             return None
         finally:
-            self._return_connection(conn)
+            self._return_connection(conn, broken)
 
+    @instrumented
     def fetch_multiple_query(self, query, params):
         conn = self._get_connection()
         if not conn:
             return None
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             cursor.execute(query, params)
             rows = cursor.fetchall()
             count = cursor.nextset().fetchone()[0]
             return rows, count
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error fetching records:", e)
             return None
         finally:
-            self._return_connection(conn)
+            self._return_connection(conn, broken)
     
+    @instrumented
     def get_columns_of_table(self, table_name):
         conn = self._get_connection()
         if not conn:
             return None
 
-        cursor = conn.cursor()
+        broken = False
         try:
+            cursor = conn.cursor()
             query = "select column_name, data_type from information_schema.columns where table_name=?"
             cursor.execute(query, (table_name,))
             rows = cursor.fetchall()
             return rows
         except Exception as e:
+            broken = is_connection_error(e)
             print("Error fetching records:", e)
             return None
         finally:
-            self._return_connection(conn)
\ No newline at end of file
+            self._return_connection(conn, broken)
\ No newline at end of file
@@ -0,0 +1,75 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from src.config import JSON_ENCODER
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class RawJson:
+    """
+    Text that is already JSON, like a stored PayloadDetails, to be embedded in
+    a response as is instead of being decoded and encoded again.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class OrjsonEncoder:
+    name = 'orjson'
+
+    def _default(self, value):
+        if isinstance(value, RawJson):
+            return orjson.Fragment(value.value)
+        if isinstance(value, Decimal):
+            # as a string, like Flask's provider, so amounts keep their precision
+            return str(value)
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    def dumps(self, value):
+        # datetimes are written as ISO 8601 by orjson itself
+        return orjson.dumps(value, default=self._default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class StdlibEncoder:
+    name = 'stdlib'
+
+    def _default(self, value):
+        if isinstance(value, RawJson):
+            # the stdlib encoder cannot splice raw text, so the fallback decodes it
+            return json.loads(value.value)
+        if isinstance(value, (datetime, date, time)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    def dumps(self, value):
+        return json.dumps(value, default=self._default, separators=(',', ':')).encode('utf-8')
+
+
+def get_encoder(name='auto'):
+    """
+    :param name: 'orjson', 'stdlib' or 'auto' (orjson when it is installed).
+    """
+    if name == 'stdlib' or (name == 'auto' and orjson is None):
+        return StdlibEncoder()
+    if orjson is None:
+        raise ValueError('orjson is not installed')
+    return OrjsonEncoder()
+
+
+encoder = get_encoder(JSON_ENCODER)
+
+
+def dumps(value):
+    """
+    :return: value encoded as UTF-8 JSON bytes.
+    """
+    return encoder.dumps(value)
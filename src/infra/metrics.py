@@ -0,0 +1,388 @@
+import atexit
+import fcntl
+import functools
+import glob
+import inspect
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+
+# seconds; spans a cached in-memory lookup up to a stalled database call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUERY_VERB_PATTERN = re.compile(r"^\s*(\w+)")
+QUERY_TABLE_PATTERN = re.compile(r"\b(kd_hk_\w+|information_schema\.\w+|sys\.\w+)", re.I)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'label_names', '_values', '_lock')
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def merge(self, merged, samples, live):
+        for labels, value in samples:
+            merged[labels] = merged.get(labels, 0) + value
+
+    def render(self, samples=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in self.samples() if samples is None else samples:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. observe() is a bisect plus two additions under a
+    lock, so it is cheap enough for every query and every rule check stage.
+    """
+    __slots__ = ('name', 'help', 'label_names', 'buckets', '_series', '_lock')
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            return [(labels, list(values)) for labels, values in self._series.items()]
+
+    def merge(self, merged, samples, live):
+        for labels, values in samples:
+            series = merged.get(labels)
+            if series is None:
+                merged[labels] = list(values)
+            else:
+                merged[labels] = [total + value for total, value in zip(series, values)]
+
+    def render(self, samples=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, values in self.samples() if samples is None else samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, labels, (('le', bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {values[-1]}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """
+    Gauge read from a callback at scrape time. The callback returns a number,
+    or a list of (label values, number) pairs when the gauge has labels.
+
+    Across workers a gauge is the sum of the live workers' values, or their
+    minimum or maximum with multiprocess_mode 'min' or 'max'; exited workers
+    are left out.
+    """
+    __slots__ = ('name', 'help', 'label_names', 'callback', 'multiprocess_mode')
+
+    def __init__(self, name, help, callback, label_names=(), multiprocess_mode='sum'):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.callback = callback
+        self.multiprocess_mode = multiprocess_mode
+
+    def samples(self):
+        value = self.callback()
+        return [(tuple(labels), sample) for labels, sample in value] if self.label_names else [((), value)]
+
+    def merge(self, merged, samples, live):
+        if not live:
+            return
+        for labels, value in samples:
+            if labels not in merged:
+                merged[labels] = value
+            elif self.multiprocess_mode == 'max':
+                merged[labels] = max(merged[labels], value)
+            elif self.multiprocess_mode == 'min':
+                merged[labels] = min(merged[labels], value)
+            else:
+                merged[labels] += value
+
+    def render(self, samples=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for labels, sample in self.samples() if samples is None else samples:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {sample}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics rendered in the Prometheus text exposition format.
+
+    Every process keeps its own registry. Under gunicorn a scrape is served by
+    one worker only, so without share() it reports that worker's values and
+    the others are never seen. With share(directory), every worker writes its
+    values to the directory every few seconds and a scrape reports them
+    merged: counters and histograms summed over all the workers that have
+    written, including exited ones, and gauges over the live ones.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._directory = None
+        self._stopped = threading.Event()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def gauge(self, name, help, callback, label_names=(), multiprocess_mode='sum'):
+        gauge = Gauge(name, help, callback, label_names, multiprocess_mode)
+        with self._lock:
+            # later registrations win, so a rebuilt pool or queue replaces the old callback
+            self._metrics[name] = gauge
+        return gauge
+
+    def share(self, directory, interval=5.0):
+        """
+        Writes this process's values to `directory` every `interval` seconds and
+        on exit, and makes render() report the values of every process writing
+        there. The directory should be emptied when the app is (re)started.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        thread = threading.Thread(target=self._share, args=(interval,), name='metrics-writer', daemon=True)
+        thread.start()
+        atexit.register(self._close)
+
+    def _share(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self._write()
+            except Exception as e:
+                print("Error writing shared metrics:", e)
+
+    def _close(self):
+        self._stopped.set()
+        self._write()
+
+    def _samples(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        samples = {}
+        for metric in metrics:
+            try:
+                samples[metric.name] = metric.samples()
+            except Exception as e:
+                print(f"Error reading metric {metric.name}:", e)
+        return samples
+
+    def _write(self):
+        path = os.path.join(self._directory, f'metrics_{os.getpid()}.json')
+        # the writer thread and a scrape may write at once, so each has its own temporary file
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as metrics_file:
+            json.dump(self._samples(), metrics_file, default=str)
+        os.replace(temporary, path)
+
+    def _read(self, path):
+        try:
+            with open(path, encoding='utf-8') as metrics_file:
+                return {name: [(tuple(labels), value) for labels, value in samples]
+                        for name, samples in json.load(metrics_file).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _merge(self, merged, samples, live):
+        with self._lock:
+            metrics = dict(self._metrics)
+        for name, metric_samples in samples.items():
+            metric = metrics.get(name)
+            if metric is not None:
+                metric.merge(merged.setdefault(name, {}), metric_samples, live)
+
+    def _shared_samples(self):
+        """
+        Merges the files of every process. The files of exited processes are
+        folded into metrics_exited.json, so the directory does not grow with
+        every worker restart; only their counters and histograms are kept.
+        """
+        self._write()
+        merged = {}
+        with open(os.path.join(self._directory, 'metrics.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                exited_path = os.path.join(self._directory, 'metrics_exited.json')
+                exited = {}
+                self._merge(exited, self._read(exited_path), False)
+                folded = []
+                for path in glob.glob(os.path.join(self._directory, 'metrics_[0-9]*.json')):
+                    pid = int(os.path.basename(path)[len('metrics_'):-len('.json')])
+                    if _alive(pid):
+                        self._merge(merged, self._read(path), True)
+                    else:
+                        self._merge(exited, self._read(path), False)
+                        folded.append(path)
+                if folded:
+                    with open(exited_path + '.tmp', 'w', encoding='utf-8') as exited_file:
+                        json.dump({name: list(samples.items()) for name, samples in exited.items()}, exited_file,
+                                  default=str)
+                    os.replace(exited_path + '.tmp', exited_path)
+                    for path in folded:
+                        os.remove(path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._merge(merged, {name: samples.items() for name, samples in exited.items()}, False)
+        return {name: list(samples.items()) for name, samples in merged.items()}
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        shared = self._shared_samples() if self._directory else None
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render(None if shared is None else shared.get(metric.name, [])))
+            except Exception as e:
+                print(f"Error rendering metric {metric.name}:", e)
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = MetricsRegistry()
+
+db_query_seconds = registry.histogram(
+    'hawkeye_db_query_seconds', 'Time spent in DatabaseManager calls, including the pool wait.',
+    ('method', 'kind', 'endpoint'))
+db_pool_wait_seconds = registry.histogram(
+    'hawkeye_db_pool_wait_seconds', 'Time spent waiting to check a connection out of the pool.', ('endpoint',))
+db_executor_wait_seconds = registry.histogram(
+    'hawkeye_db_executor_wait_seconds', 'Time async database calls wait for a free executor thread.', ('endpoint',))
+db_pool_timeouts = registry.counter(
+    'hawkeye_db_pool_checkout_timeouts_total', 'Checkouts that gave up waiting for a free connection.', ('endpoint',))
+rule_check_stage_seconds = registry.histogram(
+    'hawkeye_rule_check_stage_seconds', 'Time spent in each stage of a rule check.', ('endpoint', 'stage'))
+rule_check_faults = registry.counter(
+    'hawkeye_rule_check_faulted_rules_total', 'Faulted rules found by rule checks.', ('endpoint',))
+rule_check_replays = registry.counter(
+    'hawkeye_rule_check_replays_total', 'Rule checks answered from the idempotency cache.', ('endpoint',))
+http_request_seconds = registry.histogram(
+    'hawkeye_http_request_seconds', 'Time spent serving HTTP requests.', ('endpoint', 'method', 'status'))
+
+
+@functools.lru_cache(maxsize=1024)
+def query_kind(query):
+    """
+    :return: A low-cardinality label for a query, like 'select kd_hk_rules'.
+    """
+    verb = QUERY_VERB_PATTERN.match(query)
+    table = QUERY_TABLE_PATTERN.search(query)
+    if verb is None:
+        return 'other'
+    return f"{verb.group(1).lower()} {table.group(1).lower() if table else 'other'}"
+
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
+
+
+def instrumented(method):
+    """
+    Records the duration of a DatabaseManager method in hawkeye_db_query_seconds,
+    labelled with the method, the kind of query and the Flask endpoint.
+    Generators are timed until they are exhausted or closed.
+    """
+    name = method.__name__
+    takes_query = 'query' in inspect.signature(method).parameters
+
+    def labels(args, kwargs):
+        if not takes_query:
+            return name, 'select information_schema.columns', current_endpoint()
+        query = kwargs.get('query', args[0] if args else None)
+        return name, query_kind(query) if isinstance(query, str) else 'other', current_endpoint()
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            with db_query_seconds.time(*labels(args, kwargs)):
+                return await method(self, *args, **kwargs)
+        return async_wrapper
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            with db_query_seconds.time(*labels(args, kwargs)):
+                yield from method(self, *args, **kwargs)
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with db_query_seconds.time(*labels(args, kwargs)):
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,250 @@
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# magic, format, rule count, snapshot version, published_at (unix seconds), strings length,
+# matrix section length, crc32 of the body
+HEADER = struct.Struct('<4sHIQdIII')
+# id, flags (FLAG_*), threshold kind, threshold (8 raw bytes), then string table offsets for
+# data_point, conditional, data_type, expression, name, description, string threshold
+RECORD = struct.Struct('<qBB2x8s7I')
+# the matrix section starts with its column count, then per column the string table offsets of
+# data_point and data_type and its range count, followed by that many ranges: operator code, rule
+# count and the section offset of the float64 thresholds, which the int64 rule ids follow
+MATRIX = struct.Struct('<I4x')
+COLUMN = struct.Struct('<III4x')
+RANGE = struct.Struct('<IIQ')
+MAGIC = b'HKRS'
+FORMAT_VERSION = 3
+NO_STRING = 0xFFFFFFFF
+FLAG_EXPRESSION = 1
+FLAG_SHADOW = 2
+
+THRESHOLD_NONE, THRESHOLD_FLOAT, THRESHOLD_INT, THRESHOLD_DATETIME, THRESHOLD_STRING = range(5)
+DATETIME_EPOCH = datetime(1, 1, 1)
+
+
+def _aligned(offset):
+    # numpy reads the matrix arrays in place, so they start on 8 byte boundaries
+    return (offset + 7) & ~7
+
+
+class RuleSnapshot:
+    """
+    Versioned binary snapshot of the compiled active rules in a file shared by
+    every worker on the host (under /dev/shm by default, so it lives in memory).
+
+    A publisher writes the complete snapshot to a temporary file and renames it
+    over the shared path, so readers that mmap the path always see a whole
+    snapshot. Thresholds are stored already typed, so readers rebuild rules
+    without going back to the database or re-running checkValue conversions.
+
+    Value rules compiled into the ValueRuleMatrix are stored only as its
+    threshold and rule id arrays, and are never rebuilt as rule objects.
+    Readers wrap the threshold arrays around the mapping instead of copying
+    them, so every worker on the host searches one shared copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._stat_key = None
+        self._header = None
+
+    def _encode_threshold(self, value, strings):
+        if value is None:
+            return THRESHOLD_NONE, bytes(8), NO_STRING
+        if isinstance(value, datetime):
+            micros = (value - DATETIME_EPOCH) // timedelta(microseconds=1)
+            return THRESHOLD_DATETIME, struct.pack('<q', micros), NO_STRING
+        if isinstance(value, str):
+            return THRESHOLD_STRING, bytes(8), strings(str(value))
+        if isinstance(value, int):
+            return THRESHOLD_INT, struct.pack('<q', value), NO_STRING
+        return THRESHOLD_FLOAT, struct.pack('<d', float(value)), NO_STRING
+
+    def _decode_threshold(self, kind, raw, text):
+        if kind == THRESHOLD_FLOAT:
+            return struct.unpack('<d', raw)[0]
+        if kind == THRESHOLD_INT:
+            return struct.unpack('<q', raw)[0]
+        if kind == THRESHOLD_DATETIME:
+            return DATETIME_EPOCH + timedelta(microseconds=struct.unpack('<q', raw)[0])
+        if kind == THRESHOLD_STRING:
+            return text
+        return None
+
+    def publish(self, rule_set, version):
+        """
+        :param rule_set: A CompiledRuleSet; its matrix columns, the rules checked one by one
+            and its shadow rules are written.
+        """
+        table = bytearray()
+        offsets = {}
+
+        def string(value):
+            if value is None:
+                return NO_STRING
+            if value not in offsets:
+                encoded = value.encode('utf-8')
+                offsets[value] = len(table)
+                table.extend(struct.pack('<I', len(encoded)))
+                table.extend(encoded)
+            return offsets[value]
+
+        rules = list(rule_set) + list(rule_set.shadow)
+        records = bytearray()
+        for rule in rules:
+            kind, raw, text_offset = self._encode_threshold(rule.threshold, string)
+            records.extend(RECORD.pack(
+                rule.id, (FLAG_EXPRESSION if rule.is_expression else 0) | (FLAG_SHADOW if rule.shadow else 0), kind, raw,
+                string(rule.data_point), string(rule.conditional), string(rule.data_type),
+                string(rule.expression), string(rule.name), string(rule.description), text_offset
+            ))
+
+        columns = rule_set.value_matrix.columns
+        index = bytearray(MATRIX.pack(len(columns)))
+        arrays = []
+        array_offset = _aligned(MATRIX.size + sum(COLUMN.size + RANGE.size * len(column.ranges) for column in columns))
+        for column in columns:
+            index.extend(COLUMN.pack(string(column.data_point), string(column.data_type), len(column.ranges)))
+            for code, thresholds, rule_ids in column.ranges:
+                index.extend(RANGE.pack(code, len(rule_ids), array_offset))
+                arrays.append(thresholds.astype('<f8').tobytes() + np.asarray(rule_ids, dtype='<i8').tobytes())
+                array_offset += 16 * len(rule_ids)
+        matrix = bytes(index).ljust(_aligned(len(index)), b'\0') + b''.join(arrays)
+
+        padding = bytes(_aligned(HEADER.size + len(records) + len(table)) - (HEADER.size + len(records) + len(table)))
+        body = bytes(records) + bytes(table) + padding + matrix
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, len(rules), version, time.time(), len(table), len(matrix),
+                             zlib.crc32(body))
+
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(header)
+            snapshot_file.write(body)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.path)
+
+    def header(self):
+        """
+        :return: (version, published_at) of the current snapshot, or None if there is none.
+
+        Only re-reads the header when the file was replaced since the last call,
+        so checking for a new version costs one stat().
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._stat_key:
+            with open(self.path, 'rb') as snapshot_file:
+                raw = snapshot_file.read(HEADER.size)
+            if len(raw) < HEADER.size:
+                return None
+            magic, format_version, _, version, published_at, _, _, _ = HEADER.unpack(raw)
+            if magic != MAGIC or format_version != FORMAT_VERSION:
+                return None
+            self._stat_key = key
+            self._header = (version, published_at)
+        return self._header
+
+    def read(self, build_rule, build_column):
+        """
+        Maps the snapshot read-only and rebuilds its rules and matrix columns.
+
+        :param build_rule: Called with the typed fields of each rule, like CompiledRule.from_fields.
+        :param build_column: Called with data_point, data_type and the (operator code, thresholds,
+            rule ids) ranges of each matrix column, like DataPointColumns. The arrays are
+            read-only views of the mapping, which stays open for as long as they are referenced.
+        :return: (version, published_at, rules, columns), or None when the snapshot is missing or corrupt.
+        """
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            return self._decode(mapped, build_rule, build_column)
+        except (ValueError, struct.error):
+            return None
+
+    def _decode(self, mapped, build_rule, build_column):
+        (magic, format_version, count, version, published_at,
+         table_length, matrix_length, checksum) = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            return None
+        body = memoryview(mapped)[HEADER.size:]
+        try:
+            if zlib.crc32(body) != checksum:
+                return None
+            records_length = count * RECORD.size
+            table = bytes(body[records_length:records_length + table_length])
+        finally:
+            body.release()
+
+        def string(offset):
+            if offset == NO_STRING:
+                return None
+            length = struct.unpack_from('<I', table, offset)[0]
+            return table[offset + 4:offset + 4 + length].decode('utf-8')
+
+        rules = []
+        for index in range(count):
+            (rule_id, flags, kind, raw, data_point, conditional, data_type,
+             expression, name, description, text) = RECORD.unpack_from(mapped, HEADER.size + index * RECORD.size)
+            rules.append(build_rule(
+                id=rule_id,
+                data_point=string(data_point),
+                is_expression=bool(flags & FLAG_EXPRESSION),
+                conditional=string(conditional),
+                data_type=string(data_type),
+                threshold=self._decode_threshold(kind, raw, string(text)),
+                name=string(name),
+                description=string(description),
+                expression=string(expression),
+                shadow=bool(flags & FLAG_SHADOW)
+            ))
+
+        section = _aligned(HEADER.size + records_length + table_length)
+        if section + matrix_length > len(mapped):
+            return None
+        position = section + MATRIX.size
+        columns = []
+        for _ in range(MATRIX.unpack_from(mapped, section)[0]):
+            data_point, data_type, range_count = COLUMN.unpack_from(mapped, position)
+            position += COLUMN.size
+            ranges = []
+            for _ in range(range_count):
+                code, length, offset = RANGE.unpack_from(mapped, position)
+                position += RANGE.size
+                thresholds = np.frombuffer(mapped, dtype='<f8', count=length, offset=section + offset)
+                rule_ids = np.frombuffer(mapped, dtype='<i8', count=length, offset=section + offset + 8 * length)
+                ranges.append((code, thresholds, rule_ids))
+            columns.append(build_column(string(data_point), string(data_type), ranges))
+        return version, published_at, rules, columns
+
+    def publish_lock(self, blocking=True):
+        """
+        Opens and flocks the publisher lock file so only one worker reloads from
+        the database at a time. Returns the open file (close it to release) or
+        None when blocking is False and another worker holds the lock.
+        """
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
@@ -0,0 +1,116 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from src.infra.metrics import registry
+
+log_records_dropped = registry.counter(
+    'hawkeye_log_records_dropped_total', 'Log records not written, by reason.', ('reason',))
+
+_sample_rates = {}
+
+
+def parse_sample_rates(value):
+    """
+    :param value: Comma separated event=rate pairs, like 'transaction_recorded=0.01'.
+    :return: {event: rate} with rates clamped to [0, 1]; malformed pairs are ignored.
+    """
+    rates = {}
+    for pair in (value or '').split(','):
+        event, _, rate = pair.partition('=')
+        try:
+            rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+def log_event(logger, level, event, message, *args, **fields):
+    """
+    Logs a structured event. The sampling decision and the level check happen
+    before a LogRecord is built, and message % args is only formatted by the
+    background writer, so a dropped or disabled event costs a dict lookup.
+
+    :param event: Stable event name, used as the sampling key and the `event` JSON field.
+    :param fields: Extra values written as top-level JSON fields.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = _sample_rates.get(event)
+    if rate is not None and level < logging.WARNING and random.random() >= rate:
+        log_records_dropped.inc('sampled')
+        return
+    logger.log(level, message, *args, extra={'event': event, 'fields': fields, 'sample_rate': rate})
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with the timestamp, level, logger, event name,
+    formatted message and the event's fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+        sample_rate = getattr(record, 'sample_rate', None)
+        if sample_rate is not None:
+            entry['sampleRate'] = sample_rate
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that hands the record over untouched, so message formatting
+    happens on the writer thread, and drops records instead of blocking or
+    raising when the queue is full.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc('queue_full')
+
+
+def configure_logging(level='INFO', log_format='json', sample_rates='', queue_size=10000, stream=None):
+    """
+    Routes the root logger through a bounded queue to a background writer.
+
+    :return: The started QueueListener; it is stopped, flushing what is queued, at exit.
+    """
+    _sample_rates.clear()
+    _sample_rates.update(parse_sample_rates(sample_rates))
+
+    writer = logging.StreamHandler(stream or sys.stderr)
+    if log_format == 'json':
+        writer.setFormatter(JsonFormatter())
+    else:
+        writer.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+
+    records = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(records))
+    root.setLevel(level)
+
+    listener = QueueListener(records, writer, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,247 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process buffer for inserts that do not need to finish before the
+    caller gets its response.
+
+    Rows are grouped by query and written with DatabaseManager.multiple_inserts
+    once batch_size rows are waiting or flush_interval seconds have passed.
+    A group that fails is retried row by row, so one bad row does not hold
+    back the others. A row that fails on its own while the database answers
+    is moved to a quarantine file; rows that fail because the database is
+    unreachable, or that do not fit in the buffer, are appended to a spill
+    file and replayed every replay_interval seconds.
+    Rows still in memory are flushed (or spilled) on interpreter shutdown.
+    Listeners registered for a query are called with its rows once they are committed.
+    """
+
+    def __init__(self, db, max_size=10000, batch_size=500, flush_interval=1.0, spill_dir='write_behind_spill',
+                 replay_interval=30.0):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_interval = replay_interval
+        self.spill_dir = spill_dir
+        self.spill_path = os.path.join(spill_dir, f'write_behind_{os.getpid()}.jsonl')
+        self.quarantine_path = os.path.join(spill_dir, f'write_behind_quarantine_{os.getpid()}.jsonl')
+
+        self.flushed = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.quarantined = 0
+
+        self._listeners = {}
+        self._queue = queue.Queue(maxsize=max_size)
+        self._flush_lock = threading.Lock()
+        self._replayed_at = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_listener(self, query, callback):
+        self._listeners.setdefault(query, []).append(callback)
+
+    def _notify(self, query, rows):
+        for callback in self._listeners.get(query, ()):
+            try:
+                callback(rows)
+            except Exception as e:
+                print("Error in write-behind listener:", e)
+
+    def put(self, query, params):
+        try:
+            self._queue.put_nowait((query, params))
+        except queue.Full:
+            self._spill([(query, params)])
+
+    def put_many(self, query, rows):
+        for params in rows:
+            self.put(query, params)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _database_reachable(self):
+        return self.db.fetch_record("select 1", ()) is not None
+
+    def _insert(self, query, rows):
+        """
+        Inserts the rows, one by one when the batch insert fails.
+
+        :return: The number of rows written, and the rows that could not be
+            written because the database is unreachable, to be spilled. Rows
+            the database rejected on their own are quarantined here.
+        """
+        if self.db.multiple_inserts(query, rows) != -1:
+            self._notify(query, rows)
+            return len(rows), []
+
+        written, rejected = [], []
+        for index, params in enumerate(rows):
+            result = self.db.single_inserts(query, params)
+            if result == 0:
+                written.append(params)
+                continue
+            if result == -1 or not self._database_reachable():
+                unwritten = rows[index:]
+                break
+            rejected.append(params)
+        else:
+            unwritten = []
+
+        if written:
+            self._notify(query, written)
+        if rejected:
+            self._quarantine(query, rejected)
+        return len(written), unwritten
+
+    def _write(self, batch):
+        grouped = {}
+        for query, params in batch:
+            grouped.setdefault(query, []).append(tuple(params))
+
+        failed = []
+        for query, rows in grouped.items():
+            written, unwritten = self._insert(query, rows)
+            self.flushed += written
+            failed.extend((query, params) for params in unwritten)
+        if failed:
+            self._spill(failed)
+        return not failed
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                batch = self._take_batch()
+                with self._flush_lock:
+                    if batch:
+                        self._write(batch)
+                    if time.monotonic() - self._replayed_at >= self.replay_interval:
+                        self._replayed_at = time.monotonic()
+                        self._replay_spilled()
+            except Exception as e:
+                print("Error in write-behind flush:", e)
+
+    def flush(self):
+        with self._flush_lock:
+            batch = self._drain()
+            for start in range(0, len(batch), self.batch_size):
+                self._write(batch[start:start + self.batch_size])
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join(timeout=self.flush_interval * 2)
+        self.flush()
+
+    def _append(self, path, rows):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        lines = ''.join(json.dumps([query, list(params)], default=str) + '\n' for query, params in rows)
+        with open(path, 'a', encoding='utf-8') as spill_file:
+            fcntl.flock(spill_file, fcntl.LOCK_EX)
+            try:
+                spill_file.write(lines)
+                spill_file.flush()
+                os.fsync(spill_file.fileno())
+            finally:
+                fcntl.flock(spill_file, fcntl.LOCK_UN)
+
+    def _spill(self, rows):
+        self._append(self.spill_path, rows)
+        self.spilled += len(rows)
+        print(f"Write-behind spilled {len(rows)} rows to {self.spill_path}")
+
+    def _quarantine(self, query, rows):
+        # never replayed; kept for someone to inspect and fix by hand
+        self._append(self.quarantine_path, [(query, params) for params in rows])
+        self.quarantined += len(rows)
+        print(f"Write-behind quarantined {len(rows)} rejected rows to {self.quarantine_path}")
+
+    def _spilled_chunks(self, spill_file):
+        chunk = []
+        for line in spill_file:
+            if line.strip():
+                chunk.append(json.loads(line))
+                if len(chunk) == self.batch_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def _replay_file(self, spill_file):
+        """
+        Replays the file batch_size rows at a time and rewrites it with the
+        rows that are still unwritten. Once a batch finds the database
+        unreachable the rest of the file is kept without trying it.
+        """
+        unreachable = False
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as kept:
+            for chunk in self._spilled_chunks(spill_file):
+                grouped = {}
+                for query, params in chunk:
+                    grouped.setdefault(query, []).append(tuple(params))
+                for query, rows in grouped.items():
+                    written, unwritten = (0, rows) if unreachable else self._insert(query, rows)
+                    unreachable = unreachable or bool(unwritten)
+                    self.replayed += written
+                    kept.writelines(json.dumps([query, list(params)], default=str) + '\n' for params in unwritten)
+
+            kept.seek(0)
+            spill_file.seek(0)
+            spill_file.truncate()
+            shutil.copyfileobj(kept, spill_file)
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+
+    def _replay_spilled(self):
+        # files left behind by other (possibly dead) workers are replayed too;
+        # the flock keeps two workers from replaying the same file at once.
+        # Files are truncated rather than removed as their owner may still append to them.
+        for path in glob.glob(os.path.join(self.spill_dir, 'write_behind_[0-9]*.jsonl')):
+            with open(path, 'r+', encoding='utf-8') as spill_file:
+                try:
+                    fcntl.flock(spill_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    self._replay_file(spill_file)
+                finally:
+                    fcntl.flock(spill_file, fcntl.LOCK_UN)
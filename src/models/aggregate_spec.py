@@ -0,0 +1,116 @@
+import re
+
+EXPRESSION_PATTERN = re.compile(
+    r"^\s*select\s+(sum|count|avg|min|max)\s*\(\s*(\*|\w+)\s*\)\s+from\s+kd_hk_transactions"
+    r"(?:\s+with\s*\(\s*nolock\s*\))?\s+where\s+(.+?)\s+and\s+sourceaccountnumber\s*=\s*\?\s*$",
+    re.S
+)
+WINDOW_PATTERN = re.compile(
+    r"^(\w+)\s*(>=|>)\s*dateadd\s*\(\s*(second|minute|hour|day)\s*,\s*-\s*(\d+)\s*,\s*getdate\s*\(\s*\)\s*\)$"
+)
+PREDICATE_PATTERN = re.compile(r"^(\w+)\s*(>=|<=|<>|!=|=|>|<)\s*('[^']*'|-?\d+(?:\.\d+)?)$")
+
+WINDOW_UNITS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+PREDICATE_OPERATORS = {
+    '=': lambda x, y: x == y,
+    '<>': lambda x, y: x != y,
+    '!=': lambda x, y: x != y,
+    '>': lambda x, y: x > y,
+    '<': lambda x, y: x < y,
+    '>=': lambda x, y: x >= y,
+    '<=': lambda x, y: x <= y,
+}
+
+
+class AggregateSpec:
+    """
+    The shape of an expression rule the aggregate engine can maintain itself:
+    one sum/count/avg/min/max over kd_hk_transactions per source account,
+    filtered by `column op literal` predicates and optionally a trailing
+    `column >= dateadd(unit, -n, getdate())` window.
+    """
+    __slots__ = ('function', 'column', 'predicates', 'window_column', 'window_seconds', 'where_clause')
+
+    def __init__(self, function, column, predicates, window_column, window_seconds, where_clause):
+        self.function = function
+        self.column = column
+        self.predicates = predicates
+        self.window_column = window_column
+        self.window_seconds = window_seconds
+        self.where_clause = where_clause
+
+    @classmethod
+    def parse(cls, expression):
+        """
+        :param expression: The stored kd_hk_rules expression.
+        :return: The spec, or None when the expression needs the database to evaluate it.
+        """
+        if not expression:
+            return None
+        match = EXPRESSION_PATTERN.match(expression.lower())
+        if match is None:
+            return None
+        function, column, where_clause = match.groups()
+        if re.search(r"\b(or|not|between|in|like|exists|select)\b|\(\s*select", where_clause):
+            return None
+
+        predicates = []
+        window_column = None
+        window_seconds = None
+        for condition in re.split(r"\s+and\s+", where_clause.strip()):
+            window = WINDOW_PATTERN.match(condition)
+            if window is not None and window_column is None:
+                window_column = window.group(1)
+                window_seconds = int(window.group(4)) * WINDOW_UNITS[window.group(3)]
+                continue
+            predicate = PREDICATE_PATTERN.match(condition)
+            if predicate is None:
+                return None
+            name, operator, literal = predicate.groups()
+            if literal.startswith("'"):
+                value, numeric = literal[1:-1], False
+            else:
+                value, numeric = float(literal), True
+            predicates.append((name, PREDICATE_OPERATORS[operator], value, numeric))
+
+        return cls(function, None if column == '*' else column, tuple(predicates),
+                   window_column, window_seconds, where_clause)
+
+    def matches(self, data):
+        for name, operator, value, numeric in self.predicates:
+            if name not in data or data[name] is None:
+                return False
+            try:
+                current = float(data[name]) if numeric else str(data[name]).lower()
+            except (ValueError, TypeError):
+                return False
+            if not operator(current, value):
+                return False
+        return True
+
+    def value_of(self, data):
+        if self.column is None:
+            return 1
+        value = data.get(self.column)
+        return float(value) if value is not None else None
+
+    def seed_query(self, accounts=1):
+        """
+        :param accounts: Number of source account parameters.
+        :return: The query reading the accounts' current aggregates. Windowed
+            rules read one row per transaction with its age in seconds by the
+            database clock, the others one row per account.
+        """
+        where = (f"where {self.where_clause} "
+                 f"and sourceaccountnumber in ({', '.join('?' * accounts)})")
+        if self.window_column is not None:
+            selected = self.column or '1'
+            return (f"select sourceaccountnumber, {selected}, datediff(second, {self.window_column}, getdate()) "
+                    f"from kd_hk_transactions with(nolock) {where}")
+        if self.column is None:
+            selected = "count(*), null, null, null"
+        else:
+            selected = f"count({self.column}), sum({self.column}), min({self.column}), max({self.column})"
+        return (f"select sourceaccountnumber, {selected} from kd_hk_transactions with(nolock) "
+                f"{where} group by sourceaccountnumber")
@@ -0,0 +1,125 @@
+from src.models.aggregate_spec import AggregateSpec
+from src.models.velocity_spec import VelocitySpec
+from src.utils import CONDITIONAL_MAP, TYPE_VALIDATION_MAP
+
+
+class CompiledRule:
+    """
+    An active kd_hk_rules row with its converter, comparator and (for value
+    rules) threshold resolved once at load time instead of on every check.
+    """
+    __slots__ = ('id', 'data_point', 'is_expression', 'conditional', 'data_type',
+                 'converter', 'comparator', 'threshold', 'name', 'description',
+                 'expression', 'aggregate', 'velocity', 'shadow')
+
+    def __init__(self, id, data_point, is_expression, conditional, data_type,
+                 converter, comparator, threshold, name, description,
+                 expression=None, aggregate=None, velocity=None, shadow=False):
+        self.id = id
+        self.data_point = data_point
+        self.is_expression = is_expression
+        self.conditional = conditional
+        self.data_type = data_type
+        self.converter = converter
+        self.comparator = comparator
+        self.threshold = threshold
+        self.name = name
+        self.description = description
+        self.expression = expression
+        # set when the aggregate engine can maintain the expression without the database
+        self.aggregate = aggregate
+        # set for velocity rules, which compare a sliding window of the account's transactions with threshold
+        self.velocity = velocity
+        # shadow rules are evaluated off the request path and never change a verdict
+        self.shadow = shadow
+
+    @property
+    def reads_expression_results(self):
+        # expression rules whose result only the database can compute, via kd_hk_expression_result
+        return self.is_expression and self.aggregate is None and self.velocity is None
+
+    def faulted_by(self, value, rule_result=None):
+        """
+        Compares a transaction's data point value against the rule.
+
+        :param value: The transaction's value of data_point, or for velocity rules the window's value.
+        :param rule_result: For expression rules, the expression's current result for the account.
+        :return: True if the rule is faulted, False otherwise (always False without a result).
+        :raises ValueError, TypeError: If a value cannot be converted to the rule's data type.
+        """
+        if not self.is_expression or self.velocity is not None:
+            return self.comparator(self.converter(value), self.threshold)
+        if rule_result is None:
+            return False
+        return self.comparator(self.converter(value), self.converter(rule_result))
+
+    @classmethod
+    def from_fields(cls, id, data_point, is_expression, conditional, data_type,
+                    threshold, name, description, expression=None, shadow=False):
+        """
+        Builds a compiled rule from already typed fields, resolving the
+        comparator, converter and aggregate or velocity spec.
+
+        :raises ValueError: If the conditional or data type cannot be resolved.
+        """
+        comparator = CONDITIONAL_MAP.get(conditional)
+        if comparator is None:
+            raise ValueError(f"Unsupported conditional: {conditional}")
+
+        converter = TYPE_VALIDATION_MAP.get(data_type)
+        if converter is None:
+            raise ValueError(f"Unsupported data type for conversion: {data_type}")
+
+        return cls(
+            id=id,
+            data_point=data_point,
+            is_expression=is_expression,
+            conditional=conditional,
+            data_type=data_type,
+            converter=converter,
+            comparator=comparator,
+            threshold=threshold,
+            name=name,
+            description=description,
+            expression=expression,
+            aggregate=AggregateSpec.parse(expression) if is_expression else None,
+            velocity=VelocitySpec.parse(expression) if is_expression else None,
+            shadow=shadow
+        )
+
+    @classmethod
+    def from_row(cls, rule):
+        """
+        Builds a compiled rule from a `select * from kd_hk_rules` row.
+
+        :param rule: The row as returned by the database.
+        :return: The compiled rule.
+        :raises ValueError: If the conditional, data type or checkValue cannot be resolved.
+        """
+        is_expression = bool(rule[2])
+        # expression rules compare against DataPointDataType, value rules against CheckValueDatatype
+        data_type = rule[12] if is_expression else rule[8]
+
+        threshold = None
+        # velocity rules keep their limit in checkValue like value rules
+        if not is_expression or VelocitySpec.parse(rule[5]) is not None:
+            converter = TYPE_VALIDATION_MAP.get(data_type)
+            if converter is None:
+                raise ValueError(f"Unsupported data type for conversion: {data_type}")
+            try:
+                threshold = converter(rule[4])
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"Invalid checkValue {rule[4]!r} for {data_type}: {e}")
+
+        return cls.from_fields(
+            id=rule[0],
+            data_point=rule[1].lower(),
+            is_expression=is_expression,
+            conditional=rule[3],
+            data_type=data_type,
+            threshold=threshold,
+            name=rule[11],
+            description=rule[9],
+            expression=rule[5] if is_expression else None,
+            shadow=bool(rule[13]) if len(rule) > 13 else False
+        )
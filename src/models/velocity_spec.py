@@ -0,0 +1,78 @@
+import re
+
+from src.models.aggregate_spec import WINDOW_UNITS
+
+VELOCITY_PATTERN = re.compile(
+    r"^\s*velocity\s+(count|sum)\s*\(\s*(distinct\s+)?(\*|\w+)\s*\)\s+over\s+(\d+)\s*(second|minute|hour|day)s?\s*$"
+)
+
+
+class VelocitySpec:
+    """
+    A velocity rule: the count, sum or distinct count of a column over each
+    source account's transactions in a sliding time window, compared with the
+    rule's checkValue. Stored as the rule's expression, e.g.
+
+        velocity count(*) over 10 minutes
+        velocity sum(amount) over 10 minutes
+        velocity count(distinct destinationaccountnumber) over 1 hour
+    """
+    __slots__ = ('function', 'column', 'window_seconds', 'expression')
+
+    def __init__(self, function, column, window_seconds, expression):
+        self.function = function
+        self.column = column
+        self.window_seconds = window_seconds
+        self.expression = expression
+
+    @classmethod
+    def parse(cls, expression):
+        """
+        :param expression: The stored kd_hk_rules expression or the setup payload's expression.
+        :return: The spec, or None when the expression is not a velocity expression.
+        """
+        if not expression:
+            return None
+        match = VELOCITY_PATTERN.match(str(expression).lower())
+        if match is None:
+            return None
+        function, distinct, column, amount, unit = match.groups()
+        if distinct:
+            if function != 'count' or column == '*':
+                return None
+            function = 'distinct'
+        elif function == 'sum' and column == '*':
+            return None
+        amount = int(amount)
+        if amount <= 0:
+            return None
+
+        selected = f'distinct {column}' if distinct else column
+        canonical = f"velocity {'count' if distinct else function}({selected}) over {amount} {unit}{'s' if amount > 1 else ''}"
+        return cls(function, None if column == '*' else column, amount * WINDOW_UNITS[unit], canonical)
+
+    def seed_query(self, accounts=1):
+        """
+        :param accounts: Number of source account parameters, followed by the window in seconds.
+        :return: The query reading the accounts' transactions in the window, one row per transaction
+            with its age in seconds by the database clock.
+        """
+        selected = self.column or '1'
+        return (f"select sourceaccountnumber, {selected}, datediff(second, DateTimeCreated, getdate()) "
+                f"from kd_hk_transactions with(nolock) "
+                f"where sourceaccountnumber in ({', '.join('?' * accounts)}) "
+                f"and DateTimeCreated > dateadd(second, -?, getdate())")
+
+    def value_of(self, data):
+        """
+        :return: What the transaction adds to the window (1, the amount or the distinct value),
+            or None when it does not carry the column.
+        """
+        if self.column is None:
+            return 1
+        value = data.get(self.column)
+        if value is None:
+            return None
+        if self.function == 'sum':
+            return float(value)
+        return value if self.function == 'distinct' else 1
@@ -0,0 +1,273 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from src.config import (AGGREGATE_ENGINE_MAX_ACCOUNTS, AGGREGATE_MAX_PENDING, AGGREGATE_PENDING_SECONDS,
+                        AGGREGATE_STATE_TTL_SECONDS)
+
+# kd_hk_transactions insert parameters, in order; aggregate predicates can only name these columns
+TRANSACTION_COLUMNS = ('sourceaccountnumber', 'destinationaccountnumber', 'amount', 'destinationbankcode')
+# accounts per seed query, under SQL Server's 2100 parameter limit
+SEED_CHUNK_SIZE = 2000
+
+
+class AggregateState:
+    """
+    Running aggregate of one rule for one account. Windowed states keep the
+    events in the window plus monotonic deques so min/max stay O(1) amortised.
+    """
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'events', 'min_events', 'max_events')
+
+    def __init__(self, windowed):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.events = deque() if windowed else None
+        self.min_events = deque() if windowed else None
+        self.max_events = deque() if windowed else None
+
+    def add(self, value, timestamp):
+        if value is None:
+            return
+        self.count += 1
+        self.total += value
+        if self.events is None:
+            self.minimum = value if self.minimum is None else min(self.minimum, value)
+            self.maximum = value if self.maximum is None else max(self.maximum, value)
+            return
+
+        self.events.append((timestamp, value))
+        while self.min_events and self.min_events[-1][1] >= value:
+            self.min_events.pop()
+        self.min_events.append((timestamp, value))
+        while self.max_events and self.max_events[-1][1] <= value:
+            self.max_events.pop()
+        self.max_events.append((timestamp, value))
+
+    def expire(self, cutoff):
+        while self.events and self.events[0][0] < cutoff:
+            _, value = self.events.popleft()
+            self.count -= 1
+            self.total -= value
+        while self.min_events and self.min_events[0][0] < cutoff:
+            self.min_events.popleft()
+        while self.max_events and self.max_events[0][0] < cutoff:
+            self.max_events.popleft()
+        if not self.events:
+            # reset so float drift from add/subtract does not accumulate
+            self.total = 0.0
+
+    def result(self, function):
+        if function == 'count':
+            return self.count
+        if self.count == 0:
+            return None
+        if function == 'sum':
+            return self.total
+        if function == 'avg':
+            return self.total / self.count
+        if self.events is None:
+            return self.minimum if function == 'min' else self.maximum
+        return self.min_events[0][1] if function == 'min' else self.max_events[0][1]
+
+
+class AggregateEngine:
+    """
+    In-process incremental aggregates for expression rules, replacing the
+    per-rule AFTER INSERT triggers for the shapes AggregateSpec understands.
+
+    An account's state is seeded from kd_hk_transactions on first use, plus
+    the transactions this process has queued for insert but not committed
+    yet, then updated in O(1) for every transaction this process checks.
+    States are re-seeded after AGGREGATE_STATE_TTL_SECONDS, which bounds how
+    long transactions checked by other workers go unseen, and the least
+    recently used accounts are dropped past AGGREGATE_ENGINE_MAX_ACCOUNTS.
+
+    Window cutoffs use the database clock: seeds read each row's age from
+    the database and place it relative to this process's time.time().
+    """
+
+    def __init__(self, max_accounts=AGGREGATE_ENGINE_MAX_ACCOUNTS, ttl=AGGREGATE_STATE_TTL_SECONDS,
+                 max_pending=AGGREGATE_MAX_PENDING, pending_seconds=AGGREGATE_PENDING_SECONDS):
+        self.max_accounts = max_accounts
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.pending_seconds = pending_seconds
+        self._accounts = OrderedDict()  # account -> (loaded_at, {rule_id: AggregateState})
+        self._pending = OrderedDict()  # account -> deque of (queued_at, transaction row) not committed yet
+        self._pending_count = 0
+        self._lock = threading.Lock()
+
+    def queued_rows(self, account, as_of=None):
+        """
+        :param as_of: Leave out transactions queued from this unix time on, None includes all of them.
+        :return: (transaction dict, queued unix time) for the account's transactions not committed yet.
+        """
+        cutoff = time.time() - self.pending_seconds
+        with self._lock:
+            entries = self._pending.get(account, ())
+            return [(dict(zip(TRANSACTION_COLUMNS, row)), queued_at) for queued_at, row in entries
+                    if queued_at >= cutoff and (as_of is None or queued_at < as_of)]
+
+    def _seed_many(self, db, spec, accounts, as_of):
+        """
+        :param accounts: Up to SEED_CHUNK_SIZE source accounts, as strings.
+        :param as_of: Leave out queued transactions from this unix time on, None includes all of them.
+        :return: {account: AggregateState}
+        """
+        windowed = spec.window_column is not None
+        states = {account: AggregateState(windowed) for account in accounts}
+        rows = db.fetch_records(spec.seed_query(len(accounts)), tuple(accounts), strict=True)
+        now = time.time()
+        events = {account: [] for account in accounts}
+        for row in rows:
+            account = str(row[0])
+            if account not in states:
+                continue
+            if windowed:
+                events[account].append((now - float(row[2]), float(row[1]) if row[1] is not None else None))
+            elif row[1]:
+                state = states[account]
+                state.count = row[1]
+                state.total = float(row[2]) if row[2] is not None else 0.0
+                state.minimum = float(row[3]) if row[3] is not None else None
+                state.maximum = float(row[4]) if row[4] is not None else None
+
+        for account, state in states.items():
+            for data, queued_at in self.queued_rows(account, as_of):
+                if spec.matches(data):
+                    try:
+                        events[account].append((queued_at, spec.value_of(data)))
+                    except (ValueError, TypeError):
+                        continue
+            # windowed states expire from the oldest event, so events go in by time
+            for timestamp, value in sorted(events[account], key=lambda event: event[0]):
+                state.add(value, timestamp)
+        return states
+
+    def _states(self, account):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._accounts.get(account)
+            if entry is None or now - entry[0] >= self.ttl:
+                entry = (now, {})
+                self._accounts[account] = entry
+            self._accounts.move_to_end(account)
+            while len(self._accounts) > self.max_accounts:
+                self._accounts.popitem(last=False)
+            return entry[1]
+
+    def value(self, db, rule, account, as_of=None):
+        """
+        :param as_of: Unix time the transaction was checked at, when it may already be queued for insert.
+        :return: The rule's current aggregate for the account, None when no rows match.
+        """
+        spec = rule.aggregate
+        account = str(account)
+        states = self._states(account)
+        state = states.get(rule.id)
+        if state is None:
+            state = self._seed_many(db, spec, [account], as_of)[account]
+            with self._lock:
+                state = states.setdefault(rule.id, state)
+        with self._lock:
+            if spec.window_column is not None:
+                state.expire(time.time() - spec.window_seconds)
+            return state.result(spec.function)
+
+    def missing(self, rules, account):
+        """
+        :return: The aggregate rules among rules that have no state for the account yet.
+        """
+        with self._lock:
+            entry = self._accounts.get(str(account))
+            states = entry[1] if entry is not None and time.monotonic() - entry[0] < self.ttl else {}
+            return [rule for rule in rules if rule.aggregate is not None and rule.id not in states]
+
+    def prime(self, db, rule, account):
+        # seeds the rule's state for the account so value() does not have to query
+        self.prime_many(db, [rule], [account])
+
+    def prime_many(self, db, rules, accounts):
+        """
+        Seeds every aggregate rule's state for every account that has none,
+        with one query per rule per SEED_CHUNK_SIZE accounts.
+        """
+        accounts = list(dict.fromkeys(str(account) for account in accounts))
+        for rule in rules:
+            if rule.aggregate is None:
+                continue
+            unseeded = [account for account in accounts if rule.id not in self._states(account)]
+            for start in range(0, len(unseeded), SEED_CHUNK_SIZE):
+                seeded = self._seed_many(db, rule.aggregate, unseeded[start:start + SEED_CHUNK_SIZE], None)
+                for account, state in seeded.items():
+                    states = self._states(account)
+                    with self._lock:
+                        states.setdefault(rule.id, state)
+
+    def observe(self, active_rules, data):
+        account = str(data['sourceaccountnumber'])
+        with self._lock:
+            entry = self._accounts.get(account)
+            if entry is None:
+                # not seeded yet; the seed will find this row in the database or among the queued ones
+                return
+            states = entry[1]
+            now = time.time()
+            for rule in active_rules:
+                state = states.get(rule.id)
+                if state is None or rule.aggregate is None or not rule.aggregate.matches(data):
+                    continue
+                try:
+                    state.add(rule.aggregate.value_of(data), now)
+                except (ValueError, TypeError):
+                    continue
+
+    def queued(self, rows):
+        """
+        Records transactions handed to the write-behind queue, so seeds made
+        before they are committed still count them.
+
+        :param rows: kd_hk_transactions insert parameter tuples.
+        """
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                self._pending.setdefault(str(row[0]), deque()).append((now, tuple(row)))
+                self._pending_count += 1
+            while self._pending_count > self.max_pending:
+                account, entries = next(iter(self._pending.items()))
+                entries.popleft()
+                self._pending_count -= 1
+                if not entries:
+                    del self._pending[account]
+
+    def committed(self, rows):
+        # write-behind listener for kd_hk_transactions inserts; the seed query finds these rows from now on
+        with self._lock:
+            for row in rows:
+                account = str(row[0])
+                entries = self._pending.get(account)
+                if not entries:
+                    continue
+                row = tuple(row)
+                for index, (_, queued_row) in enumerate(entries):
+                    if queued_row == row:
+                        del entries[index]
+                        self._pending_count -= 1
+                        break
+                if not entries:
+                    del self._pending[account]
+
+    def pending(self):
+        return self._pending_count
+
+    def clear(self):
+        with self._lock:
+            self._accounts.clear()
+            self._pending.clear()
+            self._pending_count = 0
+
+
+aggregate_engine = AggregateEngine()
@@ -1,21 +1,55 @@
+import asyncio
 from datetime import datetime
 import json
 from typing import List
 from flask import g
+from src.config import (ANOMALY_BATCH_CHUNK_SIZE, ANOMALY_BATCH_MAX_SIZE, ANOMALY_SCORE_THRESHOLD,
+                        ANOMALY_SCORING_ENABLED)
 from src.dto.response_dto import ResponseDto
 from src.infra.db_repo import DatabaseManager
-from concurrent.futures import ThreadPoolExecutor
+from src.infra.metrics import registry
+from src.infra.write_behind import WriteBehindQueue
+from src.services.anomaly_scorer import anomaly_scorer
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-executor = ThreadPoolExecutor(max_workers=1)
+ANOMALY_INSERT_QUERY = """
+    insert into kd_hk_anomalies (user_id, alert_type, timestamp, risk_score)
+    values(?, ?, ?, ?)
+"""
+
+ANOMALY_KEYS = ['user_id', 'alert_type', 'timestamp', 'risk_score']
+
+anomalies_detected = registry.counter(
+    'hawkeye_anomalies_detected_total', 'Transactions scored at or above ANOMALY_SCORE_THRESHOLD.', ('alert_type',))
 
 
 class AnomalyEngine:
     def __init__(self):
         self.db: DatabaseManager = g.db_manager
+        self.write_behind: WriteBehindQueue = g.write_behind
+
+    def score_transaction(self, data: dict):
+        """
+        Scores a checked transaction against its source account's history and
+        queues a kd_hk_anomalies row when the score reaches ANOMALY_SCORE_THRESHOLD.
+
+        :param data: The transaction with lowercased keys.
+        :return: The AnomalyScore, or None when scoring is disabled or the amount is not a number.
+        """
+        if not ANOMALY_SCORING_ENABLED:
+            return None
+        try:
+            amount = float(data['amount'])
+        except (KeyError, ValueError, TypeError):
+            return None
+        score = anomaly_scorer.score(data['sourceaccountnumber'], amount, data.get('destinationaccountnumber'))
+        if score.score >= ANOMALY_SCORE_THRESHOLD:
+            anomalies_detected.inc(score.alert_type)
+            self.write_behind.put(ANOMALY_INSERT_QUERY, (str(data['sourceaccountnumber']), score.alert_type,
+                                                         datetime.now(), round(score.score, 4)))
+        return score
     
     def save_record(self, dataRequest:dict):
         try:
@@ -24,15 +58,148 @@ class AnomalyEngine:
             timestamp = dataRequest['timestamp']
             risk_score = dataRequest['risk_score']
 
-            insert_query = """
-                insert into kd_hk_anomalies (user_id, alert_type, timestamp, risk_score)
-                values(?, ?, ?, ?)
-            """
-
-            self.db.single_inserts(insert_query, (userId, alert_type, timestamp, risk_score))
+            self.db.single_inserts(ANOMALY_INSERT_QUERY, (userId, alert_type, timestamp, risk_score))
 
             return ResponseDto(True, 'success', None, 200)
         
         except Exception as e:
             logger.error(f"Error while trying to save: {e}")
-            return ResponseDto(False, 'An error occurred while fetching save record', None, 500)
\ No newline at end of file
+            return ResponseDto(False, 'An error occurred while fetching save record', None, 500)
+
+    async def save_record_async(self, dataRequest:dict):
+        try:
+            row = (dataRequest['user_id'], dataRequest['alert_type'], dataRequest['timestamp'], dataRequest['risk_score'])
+            await self.db.single_inserts_async(ANOMALY_INSERT_QUERY, row)
+            return ResponseDto(True, 'success', None, 200)
+        except Exception as e:
+            logger.error(f"Error while trying to save: {e}")
+            return ResponseDto(False, 'An error occurred while fetching save record', None, 500)
+
+    def __validate_record(self, record):
+        if not isinstance(record, dict):
+            return None, 'Invalid record: expected an object'
+        missing = [key for key in ANOMALY_KEYS if record.get(key) is None]
+        if missing:
+            return None, f"Invalid record: missing {', '.join(missing)}"
+        try:
+            risk_score = float(record['risk_score'])
+        except (ValueError, TypeError):
+            return None, 'Invalid record: risk_score must be a number'
+        try:
+            timestamp = datetime.fromisoformat(str(record['timestamp']))
+        except ValueError:
+            return None, 'Invalid record: timestamp must be an ISO 8601 date and time'
+        if timestamp.tzinfo is not None:
+            # kd_hk_anomalies holds local times, as score_transaction writes them
+            timestamp = timestamp.astimezone().replace(tzinfo=None)
+        return (record['user_id'], record['alert_type'], timestamp, risk_score), None
+
+    def __prepare_records(self, records):
+        """
+        :return: (error, statuses, valid) where error is a ResponseDto when the whole batch is rejected
+            and valid holds (index, row) for every record that passed validation.
+        """
+        if not isinstance(records, list) or not records:
+            return ResponseDto(False, 'Invalid request: expected a non-empty list of records', None, 400), None, None
+        if len(records) > ANOMALY_BATCH_MAX_SIZE:
+            return ResponseDto(False, f'Invalid request: batch is limited to {ANOMALY_BATCH_MAX_SIZE} records', None, 400), None, None
+
+        statuses = []
+        valid = []
+        for index, record in enumerate(records):
+            row, error = self.__validate_record(record) if record is not None else (None, 'Invalid record: not valid JSON')
+            if error:
+                statuses.append({'index': index, 'isSuccessful': False, 'message': error})
+            else:
+                statuses.append({'index': index, 'isSuccessful': True, 'message': 'success'})
+                valid.append((index, row))
+        return None, statuses, valid
+
+    def __chunks(self, valid):
+        return [valid[start:start + ANOMALY_BATCH_CHUNK_SIZE] for start in range(0, len(valid), ANOMALY_BATCH_CHUNK_SIZE)]
+
+    def __insert_rows(self, chunk):
+        """
+        Inserts a chunk row by row after its executemany failed, so one bad
+        record does not fail the others.
+
+        :return: The indexes of the records that could not be saved.
+        """
+        failed = []
+        for position, (index, row) in enumerate(chunk):
+            result = self.db.single_inserts(ANOMALY_INSERT_QUERY, row)
+            if result == -1:
+                # no connection; the rest would wait for one just the same
+                failed.extend(index for index, _ in chunk[position:])
+                break
+            if result != 0:
+                failed.append(index)
+        return failed
+
+    async def __insert_rows_async(self, chunk):
+        return await self.db.run_in_executor(self.__insert_rows, chunk)
+
+    def __batch_result(self, records, statuses, failed):
+        for index in failed:
+            statuses[index] = {'index': index, 'isSuccessful': False, 'message': 'Failed to save record'}
+
+        saved = sum(1 for status in statuses if status['isSuccessful'])
+        return ResponseDto(True, f'{saved} of {len(records)} records saved', statuses, 200)
+
+    def save_records(self, records: list):
+        """
+        Saves many anomalies with one executemany (and one commit) per chunk.
+        A chunk whose executemany fails is retried row by row.
+
+        :param records: Anomaly objects; None marks an entry that could not be parsed.
+        :return: A ResponseDto whose data holds one status per record, in order.
+        """
+        try:
+            error, statuses, valid = self.__prepare_records(records)
+            if error:
+                return error
+            failed = []
+            for chunk in self.__chunks(valid):
+                # anything but 0 means the chunk was rolled back, a duplicate included
+                if self.db.multiple_inserts(ANOMALY_INSERT_QUERY, [row for _, row in chunk]) != 0:
+                    failed.extend(self.__insert_rows(chunk))
+            return self.__batch_result(records, statuses, failed)
+        except Exception as e:
+            logger.error(f"Error while trying to save batch: {e}")
+            return ResponseDto(False, 'An error occurred while saving records', None, 500)
+
+    async def save_records_async(self, records: list):
+        """
+        save_records for async views; the chunks are inserted concurrently,
+        as many at a time as the database executor allows.
+        """
+        try:
+            error, statuses, valid = self.__prepare_records(records)
+            if error:
+                return error
+            chunks = self.__chunks(valid)
+            results = await asyncio.gather(*(self.db.multiple_inserts_async(ANOMALY_INSERT_QUERY, [row for _, row in chunk])
+                                             for chunk in chunks))
+            retried = await asyncio.gather(*(self.__insert_rows_async(chunk)
+                                             for chunk, result in zip(chunks, results) if result != 0))
+            return self.__batch_result(records, statuses, [index for failed in retried for index in failed])
+        except Exception as e:
+            logger.error(f"Error while trying to save batch: {e}")
+            return ResponseDto(False, 'An error occurred while saving records', None, 500)
+
+    def __parse_ndjson(self, body: str):
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                records.append(None)
+        return records
+
+    def save_records_ndjson(self, body: str):
+        return self.save_records(self.__parse_ndjson(body))
+
+    async def save_records_ndjson_async(self, body: str):
+        return await self.save_records_async(self.__parse_ndjson(body))
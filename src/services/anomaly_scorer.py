@@ -0,0 +1,183 @@
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from src.config import (ANOMALY_AMOUNT_STDDEV_FLOOR, ANOMALY_EWMA_ALPHA, ANOMALY_INTERVAL_STDDEV_FLOOR,
+                        ANOMALY_MIN_OBSERVATIONS, ANOMALY_NEW_COUNTERPARTY_WEIGHT, ANOMALY_RECENT_COUNTERPARTIES,
+                        ANOMALY_RELATIVE_STDDEV_FLOOR, ANOMALY_SCORER_MAX_ACCOUNTS)
+
+
+class AnomalyScore:
+    __slots__ = ('score', 'alert_type', 'amount_z', 'interval_z', 'new_counterparty')
+
+    def __init__(self, score, alert_type, amount_z, interval_z, new_counterparty):
+        self.score = score
+        self.alert_type = alert_type
+        self.amount_z = amount_z
+        self.interval_z = interval_z
+        self.new_counterparty = new_counterparty
+
+    def to_dict(self):
+        return {
+            'score': round(self.score, 3),
+            'alertType': self.alert_type,
+            'amountZ': round(self.amount_z, 3),
+            'intervalZ': round(self.interval_z, 3),
+            'newCounterparty': self.new_counterparty
+        }
+
+
+class StreamingAnomalyScorer:
+    """
+    O(1) per transaction anomaly score per source account.
+
+    Each account owns a slot in typed arrays holding an EWMA mean and
+    variance of the amount and of the seconds between transactions, the
+    observation count, the last time seen and a ring of hashes of its most
+    recent counterparties. A transaction is scored against the state before
+    it, then folded in. The score is the larger of the amount's z-score and
+    the inter-arrival z-score (only faster than usual counts), plus a weight
+    for an unseen destination account.
+
+    The standard deviation a z-score divides by is at least relative_floor
+    times the mean and at least amount_floor (currency units) or
+    interval_floor (seconds), so an account that always sends the same
+    amount at the same pace does not score a cent or a second of difference
+    as a spike.
+
+    At most max_accounts slots exist; the least recently seen account's slot
+    is reused for a new one, so memory stays fixed however many accounts
+    transact (about 80 bytes of arrays plus the index entry per account).
+
+    The state is neither shared nor persisted: each worker process learns
+    from the transactions it serves, and starts cold after a restart or
+    deploy. Until an account has min_observations transactions on a worker
+    it scores 0 there, so an account spread over N workers needs about N
+    times as many transactions before it is scored, and anomalies during
+    that warm-up are missed.
+    """
+
+    def __init__(self, max_accounts=ANOMALY_SCORER_MAX_ACCOUNTS, alpha=ANOMALY_EWMA_ALPHA,
+                 min_observations=ANOMALY_MIN_OBSERVATIONS, counterparties=ANOMALY_RECENT_COUNTERPARTIES,
+                 new_counterparty_weight=ANOMALY_NEW_COUNTERPARTY_WEIGHT, relative_floor=ANOMALY_RELATIVE_STDDEV_FLOOR,
+                 amount_floor=ANOMALY_AMOUNT_STDDEV_FLOOR, interval_floor=ANOMALY_INTERVAL_STDDEV_FLOOR):
+        self.max_accounts = max_accounts
+        self.alpha = alpha
+        self.min_observations = min_observations
+        self.counterparties = counterparties
+        self.new_counterparty_weight = new_counterparty_weight
+        self.relative_floor = relative_floor
+        self.amount_floor = amount_floor
+        self.interval_floor = interval_floor
+
+        self._slots = OrderedDict()  # account -> slot, least recently seen first
+        # slot columns, grown up to max_accounts
+        self._count = array('I')
+        self._last_seen = array('d')
+        self._amount_mean = array('d')
+        self._amount_var = array('d')
+        self._interval_mean = array('d')
+        self._interval_var = array('d')
+        self._ring_position = array('B')
+        self._recent = array('q')  # `counterparties` hashes per slot
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _slot(self, account):
+        slot = self._slots.get(account)
+        if slot is not None:
+            self._slots.move_to_end(account)
+            return slot
+        if len(self._slots) >= self.max_accounts:
+            _, slot = self._slots.popitem(last=False)
+            self._count[slot] = 0
+            self._ring_position[slot] = 0
+            start = slot * self.counterparties
+            for index in range(start, start + self.counterparties):
+                self._recent[index] = 0
+        else:
+            slot = len(self._count)
+            for column in (self._count, self._ring_position):
+                column.append(0)
+            for column in (self._last_seen, self._amount_mean, self._amount_var,
+                           self._interval_mean, self._interval_var):
+                column.append(0.0)
+            self._recent.extend([0] * self.counterparties)
+        self._slots[account] = slot
+        return slot
+
+    def _z(self, value, mean, variance, floor):
+        stddev = max(math.sqrt(variance), self.relative_floor * abs(mean), floor)
+        return (value - mean) / stddev if stddev > 0 else 0.0
+
+    def _update(self, mean_column, var_column, slot, value, first):
+        if first:
+            mean_column[slot] = value
+            var_column[slot] = 0.0
+            return
+        delta = value - mean_column[slot]
+        mean_column[slot] += self.alpha * delta
+        var_column[slot] = (1 - self.alpha) * (var_column[slot] + self.alpha * delta * delta)
+
+    def score(self, account, amount, counterparty=None, now=None):
+        """
+        Scores a transaction and adds it to the account's state.
+
+        :param amount: The transaction amount.
+        :param counterparty: The destination account, for the unseen counterparty component.
+        :param now: Unix time of the transaction, defaults to the current time.
+        :return: An AnomalyScore; its score is 0 until the account has min_observations transactions.
+        """
+        now = time.time() if now is None else now
+        amount = float(amount)
+        # 0 marks an empty ring entry
+        counterparty_hash = (hash(str(counterparty)) or 1) if counterparty is not None else None
+        with self._lock:
+            slot = self._slot(str(account))
+            count = self._count[slot]
+            interval = now - self._last_seen[slot] if count else None
+            start = slot * self.counterparties
+            recent = self._recent[start:start + self.counterparties]
+
+            amount_z = interval_z = 0.0
+            new_counterparty = False
+            if count >= self.min_observations:
+                amount_z = self._z(amount, self._amount_mean[slot], self._amount_var[slot], self.amount_floor)
+                if count > self.min_observations:
+                    # faster than the account's usual pace scores positive
+                    interval_z = -self._z(interval, self._interval_mean[slot], self._interval_var[slot],
+                                          self.interval_floor)
+                new_counterparty = counterparty_hash is not None and counterparty_hash not in recent
+
+            self._update(self._amount_mean, self._amount_var, slot, amount, count == 0)
+            if interval is not None:
+                self._update(self._interval_mean, self._interval_var, slot, interval, count == 1)
+            if counterparty_hash is not None and counterparty_hash not in recent:
+                position = self._ring_position[slot]
+                self._recent[start + position] = counterparty_hash
+                self._ring_position[slot] = (position + 1) % self.counterparties
+            self._count[slot] = min(count + 1, 0xFFFFFFFF)
+            self._last_seen[slot] = now
+
+        score = max(amount_z, interval_z, 0.0)
+        if score == 0.0:
+            alert_type = 'new_counterparty' if new_counterparty else None
+        else:
+            alert_type = 'amount_spike' if amount_z >= interval_z else 'velocity_spike'
+        if new_counterparty:
+            score += self.new_counterparty_weight
+        return AnomalyScore(score, alert_type, amount_z, interval_z, new_counterparty)
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+            for column in (self._count, self._last_seen, self._amount_mean, self._amount_var,
+                           self._interval_mean, self._interval_var, self._ring_position, self._recent):
+                del column[:]
+
+
+anomaly_scorer = StreamingAnomalyScorer()
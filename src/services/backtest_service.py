@@ -0,0 +1,324 @@
+import multiprocessing
+import os
+import queue
+import time
+import zlib
+from datetime import datetime
+
+from src.config import BACKTEST_CHUNK_SIZE, BACKTEST_QUEUE_DEPTH
+from src.models.compiled_rule import CompiledRule
+from src.models.velocity_spec import VelocitySpec
+from src.services.aggregate_engine import AggregateState
+from src.services.schema_cache import schema_cache
+from src.services.velocity_engine import VelocityEngine
+from src.utils import TYPE_VALIDATION_MAP
+
+BUCKET_FORMATS = {'hour': '%Y-%m-%dT%H:00', 'day': '%Y-%m-%d', 'month': '%Y-%m'}
+
+# the transaction columns every replay reads, in this order, before the rules' own columns
+BASE_COLUMNS = ('id', 'datetimecreated', 'sourceaccountnumber')
+
+RULE_FIELDS = ('id', 'data_point', 'is_expression', 'conditional', 'data_type',
+               'threshold', 'name', 'description', 'expression')
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+class BacktestTally:
+    """
+    Hit counts of one replay partition: per rule totals, per time bucket
+    counts and the first `sample_size` matches. Partitions are merged with add().
+    """
+    __slots__ = ('rule_ids', 'bucket_format', 'sample_size', 'transactions', 'hits', 'buckets', 'samples', 'errors')
+
+    def __init__(self, rule_ids, bucket_format, sample_size):
+        self.rule_ids = list(rule_ids)
+        self.bucket_format = bucket_format
+        self.sample_size = sample_size
+        self.transactions = 0
+        self.hits = {rule_id: 0 for rule_id in self.rule_ids}
+        self.buckets = {}  # bucket -> [transactions, hits of rule 0, hits of rule 1, ...]
+        self.samples = {rule_id: [] for rule_id in self.rule_ids}
+        self.errors = {rule_id: 0 for rule_id in self.rule_ids}
+
+    def bucket(self, created):
+        if isinstance(created, datetime):
+            return created.strftime(self.bucket_format)
+        return str(created)[:len(datetime(2000, 1, 1).strftime(self.bucket_format))]
+
+    def add(self, other):
+        self.transactions += other.transactions
+        for rule_id in self.rule_ids:
+            self.hits[rule_id] += other.hits[rule_id]
+            self.errors[rule_id] += other.errors[rule_id]
+            room = self.sample_size - len(self.samples[rule_id])
+            self.samples[rule_id].extend(other.samples[rule_id][:max(0, room)])
+        for bucket, counts in other.buckets.items():
+            current = self.buckets.setdefault(bucket, [0] * len(counts))
+            for index, count in enumerate(counts):
+                current[index] += count
+
+
+def _replay_partition(rule_fields, columns, bucket_format, sample_size, tasks, results):
+    """
+    Worker process: evaluates the chunks of one account partition in Id order
+    and puts its BacktestTally on `results` once it reads the None sentinel.
+    Aggregate rules keep per account state, which is why an account's rows
+    always go to the same worker.
+    """
+    rules = [CompiledRule.from_fields(**fields) for fields in rule_fields]
+    tally = BacktestTally([rule.id for rule in rules], bucket_format, sample_size)
+    states = {}  # (rule id, account) -> AggregateState
+    velocities = VelocityEngine()
+
+    while True:
+        rows = tasks.get()
+        if rows is None:
+            break
+        for row in rows:
+            data = dict(zip(columns, row))
+            account = str(data['sourceaccountnumber'])
+            now = _timestamp(data['datetimecreated'])
+            counts = tally.buckets.setdefault(tally.bucket(data['datetimecreated']), [0] * (len(rules) + 1))
+            counts[0] += 1
+            tally.transactions += 1
+
+            for index, rule in enumerate(rules, start=1):
+                rule_result = None
+                spec = rule.aggregate
+                if spec is not None:
+                    state = states.get((rule.id, account))
+                    if state is None:
+                        state = states[(rule.id, account)] = AggregateState(spec.window_column is not None)
+                    if spec.window_column is not None and now is not None:
+                        state.expire(now - spec.window_seconds)
+                    # like the live engine, a transaction is checked against the aggregate before it is added
+                    rule_result = state.result(spec.function)
+                try:
+                    if rule.velocity is not None:
+                        # windows slide on DateTimeCreated, as they did when the transactions arrived
+                        faulted = rule.faulted_by(velocities.observe(rule, data, now if now is not None else 0.0))
+                    else:
+                        faulted = rule.faulted_by(data[rule.data_point], rule_result)
+                except (ValueError, TypeError):
+                    tally.errors[rule.id] += 1
+                    faulted = False
+                if faulted:
+                    tally.hits[rule.id] += 1
+                    counts[index] += 1
+                    if len(tally.samples[rule.id]) < sample_size:
+                        tally.samples[rule.id].append(data)
+                if spec is not None and spec.matches(data):
+                    try:
+                        timestamp = _timestamp(data[spec.window_column]) if spec.window_column else now
+                        state.add(spec.value_of(data), timestamp if timestamp is not None else 0.0)
+                    except (ValueError, TypeError, KeyError):
+                        pass
+    results.put(tally)
+
+
+class BacktestService:
+    """
+    Replays kd_hk_transactions through rules without writing kd_hk_report.
+
+    Rows are streamed with fetchmany and split by source account across a
+    pool of worker processes, each fed through a bounded queue, so memory
+    stays flat however many rows are replayed. Value rules, velocity rules
+    and the expression rules the aggregate engine understands are replayed;
+    rules whose expression needs the database are reported as skipped.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __columns(self):
+        schema = schema_cache.get(self.db, 'kd_hk_transactions')
+        if not schema:
+            raise ValueError('Could not read the kd_hk_transactions columns')
+        return {name.lower(): data_type for name, data_type in schema.columns.items()}
+
+    def __from_definition(self, index, definition, columns):
+        # the same payload as /api/rule/setup, without saving the rule
+        data_point = str(definition.get('dataPoint', '')).lower()
+        if data_point not in columns:
+            raise ValueError(f'dataPoint {data_point!r} is not a kd_hk_transactions column')
+        expression = None
+        threshold = None
+        data_type = columns[data_point]
+        velocity = VelocitySpec.parse(definition.get('expression')) if definition.get('isExpression') else None
+        if velocity is not None:
+            expression, data_type = velocity.expression, 'float'
+            try:
+                threshold = float(definition.get('checkValue'))
+            except (ValueError, TypeError):
+                raise ValueError(f"checkValue {definition.get('checkValue')!r} is not a number")
+        elif definition.get('isExpression'):
+            expression = str(definition.get('expression', '')).lower().replace('transactions', 'kd_hk_transactions')
+            expression += ' and sourceaccountnumber=?'
+        else:
+            converter = TYPE_VALIDATION_MAP.get(columns[data_point])
+            if converter is None:
+                raise ValueError(f"Unsupported data type for conversion: {columns[data_point]}")
+            threshold = converter(definition.get('checkValue'))
+        return CompiledRule.from_fields(
+            id=-index,
+            data_point=data_point,
+            is_expression=expression is not None,
+            conditional=definition.get('conditional'),
+            data_type=data_type,
+            threshold=threshold,
+            name=definition.get('name') or f'definition {index}',
+            description=definition.get('description') or '',
+            expression=expression
+        )
+
+    def resolve_rules(self, rule_ids=(), definitions=()):
+        """
+        :param rule_ids: kd_hk_rules ids, active or not.
+        :param definitions: Rules that are not saved yet, as /api/rule/setup payloads; they get negative ids.
+        :return: (replayable compiled rules, [{id, name, reason}] of the skipped ones)
+        :raises ValueError: If a rule id does not exist or a definition is invalid.
+        """
+        columns = self.__columns()
+        rules = []
+        for rule_id in rule_ids:
+            row = self.db.fetch_record("select * from kd_hk_rules with(nolock) where Id = ?", (rule_id,))
+            if row is None:
+                raise ValueError(f'Rule {rule_id} does not exist')
+            rules.append(CompiledRule.from_row(row))
+        rules.extend(self.__from_definition(index, definition, columns)
+                     for index, definition in enumerate(definitions, start=1))
+
+        replayable, skipped = [], []
+        for rule in rules:
+            if rule.reads_expression_results:
+                skipped.append({'id': rule.id, 'name': rule.name,
+                                'reason': 'expression needs the database to evaluate'})
+            elif rule.data_point not in columns:
+                skipped.append({'id': rule.id, 'name': rule.name, 'reason': 'dataPoint is not a column'})
+            else:
+                replayable.append(rule)
+        return replayable, skipped
+
+    def __read_columns(self, rules, columns):
+        needed = list(BASE_COLUMNS)
+        for rule in rules:
+            spec = rule.aggregate
+            names = [rule.data_point]
+            if spec is not None:
+                names.extend([spec.column, spec.window_column, *(name for name, _, _, _ in spec.predicates)])
+            if rule.velocity is not None:
+                names.append(rule.velocity.column)
+            needed.extend(name for name in names if name and name in columns and name not in needed)
+        return needed
+
+    def __send(self, partition, rows):
+        # a bounded queue blocks the reader while the worker catches up, unless the worker died
+        process, tasks, _ = partition
+        while True:
+            try:
+                tasks.put(rows, timeout=1)
+                return
+            except queue.Full:
+                if not process.is_alive():
+                    raise RuntimeError(f'Backtest worker exited with code {process.exitcode}')
+
+    def __receive(self, results, partitions):
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if any(not process.is_alive() and process.exitcode != 0 for process, _, _ in partitions):
+                    raise RuntimeError('A backtest worker exited before reporting its results')
+
+    def run(self, rule_ids=(), definitions=(), since=None, until=None, workers=None,
+            chunk_size=BACKTEST_CHUNK_SIZE, bucket='day', sample_size=10):
+        """
+        :param since: Only transactions created at or after this datetime.
+        :param until: Only transactions created before this datetime.
+        :param workers: Worker processes, defaults to the number of cores.
+        :param bucket: 'hour', 'day' or 'month', the resolution of the hit rate over time.
+        :return: Per rule hits, hit rate, hit rate per bucket and sample matches, plus the skipped rules.
+        """
+        if bucket not in BUCKET_FORMATS:
+            raise ValueError(f'Unsupported bucket: {bucket}')
+        started = time.perf_counter()
+        columns = self.__columns()
+        rules, skipped = self.resolve_rules(rule_ids, definitions)
+        result = {'rules': [], 'skipped': skipped, 'transactions': 0, 'seconds': 0.0}
+        if not rules:
+            return result
+
+        read_columns = self.__read_columns(rules, columns)
+        conditions, params = [], []
+        if since is not None:
+            conditions.append('DateTimeCreated >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('DateTimeCreated < ?')
+            params.append(until)
+        query = f"select {', '.join(read_columns)} from kd_hk_transactions with(nolock)"
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        query += ' order by Id'
+
+        workers = max(1, workers or os.cpu_count() or 1)
+        rule_fields = [{name: getattr(rule, name) for name in RULE_FIELDS} for rule in rules]
+        # spawn: the workers only need the rules and the queues, and a forked copy would inherit
+        # the pool's connections and the threads of whatever process runs the backtest
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        partitions = []
+        for _ in range(workers):
+            tasks = context.Queue(maxsize=BACKTEST_QUEUE_DEPTH)
+            process = context.Process(target=_replay_partition, daemon=True,
+                                      args=(rule_fields, read_columns, BUCKET_FORMATS[bucket], sample_size,
+                                            tasks, results))
+            process.start()
+            partitions.append((process, tasks, []))
+
+        try:
+            for row in self.db.stream_records(query, tuple(params), chunk_size):
+                partition = partitions[zlib.crc32(str(row[2]).encode()) % workers]
+                partition[2].append(tuple(row))
+                if len(partition[2]) >= chunk_size:
+                    self.__send(partition, partition[2][:])
+                    partition[2].clear()
+            for partition in partitions:
+                if partition[2]:
+                    self.__send(partition, partition[2][:])
+                self.__send(partition, None)
+            tally = BacktestTally([rule.id for rule in rules], BUCKET_FORMATS[bucket], sample_size)
+            for _ in partitions:
+                tally.add(self.__receive(results, partitions))
+        finally:
+            for process, _, _ in partitions:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+
+        result['transactions'] = tally.transactions
+        for index, rule in enumerate(rules, start=1):
+            hits = tally.hits[rule.id]
+            result['rules'].append({
+                'id': rule.id,
+                'name': rule.name,
+                'hits': hits,
+                'hitRate': hits / tally.transactions if tally.transactions else 0.0,
+                'errors': tally.errors[rule.id],
+                'hitRateOverTime': [
+                    {'bucket': key, 'transactions': counts[0], 'hits': counts[index],
+                     'hitRate': counts[index] / counts[0]}
+                    for key, counts in sorted(tally.buckets.items())
+                ],
+                'samples': tally.samples[rule.id]
+            })
+        result['seconds'] = round(time.perf_counter() - started, 3)
+        return result
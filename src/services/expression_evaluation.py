@@ -0,0 +1,119 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+from src.config import RULE_CHECK_DEADLINE_MS
+from src.services.aggregate_engine import aggregate_engine
+from src.services.expression_result_cache import expression_result_cache
+from src.services.velocity_engine import velocity_engine
+
+logger = logging.getLogger(__name__)
+
+
+class ExpressionEvaluation:
+    """
+    The database lookups behind one rule check's expression rules, fanned out
+    on the database executor and bounded by a deadline.
+
+    Only cache misses become lookups: one kd_hk_expression_result read shared
+    by the table rules, and one seed per aggregate-engine rule or velocity
+    window that is missing or past its TTL. Rules whose
+    lookup has not finished by the deadline are left unevaluated and reported
+    in `unfinished`; a lookup that is already running completes in the
+    background and warms the caches for the next check.
+    """
+    __slots__ = ('started', 'deadline', 'results', 'unfinished', 'timings', 'value_rules_ms',
+                 '_lookups', '_lookup_ms', '_table_lookup')
+
+    def __init__(self, db, active_rules, account, deadline_ms=RULE_CHECK_DEADLINE_MS):
+        self.started = time.perf_counter()
+        self.deadline = deadline_ms / 1000 if deadline_ms > 0 else None
+        self.results = {}
+        self.unfinished = set()
+        self.timings = {}  # rule id -> lookup plus evaluation milliseconds
+        self.value_rules_ms = 0.0
+        self._lookups = {}  # future -> ids of the rules waiting on it
+        self._lookup_ms = {}
+        self._table_lookup = None
+
+        remaining = active_rules.value_matrix.remaining
+        table_rules = [rule.id for rule in remaining if rule.reads_expression_results]
+        if table_rules:
+            results = expression_result_cache.peek(account)
+            if results is None:
+                self._table_lookup = self._submit(db, table_rules, expression_result_cache.load, db, account)
+            else:
+                self.results = results
+        for rule in aggregate_engine.missing(remaining, account):
+            self._submit(db, [rule.id], aggregate_engine.prime, db, rule, account)
+        for rule in velocity_engine.missing(remaining, account):
+            self._submit(db, [rule.id], velocity_engine.prime, db, rule, account)
+
+    def _submit(self, db, rule_ids, func, *args):
+        def lookup():
+            try:
+                return func(*args)
+            finally:
+                elapsed = (time.perf_counter() - self.started) * 1000
+                for rule_id in rule_ids:
+                    self._lookup_ms[rule_id] = elapsed
+
+        future = db.submit(lookup)
+        self._lookups[future] = rule_ids
+        return future
+
+    def _remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - (time.perf_counter() - self.started))
+
+    def _collect(self, done, pending):
+        for future in pending:
+            future.cancel()
+            self.unfinished.update(self._lookups[future])
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Expression rule lookup failed: {e}")
+                self.unfinished.update(self._lookups[future])
+                continue
+            if future is self._table_lookup:
+                self.results = result
+
+    def wait(self):
+        """
+        Blocks until every lookup is done or the deadline passes.
+        """
+        if self._lookups:
+            done, pending = concurrent.futures.wait(self._lookups, timeout=self._remaining())
+            self._collect(done, pending)
+        return self
+
+    async def wait_async(self):
+        if self._lookups:
+            wrapped = {asyncio.wrap_future(future): future for future in self._lookups}
+            done, pending = await asyncio.wait(wrapped, timeout=self._remaining())
+            for future in done:
+                # retrieved here so a failed lookup is not reported again as never retrieved
+                future.exception()
+            self._collect({wrapped[future] for future in done}, {wrapped[future] for future in pending})
+        return self
+
+    def evaluated(self, rule_id, started):
+        """
+        Records a rule's evaluation that began at `started` (perf_counter).
+        """
+        evaluation_ms = (time.perf_counter() - started) * 1000
+        self.timings[rule_id] = self._lookup_ms.get(rule_id, 0.0) + evaluation_ms
+
+    def to_dict(self):
+        return {
+            'complete': not self.unfinished,
+            'deadlineMs': self.deadline * 1000 if self.deadline is not None else None,
+            'elapsedMs': round((time.perf_counter() - self.started) * 1000, 3),
+            'unfinishedRules': sorted(self.unfinished),
+            'valueRulesMs': round(self.value_rules_ms, 3),
+            'expressionRulesMs': {str(rule_id): round(ms, 3) for rule_id, ms in self.timings.items()}
+        }
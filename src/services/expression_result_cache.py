@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+from src.config import EXPRESSION_CACHE_MAX_ACCOUNTS, EXPRESSION_CACHE_TTL_SECONDS
+
+
+class ExpressionResultCache:
+    """
+    Bounded LRU/TTL cache of kd_hk_expression_result rows per source account.
+
+    Each entry maps RuleId to ResultValue for one account. Accounts with no
+    results are cached as an empty dict so they do not go back to the database.
+    Reads are strict: a failed query raises DatabaseError and caches nothing,
+    so it is never mistaken for an account without results.
+    """
+    select_account_query = """
+        select RuleId, ResultValue from kd_hk_expression_result with(nolock)
+        where SourceAccountNumber = ?
+    """
+
+    def __init__(self, max_accounts=EXPRESSION_CACHE_MAX_ACCOUNTS, ttl=EXPRESSION_CACHE_TTL_SECONDS):
+        self.max_accounts = max_accounts
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # account -> (loaded_at, {rule_id: result_value})
+        self._lock = threading.Lock()
+
+    def _lookup(self, account):
+        with self._lock:
+            entry = self._entries.get(account)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(account)
+            self.hits += 1
+            return entry[1]
+
+    def _store(self, account, results):
+        with self._lock:
+            self._entries[account] = (time.monotonic(), results)
+            self._entries.move_to_end(account)
+            while len(self._entries) > self.max_accounts:
+                self._entries.popitem(last=False)
+
+    def peek(self, account):
+        """
+        :return: The cached results of the account, or None when they have to be loaded.
+        """
+        return self._lookup(str(account))
+
+    def load(self, db, account):
+        account = str(account)
+        results = {row[0]: row[1] for row in db.fetch_records(self.select_account_query, (account,), strict=True)}
+        self._store(account, results)
+        return results
+
+    def get(self, db, account):
+        results = self._lookup(str(account))
+        return results if results is not None else self.load(db, account)
+
+    async def get_async(self, db, account):
+        account = str(account)
+        results = self._lookup(account)
+        if results is None:
+            rows = await db.fetch_records_async(self.select_account_query, (account,), strict=True)
+            results = {row[0]: row[1] for row in rows}
+            self._store(account, results)
+        return results
+
+    def get_many(self, db, accounts):
+        """
+        Returns the results of every account, loading all the misses with as
+        few queries as the parameter limit allows.
+
+        :return: {account: {rule_id: result_value}}
+        """
+        found = {}
+        missing = []
+        for account in {str(account) for account in accounts}:
+            results = self._lookup(account)
+            if results is None:
+                missing.append(account)
+            else:
+                found[account] = results
+
+        # SQL Server caps a statement at 2100 parameters
+        for start in range(0, len(missing), 2000):
+            chunk = missing[start:start + 2000]
+            loaded = {account: {} for account in chunk}
+            query = f"""
+                select SourceAccountNumber, RuleId, ResultValue from kd_hk_expression_result with(nolock)
+                where SourceAccountNumber in ({', '.join('?' * len(chunk))})
+            """
+            for row in db.fetch_records(query, tuple(chunk), strict=True):
+                loaded.setdefault(str(row[0]), {})[row[1]] = row[2]
+            for account, results in loaded.items():
+                self._store(account, results)
+            found.update(loaded)
+        return found
+
+    def invalidate(self, account):
+        with self._lock:
+            self._entries.pop(str(account), None)
+
+    def invalidate_transactions(self, rows):
+        # write-behind listener for kd_hk_transactions inserts; the insert trigger has
+        # recomputed the results of these accounts, so drop what we hold for them
+        with self._lock:
+            for row in rows:
+                self._entries.pop(str(row[0]), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+expression_result_cache = ExpressionResultCache()
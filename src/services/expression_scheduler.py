@@ -0,0 +1,267 @@
+import atexit
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from src.infra.metrics import registry
+from src.services.expression_result_cache import expression_result_cache
+from src.services.expression_triggers import (ACCOUNT_PARAMETER_PATTERN, TRIGGER_RULES_QUERY, existing_triggers,
+                                              needs_trigger)
+from src.services.rule_cache import rule_set_cache
+
+logger = logging.getLogger(__name__)
+
+expression_recompute_seconds = registry.histogram(
+    'hawkeye_expression_recompute_seconds', 'Time spent recomputing one rule\'s kd_hk_expression_result rows.',
+    ('rule',))
+expression_recompute_failures = registry.counter(
+    'hawkeye_expression_recompute_failures_total', 'Expression rule recomputations that failed.', ('rule',))
+expression_recompute_skips = registry.counter(
+    'hawkeye_expression_recompute_skips_total',
+    'Expression rule recomputations skipped because another host had already moved the watermark.', ('rule',))
+
+# identity values are handed out before their rows are committed, so a pass only reads up to the
+# last row older than the safety lag; a row committed out of order within the lag is not skipped.
+# top 1 by Id scans back from the newest row, so it only reads the rows inside the lag
+HIGH_WATERMARK_QUERY = """
+    select coalesce((
+        select top 1 Id from kd_hk_transactions with(nolock)
+        where DateTimeCreated <= dateadd(second, -?, getdate())
+        order by Id desc
+    ), 0)
+"""
+
+WATERMARKS_QUERY = """
+    select RuleId, LastId, datediff(second, LastRunAt, getdate()) from kd_hk_expression_watermark
+"""
+
+# first run of a rule: resume after the transactions its stored results already cover
+LOW_WATERMARK_QUERY = """
+    select coalesce(min(Id), ?) - 1 from kd_hk_transactions with(nolock)
+    where DateTimeCreated >= (
+        select coalesce(max(DateTimeUpdated), cast('19000101' as datetime))
+        from kd_hk_expression_result with(nolock) where RuleId = ?
+    )
+"""
+
+INSERT_WATERMARK_QUERY = """
+    insert into kd_hk_expression_watermark (RuleId, LastId, LastRunAt)
+    select ?, ?, null
+    where not exists (select 1 from kd_hk_expression_watermark where RuleId = ?)
+"""
+
+# the watermark moves only from the value this pass read, in the same transaction as the MERGE,
+# so when two hosts recompute a rule at once the second one waits for the first and then skips it;
+# the batch selects 1 when it moved the watermark and 0 when it skipped
+RECOMPUTE_QUERY = """
+    set nocount on;
+    update kd_hk_expression_watermark set LastId = ?, LastRunAt = getdate()
+    where RuleId = ? and LastId = ?;
+    declare @moved int = @@ROWCOUNT;
+    if @moved = 1
+    merge kd_hk_expression_result as target
+    using (
+        select touched.SourceAccountNumber, ({expression}) as ResultValue
+        from (
+            select distinct SourceAccountNumber from kd_hk_transactions with(nolock)
+            where Id > ? and Id <= ?
+        ) as touched
+    ) as source
+    on target.RuleId = ? and target.SourceAccountNumber = source.SourceAccountNumber
+    when matched then
+        update set ResultValue = cast(source.ResultValue as nvarchar(max)), DateTimeUpdated = getdate()
+    when not matched then
+        insert (RuleId, ResultValue, ResultDataType, SourceAccountNumber)
+        values (?, cast(source.ResultValue as nvarchar(max)), '', source.SourceAccountNumber);
+    select @moved;
+"""
+
+
+def parse_staleness_limits(value):
+    """
+    :param value: Comma separated rule_id=seconds pairs, like '12=30,15=600'.
+    :return: {rule_id: seconds}; malformed pairs are ignored.
+    """
+    limits = {}
+    for pair in (value or '').split(','):
+        rule_id, _, seconds = pair.partition('=')
+        try:
+            limits[int(rule_id)] = float(seconds)
+        except ValueError:
+            continue
+    return limits
+
+
+class ExpressionRecomputeScheduler:
+    """
+    Keeps kd_hk_expression_result up to date in place of the per-rule AFTER
+    INSERT triggers, so inserting a transaction costs the same however many
+    expression rules exist.
+
+    Every `interval` seconds, each active expression rule, shadow rules
+    included, that neither the aggregate nor the velocity engine handles and
+    whose results are older than its staleness limit is recomputed with one
+    MERGE over the accounts that have transactions after the rule's
+    watermark. Watermarks and the time of each rule's last run are kept in
+    kd_hk_expression_watermark, so they survive restarts and are shared by
+    every host. Only one process per lock file runs the passes, so gunicorn
+    workers on a host do not repeat each other's work.
+
+    The scheduler never touches the triggers: drop them with
+    `python expression_triggers.py drop` before enabling it.
+    """
+
+    def __init__(self, db, interval=60.0, staleness_limits=None, lock_path=None, safety_lag=10.0):
+        self.db = db
+        self.staleness_limits = staleness_limits or {}
+        self.default_staleness = interval
+        # wake often enough for the tightest limit, but not in a busy loop
+        self.interval = max(1.0, min([interval, *self.staleness_limits.values()]))
+        self.lock_path = lock_path
+        self.safety_lag = safety_lag
+
+        self._triggers_checked = False
+        self._last_run = {}  # rule id -> monotonic time of the last recompute, as of the last pass here
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='expression-recompute', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def staleness(self):
+        """
+        :return: [((rule id,), seconds since the rule was last recomputed)] for the gauge.
+        """
+        now = time.monotonic()
+        return [((str(rule_id),), round(now - last_run, 3)) for rule_id, last_run in list(self._last_run.items())]
+
+    def _acquire(self):
+        # non-blocking exclusive lock held for one pass; None when another process holds it
+        if not self.lock_path:
+            return -1
+        lock_file = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            os.close(lock_file)
+            return None
+
+    def _release(self, lock_file):
+        if lock_file != -1:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            os.close(lock_file)
+
+    def _check_triggers(self):
+        # the triggers still recompute on every insert, so the scheduler only adds work until they are dropped
+        names = {str(row[1]) for row in self.db.fetch_records(TRIGGER_RULES_QUERY, (), strict=True)
+                 if needs_trigger(row[2])}
+        remaining = names & existing_triggers(self.db)
+        if remaining:
+            logger.warning(f'{len(remaining)} expression rule triggers still exist on kd_hk_transactions; '
+                           f'run `python expression_triggers.py drop` to stop them recomputing on every insert')
+
+    def _due(self, rule, now):
+        last_run = self._last_run.get(rule.id)
+        limit = self.staleness_limits.get(rule.id, self.default_staleness)
+        return last_run is None or now - last_run >= limit
+
+    def recompute(self, rule, low_watermark, high_watermark):
+        """
+        Recomputes the rule's results for the accounts with transactions in
+        (low_watermark, high_watermark] and advances the stored watermark.
+
+        :param low_watermark: The rule's stored watermark, or None when it has none yet.
+        :return: True when this pass moved the watermark and merged the results, False when
+            it failed or another host had already moved the watermark from low_watermark.
+        """
+        if low_watermark is None:
+            row = self.db.fetch_record(LOW_WATERMARK_QUERY, (high_watermark + 1, rule.id))
+            if row is None:
+                return False
+            low_watermark = min(row[0], high_watermark)
+            if self.db.single_inserts(INSERT_WATERMARK_QUERY, (rule.id, low_watermark, rule.id)) != 0:
+                expression_recompute_failures.inc(str(rule.id))
+                return False
+        high_watermark = max(low_watermark, high_watermark)
+
+        expression = ACCOUNT_PARAMETER_PATTERN.sub('sourceaccountnumber = touched.SourceAccountNumber',
+                                                   rule.expression.strip().rstrip(';'))
+        with expression_recompute_seconds.time(str(rule.id)):
+            moved = self.db.single_insert_return_id(RECOMPUTE_QUERY.format(expression=expression),
+                                                    (high_watermark, rule.id, low_watermark,
+                                                     low_watermark, high_watermark, rule.id, rule.id))
+        if moved == 0:
+            expression_recompute_skips.inc(str(rule.id))
+            return False
+        if moved != 1:
+            expression_recompute_failures.inc(str(rule.id))
+            return False
+        return True
+
+    def _watermarks(self, rules, now):
+        """
+        Reads the stored watermarks and refreshes _last_run from the stored run times.
+
+        :return: {rule id: last kd_hk_transactions Id covered}
+        """
+        watermarks, last_run = {}, {}
+        active = {rule.id for rule in rules}
+        for rule_id, last_id, age in self.db.fetch_records(WATERMARKS_QUERY, (), strict=True):
+            if rule_id not in active:
+                continue
+            watermarks[rule_id] = last_id
+            if age is not None:
+                last_run[rule_id] = now - age
+        self._last_run = last_run
+        return watermarks
+
+    def run_once(self):
+        """
+        One pass over the due rules.
+
+        :return: The ids of the rules recomputed.
+        """
+        lock_file = self._acquire()
+        if lock_file is None:
+            return []
+        try:
+            if not self._triggers_checked:
+                self._triggers_checked = True
+                self._check_triggers()
+
+            now = time.monotonic()
+            rule_set = rule_set_cache.get(self.db)
+            # shadow rules read kd_hk_expression_result too
+            rules = [rule for rule in list(rule_set) + list(rule_set.shadow)
+                     if rule.reads_expression_results and rule.expression]
+            watermarks = self._watermarks(rules, now)
+            rules = [rule for rule in rules if self._due(rule, now)]
+            if not rules:
+                return []
+            row = self.db.fetch_record(HIGH_WATERMARK_QUERY, (self.safety_lag,))
+            if row is None:
+                return []
+
+            recomputed = []
+            for rule in rules:
+                if self.recompute(rule, watermarks.get(rule.id), row[0]):
+                    self._last_run[rule.id] = now
+                    recomputed.append(rule.id)
+            if recomputed:
+                # cached accounts may hold results older than the ones just written
+                expression_result_cache.clear()
+            return recomputed
+        finally:
+            self._release(lock_file)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error recomputing expression results: {e}")
+
+    def close(self):
+        self._stopped.set()
@@ -0,0 +1,104 @@
+import re
+
+from src.models.aggregate_spec import AggregateSpec
+from src.models.velocity_spec import VelocitySpec
+
+TRANSACTIONS_TABLE = 'kd_hk_transactions'
+
+# stored expressions end in this account filter, which the trigger and the scheduler bind per account
+ACCOUNT_PARAMETER_PATTERN = re.compile(r"sourceaccountnumber\s*=\s*\?\s*$", re.I)
+
+TRIGGER_RULES_QUERY = """
+    select Id, TriggerName, Expression, IsActive from kd_hk_rules with(nolock)
+    where IsExpression = 1 and TriggerName is not null
+"""
+
+EXISTING_TRIGGERS_QUERY = """
+    select t.name from sys.triggers t
+    inner join sys.tables tb on t.parent_id = tb.object_id
+    where tb.name = ?
+"""
+
+CREATE_TRIGGER_DDL = """
+    CREATE TRIGGER {trigger_name}
+    ON {table_name}
+    AFTER INSERT
+    AS
+    BEGIN
+        DECLARE @SourceAccountNumber NVARCHAR(10);
+        DECLARE @ResultValue NVARCHAR(MAX);
+        DECLARE @RuleId INT;
+        DECLARE @ExistingRuleCount INT;
+
+        DECLARE cur CURSOR FOR
+        SELECT SourceAccountNumber FROM inserted;
+
+        OPEN cur;
+        FETCH NEXT FROM cur INTO @SourceAccountNumber;
+
+        WHILE @@FETCH_STATUS = 0
+        BEGIN
+            -- Construct the result value for each row
+            SET @ResultValue = ({expression});
+
+            -- Retrieve RuleId
+            SELECT @RuleId = Id FROM kd_hk_rules WHERE TriggerName = {trigger_literal};
+
+            -- Check if the rule already exists in the result table
+            SELECT @ExistingRuleCount = COUNT(*) FROM kd_hk_expression_result
+            WHERE RuleId = @RuleId AND SourceAccountNumber=@SourceAccountNumber;
+
+            -- If the rule exists, update, otherwise insert
+            IF @ExistingRuleCount > 0
+            BEGIN
+                UPDATE kd_hk_expression_result
+                SET ResultValue = CAST(@ResultValue AS NVARCHAR(MAX)), DateTimeUpdated = GETDATE()
+                WHERE RuleId = @RuleId AND SourceAccountNumber=@SourceAccountNumber;
+            END
+            ELSE
+            BEGIN
+                INSERT INTO kd_hk_expression_result (RuleId, ResultValue, ResultDataType, SourceAccountNumber)
+                VALUES (@RuleId, CAST(@ResultValue AS NVARCHAR(MAX)), '', @SourceAccountNumber);
+            END
+
+            FETCH NEXT FROM cur INTO @SourceAccountNumber;
+        END;
+
+        CLOSE cur;
+        DEALLOCATE cur;
+    END;
+"""
+
+
+def quote_name(name):
+    return '[' + str(name).replace(']', ']]') + ']'
+
+
+def needs_trigger(expression):
+    # aggregate and velocity rules are kept up to date in-process
+    return AggregateSpec.parse(expression) is None and VelocitySpec.parse(expression) is None
+
+
+def create_trigger_ddl(trigger_name, expression, table_name=TRANSACTIONS_TABLE):
+    """
+    :param trigger_name: The rule's kd_hk_rules.TriggerName.
+    :param expression: The rule's stored expression, ending in `sourceaccountnumber=?`.
+    :return: The CREATE TRIGGER statement that recomputes the rule's results for inserted accounts.
+    """
+    bound = ACCOUNT_PARAMETER_PATTERN.sub('sourceaccountnumber = @SourceAccountNumber',
+                                          str(expression).strip().rstrip(';'))
+    return CREATE_TRIGGER_DDL.format(trigger_name=quote_name(trigger_name), table_name=quote_name(table_name),
+                                     expression=bound,
+                                     trigger_literal="'" + str(trigger_name).replace("'", "''") + "'")
+
+
+def drop_trigger_ddl(trigger_name):
+    return f"drop trigger if exists {quote_name(trigger_name)}"
+
+
+def existing_triggers(db, table_name=TRANSACTIONS_TABLE):
+    """
+    :return: The names of the triggers on the table.
+    :raises DatabaseError: If they could not be read.
+    """
+    return {row[0] for row in db.fetch_records(EXISTING_TRIGGERS_QUERY, (table_name,), strict=True)}
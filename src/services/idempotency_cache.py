@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from datetime import datetime, timedelta
+
+from src.config import (IDEMPOTENCY_CACHE_MAX_ENTRIES, IDEMPOTENCY_CACHE_TTL_SECONDS, IDEMPOTENCY_CLAIM_SECONDS,
+                        IDEMPOTENCY_HASH_PAYLOADS, IDEMPOTENCY_POLL_SECONDS, IDEMPOTENCY_REFERENCE_FIELD,
+                        IDEMPOTENCY_SHARED, IDEMPOTENCY_WAIT_SECONDS)
+from src.dto.response_dto import ResponseDto
+from src.infra.json_codec import dumps
+
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+CLAIM_QUERY = """
+    insert into kd_hk_idempotency (IdempotencyKey, ExpiresAt) values (?, ?)
+"""
+
+STORED_QUERY = """
+    select Response, ExpiresAt from kd_hk_idempotency where IdempotencyKey = ?
+"""
+
+STORE_QUERY = """
+    update kd_hk_idempotency set Response = ?, ExpiresAt = ? where IdempotencyKey = ?
+"""
+
+RELEASE_QUERY = """
+    delete from kd_hk_idempotency where IdempotencyKey = ?
+"""
+
+EXPIRED_DELETE_QUERY = """
+    delete from kd_hk_idempotency where IdempotencyKey = ? and ExpiresAt = ?
+"""
+
+
+class IdempotencyCache:
+    """
+    Bounded LRU/TTL cache of rule check verdicts by idempotency key.
+
+    The first request with a key stores a Future before it evaluates; retries
+    and concurrent duplicates get that Future back and wait on it instead of
+    evaluating, so one key leads to one evaluation, one set of kd_hk_report
+    rows and one kd_hk_transactions row. Failed checks, and checks that left
+    rules unevaluated, are not kept, so they can be retried.
+
+    The map only covers this process. Retries that reach another worker or
+    host are caught by claim(), which takes the key in kd_hk_idempotency
+    before evaluating, and store(), which leaves the verdict there for them.
+
+    Transactions are keyed by the client's key or their reference field.
+    Payload hashes are opt-in: identical payloads are not always retries.
+    """
+
+    def __init__(self, max_entries=IDEMPOTENCY_CACHE_MAX_ENTRIES, ttl=IDEMPOTENCY_CACHE_TTL_SECONDS,
+                 wait_seconds=IDEMPOTENCY_WAIT_SECONDS, reference_field=IDEMPOTENCY_REFERENCE_FIELD,
+                 hash_payloads=IDEMPOTENCY_HASH_PAYLOADS, shared=IDEMPOTENCY_SHARED,
+                 claim_seconds=IDEMPOTENCY_CLAIM_SECONDS, poll_seconds=IDEMPOTENCY_POLL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.wait_seconds = wait_seconds
+        self.reference_field = reference_field
+        self.hash_payloads = hash_payloads
+        self.shared = shared
+        self.claim_seconds = claim_seconds
+        self.poll_seconds = poll_seconds
+        self._entries = OrderedDict()  # key -> (started_at, Future of the ResponseDto)
+        self._lock = threading.Lock()
+
+    def key_for(self, idempotency_key, data):
+        """
+        :param idempotency_key: The client's key, when it sent one.
+        :param data: The transaction with lowercased keys.
+        :return: The cache key, or None when the cache is disabled or the transaction cannot be keyed.
+        """
+        if self.max_entries <= 0:
+            return None
+        if idempotency_key:
+            return 'key:' + idempotency_key
+        reference = data.get(self.reference_field) if self.reference_field else None
+        if reference not in (None, ''):
+            return 'ref:' + str(reference)
+        if not self.hash_payloads:
+            return None
+        payload = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+        return 'sha:' + hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def begin(self, key):
+        """
+        :return: (future, owner). The owner evaluates and passes the result to finish();
+                 everyone else waits on the future with replay() or replay_async().
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1], False
+            future = Future()
+            self._entries[key] = (now, future)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return future, True
+
+    def finish(self, key, future, res, keep=True):
+        """
+        Hands the owner's result to everyone waiting on the key.
+
+        :param keep: False to hand the result out without keeping it for later retries.
+        """
+        if res is None or not res.isSuccessful or not keep:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] is future:
+                    del self._entries[key]
+        future.set_result(res)
+
+    def claim(self, db, key):
+        """
+        Takes the key in kd_hk_idempotency for this process, after begin() made it the owner here.
+
+        :return: (claimed, res). res is None when this process should evaluate, which it also
+                 does when the table cannot be reached; otherwise it is the verdict another
+                 worker stored, or 409 if that worker does not store one within wait_seconds.
+                 Only a claimed key is passed to store().
+        """
+        if not self.shared:
+            return False, None
+        if db.single_inserts(CLAIM_QUERY, (key, datetime.now() + timedelta(seconds=self.claim_seconds))) == 0:
+            return True, None
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            row = db.fetch_record(STORED_QUERY, (key,))
+            if row is None:
+                # the table cannot be read, or the other worker's check failed and gave the key up
+                return False, None
+            response, expires_at = row
+            if expires_at < datetime.now():
+                # a verdict past the TTL, or a claim left by a worker that died before storing one
+                db.single_inserts(EXPIRED_DELETE_QUERY, (key, expires_at))
+                if db.single_inserts(CLAIM_QUERY, (key, datetime.now() + timedelta(seconds=self.claim_seconds))) == 0:
+                    return True, None
+            elif response is not None:
+                try:
+                    return False, self._replayed_response(self._decode(response))
+                except (ValueError, KeyError):
+                    return False, None
+            if time.monotonic() >= deadline:
+                return False, self._in_progress()
+            time.sleep(self.poll_seconds)
+
+    async def claim_async(self, db, key):
+        return await db.run_in_executor(self.claim, db, key)
+
+    def store(self, db, key, res, keep=True):
+        """
+        Leaves a claimed key's verdict in kd_hk_idempotency for retries that reach other
+        workers, or gives the key up for the same verdicts finish() does not keep.
+        """
+        if res is None or not res.isSuccessful or not keep:
+            db.single_inserts(RELEASE_QUERY, (key,))
+            return
+        db.single_inserts(STORE_QUERY, (self._encode(res), datetime.now() + timedelta(seconds=self.ttl), key))
+
+    async def store_async(self, db, key, res, keep=True):
+        await db.run_in_executor(self.store, db, key, res, keep)
+
+    def _encode(self, res):
+        return dumps({'isSuccessful': res.isSuccessful, 'message': res.message, 'data': res.data,
+                      'statuscode': res.statuscode, 'headers': res.headers, 'extra': res.extra}).decode('utf-8')
+
+    def _decode(self, response):
+        stored = json.loads(response)
+        return ResponseDto(stored['isSuccessful'], stored['message'], stored['data'], stored['statuscode'],
+                           stored['headers'], stored['extra'])
+
+    def _replayed(self, future):
+        return self._replayed_response(future.result())
+
+    def _replayed_response(self, res):
+        if res is None:
+            return ResponseDto(False, 'An error occured', False, 500)
+        headers = dict(res.headers or {})
+        headers[REPLAYED_HEADER] = 'true'
+        return ResponseDto(res.isSuccessful, res.message, res.data, res.statuscode, headers, res.extra)
+
+    def _in_progress(self):
+        return ResponseDto(False, 'A rule check with this idempotency key is still in progress', None, 409)
+
+    def replay(self, future):
+        try:
+            future.result(timeout=self.wait_seconds)
+        except TimeoutError:
+            return self._in_progress()
+        return self._replayed(future)
+
+    async def replay_async(self, future):
+        # asyncio.wait rather than wait_for: a timeout must not cancel the owner's future
+        done, _ = await asyncio.wait({asyncio.wrap_future(future)}, timeout=self.wait_seconds)
+        if not done:
+            return self._in_progress()
+        return self._replayed(future)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+idempotency_cache = IdempotencyCache()
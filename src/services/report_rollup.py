@@ -0,0 +1,165 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from src.infra.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+report_rollup_flush_failures = registry.counter(
+    'hawkeye_report_rollup_flush_failures_total', 'Report rollup flushes that failed and were kept for the next one.')
+
+BUCKETS = ('hour', 'day')
+
+# rows are created with 0 hits first and then incremented, so a failure at either step can be retried as a whole
+ROLLUP_INSERT_QUERY = """
+    insert into kd_hk_report_rollup (RuleId, Bucket, BucketStart, Hits)
+    select ?, ?, ?, 0
+    where not exists (
+        select 1 from kd_hk_report_rollup where RuleId = ? and Bucket = ? and BucketStart = ?
+    )
+"""
+ROLLUP_UPDATE_QUERY = """
+    update kd_hk_report_rollup set Hits = Hits + ?
+    where RuleId = ? and Bucket = ? and BucketStart = ?
+"""
+ACCOUNT_ROLLUP_INSERT_QUERY = """
+    insert into kd_hk_report_rollup_account (RuleId, BucketStart, SourceAccountNumber, Hits)
+    select ?, ?, ?, 0
+    where not exists (
+        select 1 from kd_hk_report_rollup_account where RuleId = ? and BucketStart = ? and SourceAccountNumber = ?
+    )
+"""
+ACCOUNT_ROLLUP_UPDATE_QUERY = """
+    update kd_hk_report_rollup_account set Hits = Hits + ?
+    where RuleId = ? and BucketStart = ? and SourceAccountNumber = ?
+"""
+
+
+def bucket_start(moment, bucket):
+    if bucket == 'day':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+class ReportRollup:
+    """
+    Hit counts per rule per hour and day, and per rule, day and source
+    account, kept in kd_hk_report_rollup and kd_hk_report_rollup_account so
+    the report summary never reads kd_hk_report.
+
+    Registered as the write-behind listener of the report insert, it counts
+    report rows as they are committed and adds the counts to the rollup
+    tables every `interval` seconds. Flushes of the processes on a host are
+    serialised by a lock file, so two of them never create the same row.
+    Hosts are not: when two create the same row at once, the unique indexes
+    of migrations/004_report_rollup.sql roll one batch back, and its counts
+    are kept and added on its next flush, once the row exists.
+    """
+
+    def __init__(self, db, interval=10.0, lock_path=None):
+        self.db = db
+        self.interval = interval
+        self.lock_path = lock_path
+
+        self._hits = {}  # (rule id, bucket, bucket start) -> hits not flushed yet
+        self._account_hits = {}  # (rule id, day start, source account) -> hits not flushed yet
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='report-rollup', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, rows, now=None):
+        """
+        Write-behind listener for report inserts.
+
+        :param rows: (rule id, payload JSON) parameter tuples of the committed report rows.
+        :param now: When the rows were written, defaults to the current time.
+        """
+        now = now or datetime.now()
+        starts = {bucket: bucket_start(now, bucket) for bucket in BUCKETS}
+        with self._lock:
+            for rule_id, payload in rows:
+                for bucket, start in starts.items():
+                    key = (rule_id, bucket, start)
+                    self._hits[key] = self._hits.get(key, 0) + 1
+                try:
+                    account = json.loads(payload).get('sourceaccountnumber')
+                except (ValueError, TypeError, AttributeError):
+                    account = None
+                if account is not None:
+                    key = (rule_id, starts['day'], str(account))
+                    self._account_hits[key] = self._account_hits.get(key, 0) + 1
+        if self._stopped.is_set():
+            # the write-behind queue flushes its last rows after this object's atexit hook has run
+            self.flush()
+
+    def pending(self):
+        return len(self._hits) + len(self._account_hits)
+
+    def _acquire(self):
+        if not self.lock_path:
+            return -1
+        lock_file = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _release(self, lock_file):
+        if lock_file != -1:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            os.close(lock_file)
+
+    def _apply(self, insert_query, update_query, counts):
+        # each batch is one transaction: a batch that did not return 0 wrote nothing
+        keys = list(counts)
+        if self.db.multiple_inserts(insert_query, [key + key for key in keys]) != 0:
+            return False
+        return self.db.multiple_inserts(update_query, [(counts[key], *key) for key in keys]) == 0
+
+    def _restore(self, target, counts):
+        with self._lock:
+            for key, hits in counts.items():
+                target[key] = target.get(key, 0) + hits
+
+    def flush(self):
+        """
+        Adds the counted hits to the rollup tables. Counts that could not be
+        written are kept and retried on the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                hits, self._hits = self._hits, {}
+                account_hits, self._account_hits = self._account_hits, {}
+            if not hits and not account_hits:
+                return
+
+            lock_file = self._acquire()
+            try:
+                if hits and not self._apply(ROLLUP_INSERT_QUERY, ROLLUP_UPDATE_QUERY, hits):
+                    report_rollup_flush_failures.inc()
+                    self._restore(self._hits, hits)
+                if account_hits and not self._apply(ACCOUNT_ROLLUP_INSERT_QUERY, ACCOUNT_ROLLUP_UPDATE_QUERY,
+                                                    account_hits):
+                    report_rollup_flush_failures.inc()
+                    self._restore(self._account_hits, account_hits)
+            finally:
+                self._release(lock_file)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing report rollups: {e}")
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self.flush()
@@ -0,0 +1,197 @@
+import threading
+import time
+import logging
+
+from src.config import RULE_CACHE_REFRESH_SECONDS, RULE_CACHE_RETRY_SECONDS, RULE_SNAPSHOT_PATH
+from src.infra.db_repo import DatabaseError
+from src.infra.rule_snapshot import RuleSnapshot
+from src.models.compiled_rule import CompiledRule
+from src.services.value_rule_matrix import DataPointColumns, ValueRuleMatrix
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledRuleSet(tuple):
+    """
+    The active rules that decide verdicts: the ValueRuleMatrix that checks
+    the numeric value rules, and the rules checked one by one, which are the
+    tuple's items. Both are swapped together when the set is reloaded.
+    Active shadow rules are kept apart in `shadow`.
+    """
+
+    def __new__(cls, rules, columns=None):
+        """
+        :param rules: Compiled rules, shadow rules included.
+        :param columns: The matrix columns read from a RuleSnapshot, in which case
+            rules holds only the rules that are not in them.
+        """
+        active = [rule for rule in rules if not rule.shadow]
+        if columns is None:
+            value_matrix = ValueRuleMatrix(active)
+        else:
+            value_matrix = ValueRuleMatrix.from_columns(columns, active)
+        rule_set = super().__new__(cls, value_matrix.remaining)
+        rule_set.shadow = tuple(rule for rule in rules if rule.shadow)
+        rule_set.value_matrix = value_matrix
+        return rule_set
+
+    def __bool__(self):
+        return tuple.__len__(self) > 0 or len(self.value_matrix) > 0
+
+
+class RuleSetCache:
+    """
+    Process-wide set of compiled active rules.
+
+    The set is rebuilt off to the side and swapped in with a single assignment,
+    so readers always see either the old or the new tuple, never a partial one.
+
+    With a RuleSnapshot, workers share one copy of the set: whichever worker
+    has to reload takes the publisher lock, reads kd_hk_rules and publishes a
+    new snapshot version. Every other worker notices the new version on its
+    next get() and adopts it from the snapshot instead of querying the database.
+
+    A reload whose query fails keeps the previous set and is retried after
+    retry_interval seconds. With no previous set the DatabaseError is raised,
+    so a rule check fails instead of passing every transaction.
+    """
+    select_rules_query = "select * from kd_hk_rules with(nolock) where isActive = 1"
+
+    def __init__(self, refresh_interval=RULE_CACHE_REFRESH_SECONDS, snapshot=None,
+                 retry_interval=RULE_CACHE_RETRY_SECONDS):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.snapshot = snapshot
+        self._rules = None
+        self._loaded_at = 0.0
+        self._version = 0
+        self._force_db = False
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    def _is_fresh(self):
+        return self._rules is not None and time.monotonic() - self._loaded_at < self.refresh_interval
+
+    def _published_version(self):
+        header = self.snapshot.header() if self.snapshot else None
+        return header[0] if header else None
+
+    def _current(self):
+        rules = self._rules
+        if rules is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            published = self._published_version()
+            if published is None or published == self._version:
+                return rules
+        return None
+
+    def get(self, db):
+        rules = self._current()
+        return rules if rules is not None else self.reload(db)
+
+    async def get_async(self, db):
+        rules = self._current()
+        # reloads take the publisher lock and query the database, so they run on the executor
+        return rules if rules is not None else await db.run_in_executor(self.reload, db)
+
+    def _swap(self, rule_set, version):
+        self._rules = rule_set
+        self._loaded_at = time.monotonic()
+        self._version = version
+        return self._rules
+
+    def _adopt_snapshot(self):
+        """
+        Switches to the published snapshot if it is recent enough to trust.
+
+        :return: The rule set, or None when the database has to be read instead.
+        """
+        if self.snapshot is None or self._force_db:
+            return None
+        header = self.snapshot.header()
+        if header is None or time.time() - header[1] >= self.refresh_interval:
+            return None
+        if header[0] == self._version and self._rules is not None:
+            self._loaded_at = time.monotonic()
+            return self._rules
+        loaded = self.snapshot.read(CompiledRule.from_fields, DataPointColumns)
+        if loaded is None:
+            return None
+        version, _, rules, columns = loaded
+        return self._swap(CompiledRuleSet(rules, columns), version)
+
+    def _load_from_db(self, db):
+        # strict, so a failed query raises instead of looking like a table without active rules
+        rows = db.fetch_records(self.select_rules_query, (), strict=True)
+        compiled = []
+        for row in rows:
+            try:
+                compiled.append(CompiledRule.from_row(row))
+            except Exception as e:
+                logger.error(f"Skipping rule {row[0]}: {e}")
+        return CompiledRuleSet(compiled)
+
+    def reload(self, db):
+        with self._lock:
+            # another thread may have reloaded while we waited on the lock
+            if self._is_fresh() and self._published_version() in (None, self._version):
+                return self._rules
+
+            try:
+                return self._reload(db)
+            except DatabaseError as e:
+                if self._rules is None:
+                    raise
+                logger.error(f"Failed to reload rules, keeping the previous set: {e}")
+                self._loaded_at = time.monotonic() - self.refresh_interval + self.retry_interval
+                return self._rules
+
+    def _reload(self, db):
+        rules = self._adopt_snapshot()
+        if rules is not None:
+            return rules
+
+        read_from_db = False
+        try:
+            if self.snapshot is None:
+                rule_set, read_from_db = self._load_from_db(db), True
+                return self._swap(rule_set, self._version + 1)
+
+            try:
+                publish_lock = self.snapshot.publish_lock()
+            except OSError as e:
+                logger.error(f"Rule snapshot unavailable, loading rules locally: {e}")
+                rule_set, read_from_db = self._load_from_db(db), True
+                return self._swap(rule_set, self._version + 1)
+
+            try:
+                # another worker may have published while we waited for the publisher lock
+                rules = self._adopt_snapshot()
+                if rules is not None:
+                    return rules
+
+                # a failed read raises DatabaseError, so only a set read successfully is published
+                rule_set, read_from_db = self._load_from_db(db), True
+                version = max(self._published_version() or 0, self._version) + 1
+                try:
+                    self.snapshot.publish(rule_set, version)
+                except OSError as e:
+                    logger.error(f"Failed to publish rule snapshot: {e}")
+                return self._swap(rule_set, version)
+            finally:
+                publish_lock.close()
+        finally:
+            # an invalidation is served once the database was read, whichever path read it
+            if read_from_db:
+                self._force_db = False
+
+    def invalidate(self):
+        # the caller changed kd_hk_rules, so the next load must come from the database
+        with self._lock:
+            self._loaded_at = 0.0
+            self._force_db = True
+
+
+rule_set_cache = RuleSetCache(snapshot=RuleSnapshot(RULE_SNAPSHOT_PATH) if RULE_SNAPSHOT_PATH else None)
@@ -1,65 +1,112 @@
-from datetime import datetime
+import asyncio
+import base64
+from datetime import datetime, timedelta
 import json
 import random
 import re
+import time
 from typing import List
 from flask import g
+from werkzeug.http import http_date, quote_etag
 from src.dto.response_dto import ResponseDto
 from src.infra.db_repo import DatabaseManager
-from concurrent.futures import ThreadPoolExecutor
+from src.models.aggregate_spec import AggregateSpec
+from src.models.compiled_rule import CompiledRule
+from src.models.velocity_spec import VelocitySpec
+from src.services.aggregate_engine import aggregate_engine
+from src.services.anomaly_engine_service import AnomalyEngine
+from src.services.expression_evaluation import ExpressionEvaluation
+from src.services.expression_result_cache import expression_result_cache
+from src.services.expression_triggers import create_trigger_ddl
+from src.services.idempotency_cache import idempotency_cache
+from src.services.report_rollup import BUCKETS, bucket_start
+from src.services.rule_cache import rule_set_cache
+from src.services.schema_cache import schema_cache
+from src.services.shadow_rules import ShadowRuleStats, load_stats, shadow_rule_evaluator
+from src.services.velocity_engine import velocity_engine
+from src.config import (EXPRESSION_RECOMPUTE_ENABLED, REPORT_EXPORT_CHUNK_SIZE, REPORT_PAGE_DEFAULT_SIZE, REPORT_PAGE_MAX_SIZE,
+                        REPORT_SUMMARY_MAX_BUCKETS, REPORT_SUMMARY_MAX_TOP_ACCOUNTS, RULE_CHECK_BATCH_MAX_SIZE)
+from src.utils import CONDITIONAL_MAP, TYPE_VALIDATION_MAP
+from src.infra.json_codec import RawJson, dumps
+from src.infra.metrics import current_endpoint, rule_check_faults, rule_check_replays, rule_check_stage_seconds
+from src.infra.structured_logging import log_event
+from src.infra.write_behind import WriteBehindQueue
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-executor = ThreadPoolExecutor(max_workers=1)
+REPORT_INSERT_QUERY = """
+    insert into kd_hk_report
+    (ruleId, payloadType, payloadDetails)
+    values(?, 'Transaction', ?)
+"""
+
+TRANSACTION_INSERT_QUERY = """
+    insert into kd_hk_transactions (sourceAccountNumber, DestinationAccountNumber,
+     Amount,DestinationBankCode) values (?, ?, ?, ?)
+"""
+
+TRANSACTION_KEYS = ['sourceaccountnumber', 'destinationaccountnumber', 'amount', 'destinationbankcode']
+
+REPORT_SUMMARY_QUERY = """
+    select RuleId, BucketStart, sum(Hits) from kd_hk_report_rollup with(nolock)
+    where Bucket = ? and BucketStart >= ?{rule_filter}
+    group by RuleId, BucketStart
+"""
+
+REPORT_TOP_ACCOUNTS_QUERY = """
+    select top (?) SourceAccountNumber, sum(Hits) from kd_hk_report_rollup_account with(nolock)
+    where BucketStart >= ?{rule_filter}
+    group by SourceAccountNumber
+    order by sum(Hits) desc
+"""
+
+REPORT_SUMMARY_DEFAULT_BUCKETS = {'hour': 24, 'day': 30}
 
 
 class RuleEngine:
     def __init__(self):
         self.db: DatabaseManager = g.db_manager
-        self.conditional_map = {
-            "GreaterThan": lambda x, y: x > y,
-            "LessThan": lambda x, y: x < y,
-            "EqualTo": lambda x, y: x == y,
-            "GreaterThanOrEqualTo": lambda x, y: x >= y,
-            "LessThanOrEqualTo": lambda x, y: x <= y,
-            "NotEqualTo": lambda x, y: x != y
-        }
-        self.type_validation_map = {
-            'float': lambda v: float(v),
-            'int': lambda v: int(v),
-            'datetime': lambda v: datetime.strptime(v, "%Y-%m-%d %H:%M:%S"),
-            'vachar': lambda v: str(v),
-            'string': lambda v: str(v),
-            'str': lambda v: str(v),
-        }
+        self.write_behind: WriteBehindQueue = g.write_behind
+        self.anomaly_engine = AnomalyEngine()
+        self.conditional_map = CONDITIONAL_MAP
+        self.type_validation_map = TYPE_VALIDATION_MAP
 
     def get_conditionals(self):
         return [key for key in self.conditional_map]
 
+    def __get_table_schema(self, table_name):
+        return schema_cache.get(self.db, table_name)
+
     def __get_table_columns(self, table_name):
-        table_columns = self.db.get_columns_of_table(table_name)
-        if table_columns:
-            return {row[0]: row[1] for row in table_columns}
-        return None
+        schema = self.__get_table_schema(table_name)
+        return schema.columns if schema else None
 
     def get_data_points(self):
         try:
-            table_columns = self.__get_table_columns('kd_hk_transactions')
-            if table_columns:
+            schema = self.__get_table_schema('kd_hk_transactions')
+            if schema:
                 data = {
-                    'datapoints': table_columns,
+                    'datapoints': schema.columns,
                     'conditionals': self.get_conditionals(),
                     'category': ['transactions']
                 }
-                return ResponseDto(True, 'success', data, 200)
+                headers = {
+                    'ETag': quote_etag(schema.etag),
+                    'Last-Modified': http_date(schema.last_modified),
+                    'Cache-Control': 'no-cache'
+                }
+                return ResponseDto(True, 'success', data, 200, headers)
             else:
                 return ResponseDto(False, 'Failed to get the data points. Kindly try again', None, 400)
         except Exception as e:
             logger.error(f"Error fetching table columns: {e}")
             return ResponseDto(False, 'An error occurred while fetching data points', None, 500)
 
+    def refresh_data_points(self):
+        schema_cache.invalidate('kd_hk_transactions')
+        return self.get_data_points()
+
     def __keys_exist(self, data: dict, keys: list):
         return all(key in data and data[key] for key in keys)
 
@@ -67,117 +114,109 @@ class RuleEngine:
         return {k.lower(): v for k, v in input_dict.items()}
 
     def __save_report(self, rule_id, data, saving_count=0):
-        insert_query = """
-                    insert into kd_hk_report
-                    (ruleId, payloadType, payloadDetails)
-                    values(?, 'Transaction', ?)
-                """
-        # push to a query to save it
+        # queued for the write-behind flusher so the verdict does not wait on the commit
         try:
-            self.db.single_inserts(insert_query, (rule_id, json.dumps(data)))
+            self.write_behind.put(REPORT_INSERT_QUERY, (rule_id, dumps(data).decode('utf-8')))
         except Exception as e:
             logger.error(f"Failed to insert report for rule_id {rule_id}: {e}")
 
-    def __validate_value_type_rule(self, rule, data):
+    def __validate_value_type_rule(self, rule: CompiledRule, data):
         """
         Validates a rule against the given data.
 
-        :param rule: The rule to validate.
+        :param rule: The compiled rule to validate.
         :param data: The data to validate the rule against.
         :return: True if the rule is faulted, False otherwise.
         """
-        # Normalize input
-        column_to_check = rule[1].lower()
-        value_to_check_against = rule[4]
-        conditional = rule[3]
-        check_value_data_type = rule[8]
-        
+        column_to_check = rule.data_point
 
         # Guard clause: Ensure the column exists in the data
         if column_to_check not in data:
-            logger.warning(f"Data column '{column_to_check}' not present in the request")
+            log_event(logger, logging.WARNING, 'data_point_missing',
+                      "Data column '%s' not present in the request", column_to_check, rule_id=rule.id)
             return False
 
         try:
-            # Convert values
-            converter = self.type_validation_map.get(check_value_data_type)
-            if not converter:
-                logger.error(f"Unsupported data type for conversion: {check_value_data_type}")
-                return False
-
-            converted_check_value = converter(data[column_to_check])
-            converted_value_to_check_against = converter(
-                value_to_check_against)
-
-            # Evaluate the condition
-            is_faulted = self.conditional_map[conditional](
-                converted_check_value, converted_value_to_check_against
-            )
-
-            if is_faulted:
-                self.__save_report(rule[0], data)
-                return True
-            return False
+            # Only the incoming value needs converting, the threshold was converted at load time
+            return rule.faulted_by(data[column_to_check])
         except KeyError as e:
-            logger.error(f"Key error: {e}")
+            logger.error("Key error: %s", e)
             return False
         except (ValueError, TypeError) as e:
-            logger.error(f"Invalid data type for rule comparison: {e}")
+            log_event(logger, logging.ERROR, 'rule_comparison_failed',
+                      "Invalid data type for rule comparison: %s", e, rule_id=rule.id)
             return False
 
-    def __validate_expression_type_rule(self, rule, data):
-        column_to_check = rule[1].lower()
-        conditional = rule[3]
+    def __validate_expression_type_rule(self, rule: CompiledRule, data, expression_results):
+        column_to_check = rule.data_point
 
-        
         if column_to_check not in data:
-            logger.warning(f"Data column '{column_to_check}' not present in the request")
+            log_event(logger, logging.WARNING, 'data_point_missing',
+                      "Data column '%s' not present in the request", column_to_check, rule_id=rule.id)
             return False
         
         try:
-            #get rule result 
-            rule_result_query = """
-            select ResultValue from kd_hk_expression_result with(nolock)
-            where RuleId = ? and SourceAccountNumber = ?
-            """
-            rule_result = self.db.fetch_record(rule_result_query, (rule[0], data['sourceaccountnumber']))
-            
-            logger.info(f'rule_result {rule_result}')
-            if rule_result is None:
-                return False
-            
-            
-            converter = self.type_validation_map.get(rule[12])
-            if not converter:
-                logger.error(f"Unsupported data type for conversion: {rule[12]}")
-                return False
+            if rule.velocity is not None:
+                return rule.faulted_by(velocity_engine.observe(rule, data))
+            if rule.aggregate is not None:
+                rule_result = aggregate_engine.value(self.db, rule, data['sourceaccountnumber'])
+            else:
+                # results of the transaction's source account, keyed by RuleId
+                rule_result = expression_results.get(rule.id)
             
-            converted_check_value = converter(data[column_to_check])
-            converted_value_to_check_against = converter(rule_result[0])
-
-            # # Evaluate the condition
-            logger.info(converted_check_value, converted_value_to_check_against)
-            is_faulted = self.conditional_map[conditional](converted_check_value, converted_value_to_check_against)
-
-            if is_faulted:
-                self.__save_report(rule[0], data)
-                return True
-            return False
+            log_event(logger, logging.INFO, 'expression_rule_result', 'rule_result %s', rule_result, rule_id=rule.id)
+            return rule.faulted_by(data[column_to_check], rule_result)
         except KeyError as e:
-            logger.error(f"Key error: {e}")
+            logger.error("Key error: %s", e)
             return False
         except (ValueError, TypeError) as e:
-            logger.error(f"Invalid data type for rule comparison: {e}")
+            log_event(logger, logging.ERROR, 'rule_comparison_failed',
+                      "Invalid data type for rule comparison: %s", e, rule_id=rule.id)
             return False
-        return False
 
-    def __validate_rule(self, rule, data):
-        # get rule type
-        # isExpression or not
-        if not rule[2]:
+    def __validate_rule(self, rule: CompiledRule, data, expression_results):
+        if not rule.is_expression:
             return self.__validate_value_type_rule(rule, data)
         else:
-            return self.__validate_expression_type_rule(rule, data)
+            return self.__validate_expression_type_rule(rule, data, expression_results)
+
+    def __faulted_rules(self, active_rules, data, expression_results, faulted=None):
+        # numeric value rules are checked by the rule set's ValueRuleMatrix, the rest one by one
+        faulted = active_rules.value_matrix.faulted(data) if faulted is None else faulted
+        faulted.extend(rule.id for rule in active_rules.value_matrix.remaining
+                       if self.__validate_rule(rule, data, expression_results))
+        return faulted
+
+    def __evaluate(self, active_rules, data, evaluation: ExpressionEvaluation):
+        # value rules as one block, expression rules one by one so the response can time each of them
+        started = time.perf_counter()
+        faulted = active_rules.value_matrix.faulted(data)
+        expression_rules = []
+        for rule in active_rules.value_matrix.remaining:
+            if rule.is_expression:
+                expression_rules.append(rule)
+            elif self.__validate_value_type_rule(rule, data):
+                faulted.append(rule.id)
+        evaluation.value_rules_ms = (time.perf_counter() - started) * 1000
+
+        for rule in expression_rules:
+            if rule.id in evaluation.unfinished:
+                continue
+            started = time.perf_counter()
+            if self.__validate_expression_type_rule(rule, data, evaluation.results):
+                faulted.append(rule.id)
+            evaluation.evaluated(rule.id, started)
+        return faulted
+
+    def __needs_expression_results(self, active_rules):
+        return any(rule.reads_expression_results for rule in active_rules)
+
+    def __shadow_fields(self, dataRequest):
+        # IsShadow is only written for shadow rules, so the others can still be created
+        # on a database that migrations/003_shadow_rules.sql has not been applied to
+        if dataRequest.get('shadow'):
+            return ', IsShadow', ', ?', (1,)
+        return '', '', ()
 
     def set_value_type_rule(self, dataRequest: dict):
         if not self.__keys_exist(dataRequest, ['dataPoint', 'checkValue', 'conditional']):
@@ -189,63 +228,279 @@ class RuleEngine:
 
         if conditional not in self.conditional_map:
             return ResponseDto(False, f"Unsupported conditional: {conditional}", None, 400)
-        table_columns = self.__get_table_columns('kd_hk_transactions')
+        schema = self.__get_table_schema('kd_hk_transactions')
 
-        if dataPoint not in table_columns:
+        if not schema or dataPoint not in schema.columns:
             return ResponseDto(False, 'dataPoint is not mapped to the table', None, 400)
 
-        column_data_type = table_columns[dataPoint]
+        column_data_type = schema.columns[dataPoint]
 
-        if 'char' not in column_data_type:
-            if column_data_type in self.type_validation_map:
-                try:
-                    self.type_validation_map[column_data_type](checkValue)
-                except ValueError:
-                    return ResponseDto(False, f'Invalid data type for checkValue. Expected {column_data_type}.', None, 400)
+        validator = schema.validators[dataPoint]
+        if validator:
+            try:
+                validator(checkValue)
+            except ValueError:
+                return ResponseDto(False, f'Invalid data type for checkValue. Expected {column_data_type}.', None, 400)
         description = dataRequest['description'] if dataRequest['description'] else ''
         ruleName = dataRequest['name'] if dataRequest['name'] else ''
-        insert_query = """
+        # shadow rules are measured on live traffic without affecting verdicts until promoted
+        shadow_column, shadow_value, shadow = self.__shadow_fields(dataRequest)
+        insert_query = f"""
             INSERT INTO kd_hk_rules
-            (dataPoint, isExpression, conditional, checkValue, CheckValueDatatype, Description, RuleName)
-            VALUES (?, 0, ?, ?, ?, ?, ?)
+            (dataPoint, isExpression, conditional, checkValue, CheckValueDatatype, Description, RuleName{shadow_column})
+            VALUES (?, 0, ?, ?, ?, ?, ?{shadow_value})
         """
         res = self.db.single_inserts(
-            insert_query, (dataPoint, conditional, checkValue, column_data_type, description, ruleName))
+            insert_query, (dataPoint, conditional, checkValue, column_data_type, description, ruleName, *shadow))
         if res is None:
             return ResponseDto(False, 'Error creating rule. Please try again later.', None, 400)
 
+        rule_set_cache.invalidate()
         return ResponseDto(True, 'Rule has been set successfully', None, 200)
 
-    def rule_check(self, data) -> ResponseDto:
+    def __check(self, endpoint, active_rules, data, evaluation=None):
+        result = False
+        if active_rules:
+            with rule_check_stage_seconds.time(endpoint, 'evaluate'):
+                faulted_rules = self.__evaluate(active_rules, data, evaluation)
+            with rule_check_stage_seconds.time(endpoint, 'report_insert'):
+                for rule_id in faulted_rules:
+                    self.__save_report(rule_id, data)
+                    result = True
+            with rule_check_stage_seconds.time(endpoint, 'aggregate_update'):
+                aggregate_engine.observe(active_rules, data)
+            rule_check_faults.inc(endpoint, amount=len(faulted_rules))
+        
+            message = 'Transaction is suspicious' if result else 'Not a suspicious transaction'
+            if evaluation.unfinished:
+                message += f'; {len(evaluation.unfinished)} expression rules were not evaluated before the deadline'
+            res= ResponseDto(True, message, result, 200, extra={'evaluation': evaluation.to_dict()})
+        else:
+            res = ResponseDto(True, 'No active rules', result, 200)
+        shadow_rule_evaluator.submit(self.db, active_rules.shadow, [data])
+
+        with rule_check_stage_seconds.time(endpoint, 'anomaly_score'):
+            score = self.anomaly_engine.score_transaction(data)
+        if score is not None:
+            res.extra = {**(res.extra or {}), 'anomaly': score.to_dict()}
+        
+        #insert transaction
+        with rule_check_stage_seconds.time(endpoint, 'transaction_insert'):
+            transaction_row = (data['sourceaccountnumber'], data['destinationaccountnumber'],
+                               data['amount'], data['destinationbankcode'])
+            aggregate_engine.queued([transaction_row])
+            self.write_behind.put(TRANSACTION_INSERT_QUERY, transaction_row)
+        log_event(logger, logging.INFO, 'transaction_recorded', 'insert record %s', data,
+                  sourceAccountNumber=data['sourceaccountnumber'], suspicious=bool(res.data))
+        return res
+
+    def __idempotency_key(self, data, idempotency_key):
         try:
+            return idempotency_cache.key_for(idempotency_key, self.__convert_keys_to_lowercase(data))
+        except Exception as e:
+            logger.error(f"Could not build the idempotency key: {e}")
+            return None
+
+    def __complete(self, res):
+        # a verdict with deadline-skipped rules is only shared with concurrent duplicates, never replayed later
+        evaluation = (res.extra or {}).get('evaluation') if res is not None else None
+        return evaluation is None or evaluation['complete']
+
+    def rule_check(self, data, idempotency_key=None) -> ResponseDto:
+        """
+        Checks a transaction against the active rules. The expression rule
+        lookups run concurrently on the database executor; those not done
+        within RULE_CHECK_DEADLINE_MS are reported in the response's
+        `evaluation` instead of delaying the verdict.
+
+        Retries with the same idempotency key or transaction reference get
+        the first check's verdict back without evaluating or writing anything,
+        on this worker or any other sharing kd_hk_idempotency, unless that
+        check left expression rules unevaluated.
+        """
+        key = self.__idempotency_key(data, idempotency_key)
+        if key is None:
+            return self.__rule_check(data)
+        future, owner = idempotency_cache.begin(key)
+        if not owner:
+            rule_check_replays.inc(current_endpoint())
+            return idempotency_cache.replay(future)
+        claimed, res = idempotency_cache.claim(self.db, key)
+        if res is not None:
+            # another worker has the key; its verdict is handed to the duplicates waiting here too
+            rule_check_replays.inc(current_endpoint())
+            idempotency_cache.finish(key, future, res)
+            return res
+        try:
+            res = self.__rule_check(data)
+            return res
+        finally:
+            keep = self.__complete(res)
+            if claimed:
+                idempotency_cache.store(self.db, key, res, keep)
+            idempotency_cache.finish(key, future, res, keep)
+
+    def __rule_check(self, data) -> ResponseDto:
+        try:
+            endpoint = current_endpoint()
             data = self.__convert_keys_to_lowercase(data)
-            select_rules_query = "select * from kd_hk_rules with(nolock) where isActive = 1"
-            active_rules = self.db.fetch_records(select_rules_query, ())
+            with rule_check_stage_seconds.time(endpoint, 'rules_fetch'):
+                active_rules = rule_set_cache.get(self.db)
+            evaluation = None
             if active_rules:
-                result = False
-                for rule in active_rules:
-                    validate_result = self.__validate_rule(rule, data)
-                    result = result or validate_result
-            
-                message = 'Transaction is suspicious' if result else 'Not a suspicious transaction'
-                res= ResponseDto(True, message, result, 200)
-            else:
-                res = ResponseDto(True, 'No active rules', result, 200)
-            
-            
-            #insert transaction
-            tranx_insert_query = """
-                insert into kd_hk_transactions (sourceAccountNumber, DestinationAccountNumber,
-                 Amount,DestinationBankCode) values (?, ?, ?, ?)
-            """
-            self.db.single_inserts(tranx_insert_query, (data['sourceaccountnumber'], data['destinationaccountnumber'],
-                                                     data['amount'], data['destinationbankcode']))
-            logger.info(f'insert record {data}')
+                with rule_check_stage_seconds.time(endpoint, 'expression_lookup'):
+                    evaluation = ExpressionEvaluation(self.db, active_rules, data['sourceaccountnumber']).wait()
+            return self.__check(endpoint, active_rules, data, evaluation)
+        except Exception as e:
+            logger.error(f"Error occurred during rule check: {e}")
+            return ResponseDto(False, 'An error occured', False, 500)
+
+    async def rule_check_async(self, data, idempotency_key=None) -> ResponseDto:
+        """
+        rule_check for async views: the lookups and duplicates are awaited
+        instead of blocking the worker thread, with the same deadline.
+        """
+        key = self.__idempotency_key(data, idempotency_key)
+        if key is None:
+            return await self.__rule_check_async(data)
+        future, owner = idempotency_cache.begin(key)
+        if not owner:
+            rule_check_replays.inc(current_endpoint())
+            return await idempotency_cache.replay_async(future)
+        claimed, res = await idempotency_cache.claim_async(self.db, key)
+        if res is not None:
+            rule_check_replays.inc(current_endpoint())
+            idempotency_cache.finish(key, future, res)
+            return res
+        try:
+            res = await self.__rule_check_async(data)
             return res
+        finally:
+            keep = self.__complete(res)
+            if claimed:
+                await idempotency_cache.store_async(self.db, key, res, keep)
+            idempotency_cache.finish(key, future, res, keep)
+
+    async def __rule_check_async(self, data) -> ResponseDto:
+        try:
+            endpoint = current_endpoint()
+            data = self.__convert_keys_to_lowercase(data)
+            with rule_check_stage_seconds.time(endpoint, 'rules_fetch'):
+                active_rules = await rule_set_cache.get_async(self.db)
+            evaluation = None
+            if active_rules:
+                with rule_check_stage_seconds.time(endpoint, 'expression_lookup'):
+                    evaluation = await ExpressionEvaluation(self.db, active_rules, data['sourceaccountnumber']).wait_async()
+            return self.__check(endpoint, active_rules, data, evaluation)
         except Exception as e:
             logger.error(f"Error occurred during rule check: {e}")
             return ResponseDto(False, 'An error occured', False, 500)
 
+    def rule_check_batch(self, transactions: list) -> ResponseDto:
+        """
+        Evaluates many transactions with one rules lookup and one expression result
+        lookup. Reports and transactions go through the write-behind queue, which
+        inserts them with executemany.
+
+        Expression results kept in kd_hk_expression_result are read once before
+        any transaction of the batch is inserted, so those rules do not see
+        earlier items of the same batch. Aggregate and velocity rules do.
+        """
+        try:
+            if not isinstance(transactions, list) or not transactions:
+                return ResponseDto(False, 'Invalid request: expected a non-empty list of transactions', None, 400)
+            if len(transactions) > RULE_CHECK_BATCH_MAX_SIZE:
+                return ResponseDto(False, f'Invalid request: batch is limited to {RULE_CHECK_BATCH_MAX_SIZE} transactions', None, 400)
+
+            items = []
+            for transaction in transactions:
+                if isinstance(transaction, dict):
+                    transaction = self.__convert_keys_to_lowercase(transaction)
+                    if all(key in transaction for key in TRANSACTION_KEYS):
+                        items.append(transaction)
+                        continue
+                items.append(None)
+
+            endpoint = current_endpoint()
+            with rule_check_stage_seconds.time(endpoint, 'rules_fetch'):
+                active_rules = rule_set_cache.get(self.db)
+            valid_items = [item for item in items if item is not None]
+            expression_results = {}
+            with rule_check_stage_seconds.time(endpoint, 'expression_lookup'):
+                accounts = [item['sourceaccountnumber'] for item in valid_items]
+                if self.__needs_expression_results(active_rules):
+                    expression_results = expression_result_cache.get_many(self.db, accounts)
+                # one seed query per aggregate or velocity rule for all the batch's accounts, not one per account
+                aggregate_engine.prime_many(self.db, active_rules, accounts)
+                velocity_engine.prime_many(self.db, active_rules, accounts)
+
+            evaluate_started = time.perf_counter()
+            matrix_faults = iter(active_rules.value_matrix.faulted_batch(valid_items))
+
+            verdicts = []
+            report_rows = []
+            transaction_rows = []
+            for index, item in enumerate(items):
+                if item is None:
+                    verdicts.append({
+                        'index': index,
+                        'isSuccessful': False,
+                        'message': 'Invalid transaction: Missing values',
+                        'data': None
+                    })
+                    continue
+
+                account_results = expression_results.get(str(item['sourceaccountnumber']), {})
+                faulted_rules = self.__faulted_rules(active_rules, item, account_results, next(matrix_faults))
+                aggregate_engine.observe(active_rules, item)
+                payload = dumps(item).decode('utf-8')
+                report_rows.extend((rule_id, payload) for rule_id in faulted_rules)
+                transaction_rows.append((item['sourceaccountnumber'], item['destinationaccountnumber'],
+                                         item['amount'], item['destinationbankcode']))
+
+                if not active_rules:
+                    message = 'No active rules'
+                else:
+                    message = 'Transaction is suspicious' if faulted_rules else 'Not a suspicious transaction'
+                verdict = {
+                    'index': index,
+                    'isSuccessful': True,
+                    'message': message,
+                    'data': bool(faulted_rules),
+                    'faultedRules': faulted_rules
+                }
+                score = self.anomaly_engine.score_transaction(item)
+                if score is not None:
+                    verdict['anomaly'] = score.to_dict()
+                verdicts.append(verdict)
+            # per-item aggregate updates and anomaly scoring are interleaved with evaluation, so they are timed as part of it
+            rule_check_stage_seconds.observe(time.perf_counter() - evaluate_started, endpoint, 'evaluate')
+            rule_check_faults.inc(endpoint, amount=len(report_rows))
+            shadow_rule_evaluator.submit(self.db, active_rules.shadow, valid_items)
+
+            with rule_check_stage_seconds.time(endpoint, 'report_insert'):
+                self.write_behind.put_many(REPORT_INSERT_QUERY, report_rows)
+            with rule_check_stage_seconds.time(endpoint, 'transaction_insert'):
+                aggregate_engine.queued(transaction_rows)
+                self.write_behind.put_many(TRANSACTION_INSERT_QUERY, transaction_rows)
+            log_event(logger, logging.INFO, 'transaction_batch_recorded', 'insert %s records from batch of %s',
+                      len(transaction_rows), len(items), faultedRules=len(report_rows))
+
+            return ResponseDto(True, 'Success', verdicts, 200)
+        except Exception as e:
+            logger.error(f"Error occurred during batch rule check: {e}")
+            return ResponseDto(False, 'An error occured', False, 500)
+
+    async def rule_check_batch_async(self, transactions: list) -> ResponseDto:
+        # the batch already reads expression results with one query per 2000 accounts,
+        # so it runs as a whole on the database executor
+        return await self.db.run_in_executor(self.rule_check_batch, transactions)
+
+    def __rule_type(self, is_expression, expression):
+        if not is_expression:
+            return 'ValueCheck'
+        return 'VelocityCheck' if VelocitySpec.parse(expression) is not None else 'ExpressionCheck'
+
     def get_rules(self) -> List[dict]:
         try:
             select_rules_query = "select * from kd_hk_rules with(nolock) where isactive=1"
@@ -255,10 +510,11 @@ class RuleEngine:
                 for rule in active_rules:
                     rule_dict = {}
                     rule_dict['name'] = rule[11]
-                    rule_dict['type'] = 'ExpressionCheck' if rule[2] else 'ValueCheck'
+                    rule_dict['type'] = self.__rule_type(rule[2], rule[5])
                     rule_dict['description'] = rule[9]
                     rule_dict['id'] = rule[0]
                     rule_dict['isactive'] = rule[7]
+                    rule_dict['shadow'] = bool(rule[13]) if len(rule) > 13 else False
                     results.append(rule_dict)
 
             return ResponseDto(True, 'Success', results, 200)
@@ -267,67 +523,351 @@ class RuleEngine:
             logger.error(f'error_trying_to_get_rules {e}')
             return ResponseDto(False, 'An error occured', False, 500)
 
-    def get_report(self) -> List[dict]:
+    def __parse_report_filters(self, args: dict):
+        """
+        Validates the report query string.
+
+        :return: (filters, error) where error is a ResponseDto when the request is invalid.
+        """
+        filters = {'ruleId': None, 'from': None, 'to': None}
         try:
-            select_report_query = """
-                select report.PayloadType, report.PayloadDetails, 
-                report.DateInserted, rules.id, rules.Description, rules.ruleName  
-                from kd_hk_report as report with(nolock)
-                join kd_hk_rules as rules  on report.RuleId = rules.Id 
-                order by report.DateInserted DESC 
-            """
-            # select_report_query = """
-            #     	select report.PayloadType, report.PayloadDetails, 
-	        #         report.DateInserted, rules.id, rules.Description, rules.ruleName  
-	        #         from kd_hk_report as report with(nolock)
-	        #         right join kd_hk_rules as rules  on report.RuleId = rules.Id where rules.IsActive =1
-	        #         order by report.DateInserted DESC 
-            # """
-            select_anomaly_query = """
-                select * from kd_hk_anomalies
-                order by timestamp desc
-            """
-            records = self.db.fetch_records(select_report_query, ())
-            rule_results = []
-            if records:
-                #print(records)
-                for index, record in enumerate(records):
-                    rule_results.append({
-                        'sn': index+1,
-                        'payloadType': record[0] if record[0] else None,
-                        'payloadDetails':  json.loads(record[1]) if record[1] else None,
-                        'date': record[2] if record[2] else None,
-                        'ruleId': record[3] if record[3] else None,
-                        'ruleDescription': record[4] if record[4] else None,
-                        'ruleName': record[5] if record[5] else None
-                    })
-            results = {}
-            results['rules'] = rule_results 
-
-            anomaly_records = self.db.fetch_records(select_anomaly_query, ())
-            anomlay_result = []
-            if anomaly_records:
-                for index, record in enumerate(anomaly_records):
-                    anomlay_result.append({
-                        'sn': index+1,
+            limit = int(args.get('limit') or REPORT_PAGE_DEFAULT_SIZE)
+        except ValueError:
+            return None, ResponseDto(False, 'Invalid request: limit must be a number', None, 400)
+        filters['limit'] = max(1, min(limit, REPORT_PAGE_MAX_SIZE))
+
+        if args.get('ruleId'):
+            try:
+                filters['ruleId'] = int(args['ruleId'])
+            except ValueError:
+                return None, ResponseDto(False, 'Invalid request: ruleId must be a number', None, 400)
+
+        for key in ('from', 'to'):
+            if args.get(key):
+                parsed = None
+                for date_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+                    try:
+                        parsed = datetime.strptime(args[key], date_format)
+                        break
+                    except ValueError:
+                        continue
+                if parsed is None:
+                    return None, ResponseDto(False, f'Invalid request: {key} must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS', None, 400)
+                filters[key] = parsed
+
+        for key in ('rulesCursor', 'anomaliesCursor'):
+            filters[key] = None
+            if args.get(key):
+                try:
+                    filters[key] = self.__decode_cursor(args[key])
+                except (ValueError, TypeError):
+                    return None, ResponseDto(False, f'Invalid request: {key} is not valid', None, 400)
+        return filters, None
+
+    def __encode_cursor(self, date_inserted, record_id):
+        raw = json.dumps([date_inserted.isoformat(), record_id]).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    def __decode_cursor(self, cursor):
+        date_inserted, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(date_inserted), int(record_id)
+
+    def __report_query(self, filters):
+        conditions = []
+        params = []
+        if filters['rulesCursor']:
+            date_inserted, record_id = filters['rulesCursor']
+            conditions.append("(report.DateInserted < ? or (report.DateInserted = ? and report.Id < ?))")
+            params.extend([date_inserted, date_inserted, record_id])
+        if filters['ruleId'] is not None:
+            conditions.append("report.RuleId = ?")
+            params.append(filters['ruleId'])
+        if filters['from']:
+            conditions.append("report.DateInserted >= ?")
+            params.append(filters['from'])
+        if filters['to']:
+            conditions.append("report.DateInserted <= ?")
+            params.append(filters['to'])
+
+        where = f"where {' and '.join(conditions)}" if conditions else ""
+        query = f"""
+            select top (?) report.Id, report.PayloadType, report.PayloadDetails,
+            report.DateInserted, rules.id, rules.Description, rules.ruleName
+            from kd_hk_report as report with(nolock)
+            join kd_hk_rules as rules on report.RuleId = rules.Id
+            {where}
+            order by report.DateInserted DESC, report.Id DESC
+        """
+        return query, [filters['limit']] + params
+
+    def __anomaly_query(self, filters):
+        conditions = []
+        params = []
+        if filters['anomaliesCursor']:
+            timestamp, record_id = filters['anomaliesCursor']
+            conditions.append("(timestamp < ? or (timestamp = ? and id < ?))")
+            params.extend([timestamp, timestamp, record_id])
+        if filters['from']:
+            conditions.append("timestamp >= ?")
+            params.append(filters['from'])
+        if filters['to']:
+            conditions.append("timestamp <= ?")
+            params.append(filters['to'])
+
+        where = f"where {' and '.join(conditions)}" if conditions else ""
+        query = f"""
+            select top (?) id, user_id, alert_type, risk_score, timestamp from kd_hk_anomalies with(nolock)
+            {where}
+            order by timestamp DESC, id DESC
+        """
+        return query, [filters['limit']] + params
+
+    def __report_result(self, filters, records, anomaly_records):
+        rule_results = []
+        next_rules_cursor = None
+        for index, record in enumerate(records or []):
+            rule_results.append({
+                'sn': index+1,
+                'id': record[0],
+                'payloadType': record[1] if record[1] else None,
+                # stored JSON goes out as is, without a decode and re-encode
+                'payloadDetails': RawJson(record[2]) if record[2] else None,
+                'date': record[3] if record[3] else None,
+                'ruleId': record[4] if record[4] else None,
+                'ruleDescription': record[5] if record[5] else None,
+                'ruleName': record[6] if record[6] else None
+            })
+        if records and len(records) == filters['limit']:
+            next_rules_cursor = self.__encode_cursor(records[-1][3], records[-1][0])
+
+        anomlay_result = []
+        next_anomalies_cursor = None
+        for index, record in enumerate(anomaly_records or []):
+            anomlay_result.append({
+                'sn': index+1,
+                'userId': record[1],
+                'alertType': record[2],
+                'riskScore': record[3],
+                'date': record[4]
+            })
+        if anomaly_records and len(anomaly_records) == filters['limit']:
+            next_anomalies_cursor = self.__encode_cursor(anomaly_records[-1][4], anomaly_records[-1][0])
+
+        results = {
+            'rules': rule_results,
+            'anomalies': anomlay_result,
+            'nextRulesCursor': next_rules_cursor,
+            'nextAnomaliesCursor': next_anomalies_cursor
+        }
+        return ResponseDto(True, 'Success', results, 200)
+
+    def get_report(self, args: dict = None) -> ResponseDto:
+        """
+        Returns one page of reports and one page of anomalies, newest first.
+
+        Pages are keyset-paginated on (DateInserted, Id); pass back nextRulesCursor
+        and nextAnomaliesCursor as rulesCursor and anomaliesCursor to get the next page.
+        """
+        try:
+            filters, error = self.__parse_report_filters(args or {})
+            if error:
+                return error
+
+            rules_query, rules_params = self.__report_query(filters)
+            records = self.db.fetch_records(rules_query, tuple(rules_params))
+            anomaly_records = []
+            if filters['ruleId'] is None:
+                anomaly_query, anomaly_params = self.__anomaly_query(filters)
+                anomaly_records = self.db.fetch_records(anomaly_query, tuple(anomaly_params))
+            return self.__report_result(filters, records, anomaly_records)
+        except Exception as e:
+            logger.error(f'error_trying_to_get_report {e}')
+            return ResponseDto(False, 'An error occured', False, 500)
+
+    async def get_report_async(self, args: dict = None) -> ResponseDto:
+        """
+        get_report for async views, reading the report and anomaly pages concurrently.
+        """
+        try:
+            filters, error = self.__parse_report_filters(args or {})
+            if error:
+                return error
+
+            rules_query, rules_params = self.__report_query(filters)
+            lookups = [self.db.fetch_records_async(rules_query, tuple(rules_params))]
+            if filters['ruleId'] is None:
+                anomaly_query, anomaly_params = self.__anomaly_query(filters)
+                lookups.append(self.db.fetch_records_async(anomaly_query, tuple(anomaly_params)))
+            results = await asyncio.gather(*lookups)
+            return self.__report_result(filters, results[0], results[1] if len(results) > 1 else [])
+        except Exception as e:
+            logger.error(f'error_trying_to_get_report {e}')
+            return ResponseDto(False, 'An error occured', False, 500)
+
+    def export_report(self, args: dict = None):
+        """
+        Streams every matching report (or anomaly, with type=anomalies) as a JSON array.
+
+        Rows are read in keyset pages of REPORT_EXPORT_CHUNK_SIZE, each on a
+        connection that goes back to the pool before the next page, so a long
+        export never holds one while the client reads. Stored PayloadDetails
+        JSON is copied through without being decoded, so memory does not grow
+        with the size of the table.
+
+        :return: (generator, error) where error is a ResponseDto when the request is invalid.
+        """
+        filters, error = self.__parse_report_filters(args or {})
+        if error:
+            return None, error
+
+        export_anomalies = (args or {}).get('type') == 'anomalies'
+        filters['limit'] = REPORT_EXPORT_CHUNK_SIZE
+        if export_anomalies:
+            page_query, cursor_key, date_index = self.__anomaly_query, 'anomaliesCursor', 4
+        else:
+            page_query, cursor_key, date_index = self.__report_query, 'rulesCursor', 3
+        filters[cursor_key] = None
+
+        def records():
+            while True:
+                query, params = page_query(filters)
+                # strict, so a failed page ends the stream with an error instead of a truncated array
+                page = self.db.fetch_records(query, tuple(params), strict=True)
+                yield from page
+                if len(page) < filters['limit']:
+                    return
+                filters[cursor_key] = (page[-1][date_index], page[-1][0])
+
+        def generate():
+            yield b'['
+            first = True
+            for record in records():
+                if export_anomalies:
+                    item = dumps({
+                        'id': record[0],
                         'userId': record[1],
                         'alertType': record[2],
                         'riskScore': record[3],
                         'date': record[4]
                     })
-            
-            results['anomalies'] = anomlay_result
+                else:
+                    item = dumps({
+                        'id': record[0],
+                        'payloadType': record[1],
+                        'date': record[3],
+                        'ruleId': record[4],
+                        'ruleDescription': record[5],
+                        'ruleName': record[6],
+                        'payloadDetails': RawJson(record[2]) if record[2] else None
+                    })
+                yield item if first else b',' + item
+                first = False
+            yield b']'
 
-            return ResponseDto(True, 'Success', results, 200)
+        return generate(), None
+
+    def get_report_summary(self, args: dict = None) -> ResponseDto:
+        """
+        Hits per rule per hour or day and the source accounts with the most
+        hits, read from the report rollups, so the cost depends on the range
+        asked for and not on how many kd_hk_report rows exist.
+
+        Query string: bucket (hour or day), last (buckets up to the current one),
+        ruleId and top (accounts). Hits are as of the last rollup flush.
+        """
+        try:
+            args = args or {}
+            bucket = args.get('bucket') or 'hour'
+            if bucket not in BUCKETS:
+                return ResponseDto(False, f"Invalid request: bucket must be one of {', '.join(BUCKETS)}", None, 400)
+            try:
+                last = int(args.get('last') or REPORT_SUMMARY_DEFAULT_BUCKETS[bucket])
+                top = int(args.get('top') or 10)
+                rule_id = int(args['ruleId']) if args.get('ruleId') else None
+            except ValueError:
+                return ResponseDto(False, 'Invalid request: last, top and ruleId must be numbers', None, 400)
+            last = max(1, min(last, REPORT_SUMMARY_MAX_BUCKETS))
+            top = max(0, min(top, REPORT_SUMMARY_MAX_TOP_ACCOUNTS))
+
+            step = timedelta(hours=1) if bucket == 'hour' else timedelta(days=1)
+            starts = [bucket_start(datetime.now(), bucket) - step * index for index in range(last - 1, -1, -1)]
+            # account hits are rolled up per day, so they cover whole days
+            accounts_since = bucket_start(starts[0], 'day')
+            rule_filter = ' and RuleId = ?' if rule_id is not None else ''
+            rule_params = (rule_id,) if rule_id is not None else ()
+
+            records = self.db.fetch_records(REPORT_SUMMARY_QUERY.format(rule_filter=rule_filter),
+                                            (bucket, starts[0], *rule_params))
+            accounts = []
+            if top:
+                accounts = self.db.fetch_records(REPORT_TOP_ACCOUNTS_QUERY.format(rule_filter=rule_filter),
+                                                 (top, accounts_since, *rule_params))
+            if records is None or accounts is None:
+                return ResponseDto(False, 'An error occured', False, 500)
+
+            hits = {}  # rule id -> {bucket start: hits}
+            for record_rule_id, start, count in records:
+                hits.setdefault(record_rule_id, {})[start] = int(count)
+            summary = {
+                'bucket': bucket,
+                'since': starts[0],
+                'rules': [{
+                    'ruleId': record_rule_id,
+                    'hits': sum(rule_hits.values()),
+                    'buckets': [{'start': start, 'hits': rule_hits.get(start, 0)} for start in starts]
+                } for record_rule_id, rule_hits in sorted(hits.items())],
+                'topAccountsSince': accounts_since,
+                'topAccounts': [{'sourceAccountNumber': account, 'hits': int(count)} for account, count in accounts]
+            }
+            return ResponseDto(True, 'Success', summary, 200)
         except Exception as e:
-            logger.error(f'error_trying_to_get_report {e}')
+            logger.error(f'error_trying_to_get_report_summary {e}')
             return ResponseDto(False, 'An error occured', False, 500)
 
+    def __set_velocity_type_rule(self, dataRequest: dict, velocity: VelocitySpec):
+        """
+        Saves a velocity rule: its spec as the expression and its limit as checkValue.
+        Velocity rules are evaluated in-process, so they need no expression results or trigger.
+        """
+        if not self.__keys_exist(dataRequest, ['checkValue']):
+            return ResponseDto(False, 'Invalid request: Missing or empty values', None, 400)
+        try:
+            check_value = float(dataRequest['checkValue'])
+        except (ValueError, TypeError):
+            return ResponseDto(False, 'Invalid data type for checkValue. Expected float.', None, 400)
+
+        table_columns = self.__get_table_columns('kd_hk_transactions')
+        if not table_columns or dataRequest['dataPoint'] not in table_columns:
+            return ResponseDto(False, 'dataPoint is not mapped to the table', None, 400)
+        if velocity.column is not None and velocity.column not in {name.lower() for name in table_columns}:
+            return ResponseDto(False, f'{velocity.column} is not mapped to the table', None, 400)
+
+        shadow_column, shadow_value, shadow = self.__shadow_fields(dataRequest)
+        insert_rule_query = f"""
+            insert into kd_hk_rules (dataPoint, isExpression, conditional, checkValue, CheckValueDatatype, expression,
+             description, ruleName, DataPointDataType{shadow_column})
+            values(?, 1, ?, ?, 'float', ?, ?, ?, 'float'{shadow_value})
+        """
+        res = self.db.single_inserts(insert_rule_query, (
+            dataRequest['dataPoint'], dataRequest['conditional'], str(check_value), velocity.expression,
+            dataRequest.get('description') or '', dataRequest.get('name') or '', *shadow))
+        if res is None:
+            return ResponseDto(False, 'Error creating rule. Please try again later.', None, 400)
+
+        rule_set_cache.invalidate()
+        return ResponseDto(True, 'Success', None, 200)
+
     def set_expression_type_rule(self, dataRequest: dict):
         try:
             if not self.__keys_exist(dataRequest, ['dataPoint', 'expression', 'conditional']):
                 return ResponseDto(False, 'Invalid request: Missing or empty values', None, 400)
 
+            velocity = VelocitySpec.parse(dataRequest['expression'])
+            if velocity is not None:
+                if dataRequest['conditional'] not in self.conditional_map:
+                    return ResponseDto(False, f"Unsupported conditional: {dataRequest['conditional']}", None, 400)
+                return self.__set_velocity_type_rule(dataRequest, velocity)
+
             dataPoint = dataRequest['dataPoint']
             description = dataRequest['description']
             conditional = dataRequest['conditional']
@@ -360,7 +900,7 @@ class RuleEngine:
             
             table_columns = self.__get_table_columns('kd_hk_transactions')
 
-            if dataPoint not in table_columns:
+            if not table_columns or dataPoint not in table_columns:
                 return ResponseDto(False, 'dataPoint is not mapped to the table', None, 400)
 
             data_point_data_type = table_columns[dataPoint]
@@ -375,15 +915,23 @@ class RuleEngine:
             
             trigger_name = f'{re.sub(r"\s+", "_", ruleName)}_{random.randint(1, 1000)}'
             # save rule in db
-            insert_rule_query = """
-                insert into kd_hk_rules  (dataPoint, isExpression, conditional, expression, triggerName, description, ruleName, DataPointDataType)
-                values(?, 1, ?, ?, ?, ?, ?, ?)
+            shadow_column, shadow_value, shadow = self.__shadow_fields(dataRequest)
+            insert_rule_query = f"""
+                insert into kd_hk_rules  (dataPoint, isExpression, conditional, expression, triggerName, description, ruleName, DataPointDataType{shadow_column})
+                values(?, 1, ?, ?, ?, ?, ?, ?{shadow_value})
             """
-            self.db.single_inserts(insert_rule_query, (dataPoint, conditional, expression, trigger_name, description, ruleName, data_point_data_type))
+            self.db.single_inserts(insert_rule_query, (dataPoint, conditional, expression, trigger_name, description, ruleName, data_point_data_type, *shadow))
             inserted_rule = self.db.fetch_record(query=f'select id from kd_hk_rules where triggerName=?', params=(trigger_name,))
 
             if inserted_rule is None:
                 return ResponseDto(False, 'Error trying to save the rule', None, 400)
+            rule_set_cache.invalidate()
+
+            if AggregateSpec.parse(expression) is not None:
+                # the aggregate engine keeps this rule up to date in-process,
+                # so it needs neither seeded results nor a trigger on kd_hk_transactions
+                logger.info(f'rule {inserted_rule[0]} is served by the aggregate engine')
+                return ResponseDto(True, 'Success', None, 200)
             
             # run the script and get the first result and insert to the expression result db
             test_expression = user_expression.replace('select', 'select sourceaccountnumber, ') + 'group by sourceaccountnumber'
@@ -397,58 +945,15 @@ class RuleEngine:
                     values (?, ?, ?, ?)
                 """
                 self.db.multiple_inserts(insert_query, data)
+            # cached accounts do not have this rule's results yet
+            expression_result_cache.clear()
+
+            if EXPRESSION_RECOMPUTE_ENABLED:
+                # the ExpressionRecomputeScheduler keeps the results current from here on
+                return ResponseDto(True, 'Success', None, 200)
 
             # -- Enable the trigger and set trigger
-            str_trigger_name = '\''+trigger_name+'\''
-            create_trigger_query = f"""
-                CREATE TRIGGER {trigger_name}
-                ON {table_name}
-                AFTER INSERT
-                AS
-                BEGIN
-                    DECLARE @SourceAccountNumber NVARCHAR(10);
-                    DECLARE @ResultValue NVARCHAR(MAX);
-                    DECLARE @RuleId INT;
-                    DECLARE @ExistingRuleCount INT;
-
-                    DECLARE cur CURSOR FOR
-                    SELECT SourceAccountNumber FROM inserted;
-
-                    OPEN cur;
-                    FETCH NEXT FROM cur INTO @SourceAccountNumber;
-
-                    WHILE @@FETCH_STATUS = 0
-                    BEGIN
-                        -- Construct the result value for each row
-                        SET @ResultValue = ({user_expression} and sourceaccountnumber= @SourceAccountNumber);
-
-                        -- Retrieve RuleId
-                        SELECT @RuleId = Id FROM kd_hk_rules WHERE TriggerName = {str_trigger_name};
-
-                        -- Check if the rule already exists in the result table
-                        SELECT @ExistingRuleCount = COUNT(*) FROM kd_hk_expression_result 
-                        WHERE RuleId = @RuleId AND SourceAccountNumber=@SourceAccountNumber;
-
-                        -- If the rule exists, update, otherwise insert
-                        IF @ExistingRuleCount > 0
-                        BEGIN
-                            UPDATE kd_hk_expression_result
-                            SET ResultValue = CAST(@ResultValue AS NVARCHAR(MAX)), DateTimeUpdated = GETDATE()
-                            WHERE RuleId = @RuleId AND SourceAccountNumber=@SourceAccountNumber;
-                        END
-                        ELSE
-                        BEGIN
-                            INSERT INTO kd_hk_expression_result (RuleId, ResultValue, ResultDataType, SourceAccountNumber)
-                            VALUES (@RuleId, CAST(@ResultValue AS NVARCHAR(MAX)), '', @SourceAccountNumber);
-                        END
-
-                        FETCH NEXT FROM cur INTO @SourceAccountNumber;
-                    END;
-
-                    CLOSE cur;
-                    DEALLOCATE cur;
-                END;
-            """
+            create_trigger_query = create_trigger_ddl(trigger_name, expression, table_name)
             #logger.info(create_trigger_query)
             self.db.single_insert_no_param(create_trigger_query)
 
@@ -472,7 +977,37 @@ class RuleEngine:
             logger.error(f'error_set_expression_type_rule {e}')
             return ResponseDto(False, 'An error occured', False, 500) 
 
-    #every minute, get all active rules with triggernames and check if they exists
+    def get_shadow_rules(self) -> ResponseDto:
+        """
+        :return: The active shadow rules with the hits and evaluation cost every worker has flushed for them.
+        """
+        try:
+            active_rules = rule_set_cache.get(self.db)
+            stats = load_stats(self.db)
+            results = [{
+                'id': rule.id,
+                'name': rule.name,
+                'type': self.__rule_type(rule.is_expression, rule.expression),
+                **stats.get(rule.id, ShadowRuleStats()).to_dict()
+            } for rule in active_rules.shadow]
+            return ResponseDto(True, 'Success', results, 200)
+        except Exception as e:
+            logger.error(f'error_trying_to_get_shadow_rules {e}')
+            return ResponseDto(False, 'An error occured', False, 500)
+
+    def promote_rule(self, ruleId):
+        # moves a shadow rule onto the verdict path
+        try:
+            res = self.db.single_inserts("update kd_hk_rules set IsShadow = 0 where Id = ?", (ruleId,))
+            if res != 0:
+                return ResponseDto(False, 'Error promoting the rule. Please try again later.', None, 400)
+            rule_set_cache.invalidate()
+            if shadow_rule_evaluator.store is not None:
+                shadow_rule_evaluator.store.forget(ruleId)
+            return ResponseDto(True, 'Success', None, 200)
+        except Exception as err:
+            logger.error(f'error_trying_to_promote_rule {err}')
+            return ResponseDto(False, 'An error occured', False, 500)
 
     def disable_rule(self, ruleId):
         try:
@@ -481,6 +1016,7 @@ class RuleEngine:
                 where Id = ? 
             """
             self.db.single_inserts(deactivate_rule_query, (ruleId))
+            rule_set_cache.invalidate()
             return ResponseDto(True, 'Success', None, 200)
         except Exception as err:
             logger.error(f'error_trying_to_get_rules {err}')
@@ -493,6 +1029,7 @@ class RuleEngine:
                 where Id = ? 
             """
             self.db.single_inserts(activate_rule_query, (ruleId))
+            rule_set_cache.invalidate()
             return ResponseDto(True, 'Success', None, 200)
         except Exception as err:
             logger.error(f'error_trying_to_get_rules {err}')
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timezone
+
+from src.config import SCHEMA_CACHE_TTL_SECONDS
+from src.utils import CONDITIONAL_MAP, TYPE_VALIDATION_MAP
+
+
+class TableSchema:
+    """
+    Column metadata of one table with a validator per column precomputed for
+    rule setup, plus the ETag/Last-Modified pair served on /datapoints.
+    """
+    __slots__ = ('table_name', 'columns', 'validators', 'etag', 'last_modified')
+
+    def __init__(self, table_name, columns, last_modified=None, previous=None):
+        self.table_name = table_name
+        self.columns = columns
+        # character columns accept any checkValue, others must convert with their type's converter
+        self.validators = {
+            name: None if 'char' in data_type else TYPE_VALIDATION_MAP.get(data_type)
+            for name, data_type in columns.items()
+        }
+        signature = repr((sorted(columns.items()), list(CONDITIONAL_MAP))).encode()
+        self.etag = hashlib.sha1(signature).hexdigest()
+        if previous is not None and previous.etag == self.etag:
+            self.last_modified = previous.last_modified
+        else:
+            self.last_modified = last_modified or datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class SchemaCache:
+    """
+    information_schema lookups cached per table for SCHEMA_CACHE_TTL_SECONDS,
+    or until invalidate() is called after a schema change.
+    """
+
+    def __init__(self, ttl=SCHEMA_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._tables = {}  # table_name -> (loaded_at, TableSchema)
+        self._lock = threading.Lock()
+
+    def get(self, db, table_name):
+        entry = self._tables.get(table_name)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+
+        with self._lock:
+            entry = self._tables.get(table_name)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            rows = db.get_columns_of_table(table_name)
+            if not rows:
+                # keep serving the last known schema rather than failing while the database is unreachable
+                return entry[1] if entry is not None else None
+            previous = entry[1] if entry is not None else None
+            schema = TableSchema(table_name, {row[0]: row[1] for row in rows}, previous=previous)
+            self._tables[table_name] = (time.monotonic(), schema)
+            return schema
+
+    def invalidate(self, table_name=None):
+        # entries are only marked stale so an unchanged schema keeps its Last-Modified
+        with self._lock:
+            for name, (_, schema) in list(self._tables.items()):
+                if table_name is None or name == table_name:
+                    self._tables[name] = (0.0, schema)
+
+
+schema_cache = SchemaCache()
@@ -0,0 +1,284 @@
+import atexit
+import fcntl
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.config import SHADOW_RULE_MAX_PENDING, SHADOW_RULE_WORKERS
+from src.infra.metrics import registry
+from src.services.aggregate_engine import aggregate_engine
+from src.services.expression_result_cache import expression_result_cache
+from src.services.velocity_engine import velocity_engine
+
+logger = logging.getLogger(__name__)
+
+shadow_rule_evaluations = registry.counter(
+    'hawkeye_shadow_rule_evaluations_total', 'Shadow rule evaluations by outcome (hit, miss, error).',
+    ('rule', 'outcome'))
+shadow_rule_seconds = registry.histogram(
+    'hawkeye_shadow_rule_seconds', 'Time spent evaluating a shadow rule, including its lookups.', ('rule',))
+shadow_rule_dropped = registry.counter(
+    'hawkeye_shadow_rule_dropped_total', 'Transactions not shadow evaluated because the backlog was full.')
+shadow_rule_stats_flush_failures = registry.counter(
+    'hawkeye_shadow_rule_stats_flush_failures_total',
+    'Shadow rule stats flushes that failed and were kept for the next one.')
+
+# rows are created with zeros first and then added to, so a failure at either step can be retried as a whole
+STATS_INSERT_QUERY = """
+    insert into kd_hk_shadow_rule_stats (RuleId, Evaluations, Hits, Errors, TotalSeconds, MaxSeconds)
+    select ?, 0, 0, 0, 0, 0
+    where not exists (select 1 from kd_hk_shadow_rule_stats where RuleId = ?)
+"""
+STATS_UPDATE_QUERY = """
+    update kd_hk_shadow_rule_stats
+    set Evaluations = Evaluations + ?, Hits = Hits + ?, Errors = Errors + ?, TotalSeconds = TotalSeconds + ?,
+        MaxSeconds = case when MaxSeconds < ? then ? else MaxSeconds end
+    where RuleId = ?
+"""
+STATS_QUERY = """
+    select RuleId, Evaluations, Hits, Errors, TotalSeconds, MaxSeconds from kd_hk_shadow_rule_stats with(nolock)
+"""
+STATS_DELETE_QUERY = "delete from kd_hk_shadow_rule_stats where RuleId = ?"
+
+
+class ShadowRuleStats:
+    __slots__ = ('evaluations', 'hits', 'errors', 'seconds', 'max_seconds')
+
+    def __init__(self, evaluations=0, hits=0, errors=0, seconds=0.0, max_seconds=0.0):
+        self.evaluations = evaluations
+        self.hits = hits
+        self.errors = errors
+        self.seconds = seconds
+        self.max_seconds = max_seconds
+
+    def add(self, other):
+        self.evaluations += other.evaluations
+        self.hits += other.hits
+        self.errors += other.errors
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+
+    def to_dict(self):
+        return {
+            'evaluations': self.evaluations,
+            'hits': self.hits,
+            'hitRate': self.hits / self.evaluations if self.evaluations else 0.0,
+            'errors': self.errors,
+            'meanMs': round(self.seconds / self.evaluations * 1000, 3) if self.evaluations else 0.0,
+            'maxMs': round(self.max_seconds * 1000, 3)
+        }
+
+
+def load_stats(db):
+    """
+    :return: {rule id: ShadowRuleStats} as flushed by every process.
+    :raises DatabaseError: If the stats could not be read.
+    """
+    return {row[0]: ShadowRuleStats(int(row[1]), int(row[2]), int(row[3]), float(row[4]), float(row[5]))
+            for row in db.fetch_records(STATS_QUERY, (), strict=True)}
+
+
+class ShadowRuleStatsStore:
+    """
+    Shadow rule evaluations, hits, errors and cost, kept in
+    kd_hk_shadow_rule_stats so every worker and host adds to the same totals
+    and they survive restarts.
+
+    Evaluations are counted in memory and added to the table every
+    `interval` seconds. Flushes of the processes on a host are serialised by
+    a lock file, so two of them never create the same row.
+    """
+
+    def __init__(self, db, interval=10.0, lock_path=None):
+        self.db = db
+        self.interval = interval
+        self.lock_path = lock_path
+
+        self._deltas = {}  # rule id -> ShadowRuleStats not flushed yet
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='shadow-rule-stats', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, rule_id, outcome, elapsed):
+        """
+        :param outcome: 'hit', 'miss' or 'error'.
+        :param elapsed: Seconds spent evaluating the rule.
+        """
+        with self._lock:
+            stats = self._deltas.get(rule_id)
+            if stats is None:
+                stats = self._deltas[rule_id] = ShadowRuleStats()
+            stats.evaluations += 1
+            stats.hits += outcome == 'hit'
+            stats.errors += outcome == 'error'
+            stats.seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def pending(self):
+        return len(self._deltas)
+
+    def forget(self, rule_id):
+        """
+        Drops a promoted rule's stats, so it starts from zero if it is shadowed again.
+        """
+        with self._lock:
+            self._deltas.pop(rule_id, None)
+        self.db.single_inserts(STATS_DELETE_QUERY, (rule_id,))
+
+    def _acquire(self):
+        if not self.lock_path:
+            return -1
+        lock_file = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _release(self, lock_file):
+        if lock_file != -1:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            os.close(lock_file)
+
+    def _apply(self, deltas):
+        if self.db.multiple_inserts(STATS_INSERT_QUERY, [(rule_id, rule_id) for rule_id in deltas]) == -1:
+            return False
+        rows = [(stats.evaluations, stats.hits, stats.errors, stats.seconds, stats.max_seconds, stats.max_seconds,
+                 rule_id) for rule_id, stats in deltas.items()]
+        return self.db.multiple_inserts(STATS_UPDATE_QUERY, rows) != -1
+
+    def _restore(self, deltas):
+        with self._lock:
+            for rule_id, stats in deltas.items():
+                current = self._deltas.get(rule_id)
+                if current is None:
+                    self._deltas[rule_id] = stats
+                else:
+                    current.add(stats)
+
+    def flush(self):
+        """
+        Adds the counted evaluations to kd_hk_shadow_rule_stats. Counts that
+        could not be written are kept and retried on the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+            if not deltas:
+                return
+
+            lock_file = self._acquire()
+            try:
+                if not self._apply(deltas):
+                    shadow_rule_stats_flush_failures.inc()
+                    self._restore(deltas)
+            finally:
+                self._release(lock_file)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing shadow rule stats: {e}")
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self.flush()
+
+
+class ShadowRuleEvaluator:
+    """
+    Evaluates shadow rules on a small background pool after the verdict has
+    been returned, recording their hits and cost per rule instead of writing
+    kd_hk_report rows. Transactions are dropped, and counted, rather than
+    queued without bound when the pool falls behind.
+
+    The per-rule totals go to `store`, a ShadowRuleStatsStore, once one is
+    attached; until then only the metrics are recorded.
+    """
+
+    def __init__(self, max_workers=SHADOW_RULE_WORKERS, max_pending=SHADOW_RULE_MAX_PENDING):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shadow-rules')
+        self.store = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, db, rules, transactions):
+        """
+        :param rules: The rule set's shadow rules.
+        :param transactions: Transactions with lowercased keys, in the order they were checked.
+        """
+        if not rules or not transactions:
+            return
+        with self._lock:
+            if self._pending >= self.max_pending:
+                shadow_rule_dropped.inc()
+                return
+            self._pending += 1
+        # before the transactions are queued for insert, so aggregate seeds made later leave them out
+        checked_at = time.time()
+        self.executor.submit(self._evaluate_all, db, rules, transactions, checked_at)
+
+    def _evaluate_all(self, db, rules, transactions, checked_at):
+        try:
+            for data in transactions:
+                self._evaluate(db, rules, data, checked_at)
+        except Exception as e:
+            logger.error(f"Error evaluating shadow rules: {e}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _evaluate(self, db, rules, data, checked_at):
+        account = data['sourceaccountnumber']
+        expression_results = None
+        try:
+            # off the request path, so the windows are seeded here instead of by the verdict path's primes
+            velocity_engine.prime_many(db, rules, [account], as_of=checked_at)
+            primed = True
+        except Exception as e:
+            logger.error(f"Error seeding shadow velocity windows: {e}")
+            primed = False
+        for rule in rules:
+            started = time.perf_counter()
+            outcome = 'miss'
+            try:
+                if rule.velocity is not None:
+                    if not primed:
+                        raise RuntimeError('velocity window not seeded')
+                    faulted = rule.faulted_by(velocity_engine.observe(rule, data, now=checked_at))
+                else:
+                    rule_result = None
+                    if rule.aggregate is not None:
+                        rule_result = aggregate_engine.value(db, rule, account, as_of=checked_at)
+                    elif rule.is_expression:
+                        if expression_results is None:
+                            expression_results = expression_result_cache.get(db, account)
+                        rule_result = expression_results.get(rule.id)
+                    faulted = rule.data_point in data and rule.faulted_by(data[rule.data_point], rule_result)
+                if faulted:
+                    outcome = 'hit'
+            except Exception:
+                outcome = 'error'
+            elapsed = time.perf_counter() - started
+            self._record(rule.id, outcome, elapsed)
+        # after evaluating, as the verdict path does, so the transaction is not counted against itself
+        aggregate_engine.observe(rules, data)
+
+    def _record(self, rule_id, outcome, elapsed):
+        shadow_rule_evaluations.inc(str(rule_id), outcome)
+        shadow_rule_seconds.observe(elapsed, str(rule_id))
+        if self.store is not None:
+            self.store.record(rule_id, outcome, elapsed)
+
+    def pending(self):
+        return self._pending
+
+
+shadow_rule_evaluator = ShadowRuleEvaluator()
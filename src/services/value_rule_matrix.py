@@ -0,0 +1,180 @@
+import logging
+
+import numpy as np
+
+from src.infra.structured_logging import log_event
+from src.utils import TYPE_VALIDATION_MAP
+
+logger = logging.getLogger(__name__)
+
+GREATER_THAN, LESS_THAN, EQUAL_TO, GREATER_THAN_OR_EQUAL_TO, LESS_THAN_OR_EQUAL_TO, NOT_EQUAL_TO = range(6)
+
+OPERATOR_CODES = {
+    "GreaterThan": GREATER_THAN,
+    "LessThan": LESS_THAN,
+    "EqualTo": EQUAL_TO,
+    "GreaterThanOrEqualTo": GREATER_THAN_OR_EQUAL_TO,
+    "LessThanOrEqualTo": LESS_THAN_OR_EQUAL_TO,
+    "NotEqualTo": NOT_EQUAL_TO
+}
+
+# data types whose values compare the same once mapped to float64
+NUMERIC_CONVERTERS = {
+    'float': lambda v: v,
+    'int': lambda v: float(v),
+    'datetime': lambda v: v.timestamp(),
+}
+
+
+class DataPointColumns:
+    """
+    Threshold index of every value rule on one data point and data type.
+
+    Each operator keeps its thresholds sorted next to their rule ids, so the
+    faulted rules of a value are a prefix, a suffix or (EqualTo) a run found
+    by binary search. The work per transaction is a few searchsorted calls
+    plus the faulted rules themselves, whatever the total rule count.
+
+    Thresholds are a plain float64 array, so a RuleSnapshot can store them
+    as they are and every worker searches the same mapped copy. Rule ids are
+    held as a list, as slicing one is several times cheaper per faulted rule
+    than converting a slice of an int64 array.
+    """
+    __slots__ = ('data_point', 'data_type', 'converter', 'to_float', 'size', 'ranges')
+
+    def __init__(self, data_point, data_type, ranges):
+        """
+        :param ranges: (operator code, sorted float64 thresholds, rule ids) per operator.
+        """
+        self.data_point = data_point
+        self.data_type = data_type
+        self.converter = TYPE_VALIDATION_MAP[data_type]
+        self.to_float = NUMERIC_CONVERTERS[data_type]
+        self.ranges = [(code, thresholds, np.asarray(rule_ids).tolist()) for code, thresholds, rule_ids in ranges]
+        self.size = sum(len(rule_ids) for _, _, rule_ids in self.ranges)
+
+    @classmethod
+    def from_rules(cls, data_point, data_type, rules):
+        to_float = NUMERIC_CONVERTERS[data_type]
+        by_code = {}
+        for rule in rules:
+            by_code.setdefault(OPERATOR_CODES[rule.conditional], []).append((to_float(rule.threshold), rule.id))
+
+        ranges = []
+        for code, entries in sorted(by_code.items()):
+            entries.sort()
+            thresholds = np.array([threshold for threshold, _ in entries], dtype=np.float64)
+            ranges.append((code, thresholds, [rule_id for _, rule_id in entries]))
+        return cls(data_point, data_type, ranges)
+
+    def collect(self, values, present, faulted):
+        """
+        Appends the faulted rule ids of every present value to its row in faulted.
+
+        :param values: float64 array with one value per transaction.
+        :param present: Boolean array marking values that were supplied and converted.
+        :param faulted: One list per transaction, extended in place.
+        """
+        rows = np.flatnonzero(present)
+        if not rows.size:
+            return
+        x = values[rows]
+        comparable = (~np.isnan(x)).tolist()
+        rows = rows.tolist()
+
+        for code, thresholds, rule_ids in self.ranges:
+            if code in (EQUAL_TO, NOT_EQUAL_TO):
+                lows = np.searchsorted(thresholds, x, 'left').tolist()
+                highs = np.searchsorted(thresholds, x, 'right').tolist()
+                for row, low, high, ok in zip(rows, lows, highs, comparable):
+                    if code == EQUAL_TO:
+                        faulted[row].extend(rule_ids[low:high])
+                    elif ok:
+                        faulted[row].extend(rule_ids[:low])
+                        faulted[row].extend(rule_ids[high:])
+                    else:
+                        # NaN is unequal to everything and compares false otherwise
+                        faulted[row].extend(rule_ids)
+                continue
+
+            side = 'left' if code in (GREATER_THAN, LESS_THAN_OR_EQUAL_TO) else 'right'
+            cuts = np.searchsorted(thresholds, x, side).tolist()
+            for row, cut, ok in zip(rows, cuts, comparable):
+                if not ok:
+                    continue
+                if code in (GREATER_THAN, GREATER_THAN_OR_EQUAL_TO):
+                    # thresholds below (or equal to) the value
+                    faulted[row].extend(rule_ids[:cut])
+                else:
+                    faulted[row].extend(rule_ids[cut:])
+
+
+class ValueRuleMatrix:
+    """
+    Value-type rules compiled into a threshold index per data point, so a
+    transaction or a whole batch is checked with vectorised binary searches
+    instead of one Python call per rule.
+
+    Only rules whose data type maps onto float64 are compiled; `remaining`
+    holds the rules that still need the per-rule path.
+    """
+
+    def __init__(self, rules):
+        groups = {}
+        self.remaining = []
+        for rule in rules:
+            to_float = NUMERIC_CONVERTERS.get(rule.data_type)
+            if (rule.is_expression or to_float is None or rule.conditional not in OPERATOR_CODES
+                    or np.isnan(to_float(rule.threshold))):
+                self.remaining.append(rule)
+                continue
+            groups.setdefault((rule.data_point, rule.data_type), []).append(rule)
+
+        self.columns = [
+            DataPointColumns.from_rules(data_point, data_type, group)
+            for (data_point, data_type), group in groups.items()
+        ]
+
+    @classmethod
+    def from_columns(cls, columns, remaining):
+        """
+        :param columns: Already built DataPointColumns, e.g. read from a RuleSnapshot.
+        :param remaining: The rules that are not in the columns.
+        """
+        matrix = cls.__new__(cls)
+        matrix.columns = list(columns)
+        matrix.remaining = list(remaining)
+        return matrix
+
+    def __len__(self):
+        return sum(column.size for column in self.columns)
+
+    def _values(self, column, transactions):
+        values = np.full(len(transactions), np.nan, dtype=np.float64)
+        present = np.zeros(len(transactions), dtype=bool)
+        for index, data in enumerate(transactions):
+            if column.data_point not in data:
+                log_event(logger, logging.WARNING, 'data_point_missing',
+                          "Data column '%s' not present in the request", column.data_point)
+                continue
+            try:
+                values[index] = column.to_float(column.converter(data[column.data_point]))
+                present[index] = True
+            except (ValueError, TypeError) as e:
+                log_event(logger, logging.ERROR, 'rule_comparison_failed',
+                          "Invalid data type for rule comparison: %s", e, dataPoint=column.data_point)
+        return values, present
+
+    def faulted_batch(self, transactions):
+        """
+        :param transactions: Lower-cased transaction dicts.
+        :return: One list of faulted rule ids per transaction.
+        """
+        faulted = [[] for _ in transactions]
+        for column in self.columns:
+            values, present = self._values(column, transactions)
+            column.collect(values, present, faulted)
+        return faulted
+
+    def faulted(self, data):
+        return self.faulted_batch([data])[0]
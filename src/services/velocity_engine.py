@@ -0,0 +1,273 @@
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+from src.config import VELOCITY_BUCKETS, VELOCITY_HLL_PRECISION, VELOCITY_MAX_BYTES, VELOCITY_STATE_TTL_SECONDS
+from src.services.aggregate_engine import SEED_CHUNK_SIZE, TRANSACTION_COLUMNS, aggregate_engine
+
+HASH_MASK = (1 << 64) - 1
+# 2^-rank for every register value, so an estimate is one vectorised lookup
+INVERSE_POWERS = np.array([2.0 ** -rank for rank in range(66)])
+# memory a window takes besides its buckets: the object, the array headers, the key and the index entry
+WINDOW_OVERHEAD_BYTES = 600
+
+
+def _hll_alpha(registers):
+    if registers == 16:
+        return 0.673
+    if registers == 32:
+        return 0.697
+    if registers == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / registers)
+
+
+class VelocityWindow:
+    """
+    One rule's sliding window for one account: `buckets` time buckets of
+    window_seconds / buckets each, recycled in a ring. A bucket holds the
+    count and sum of its transactions and, for distinct rules, its own
+    HyperLogLog registers, so the window never grows with traffic.
+    """
+    __slots__ = ('epochs', 'counts', 'sums', 'registers', 'loaded_at')
+
+    def __init__(self, buckets, registers, loaded_at=None):
+        # monotonic time of the seed the window started from, None when it started empty
+        self.loaded_at = loaded_at
+        self.epochs = array('q', [-1]) * buckets
+        self.counts = array('I', [0]) * buckets
+        self.sums = array('d', [0.0]) * buckets
+        self.registers = np.zeros((buckets, registers), dtype=np.uint8) if registers else None
+
+
+class VelocityEngine:
+    """
+    Evaluates velocity rules in-process from per (rule, account) windows.
+
+    A transaction is added to its account's window and the rule is then
+    compared with the window's count, sum or distinct count, so the
+    transaction that crosses the limit is the one flagged. Windows slide in
+    steps of one bucket, and distinct counts are HyperLogLog estimates that
+    use linear counting while the window holds few values, where they are
+    close to exact.
+
+    Windows are seeded by prime() or prime_many() from the account's
+    kd_hk_transactions rows in the rule's time span, plus the transactions
+    this process queued for insert but not committed yet, and re-seeded
+    after VELOCITY_STATE_TTL_SECONDS, which bounds how long transactions
+    checked by other workers go unseen. observe() never queries: a window
+    that was not primed starts empty. Rules over a column that
+    kd_hk_transactions does not store start from an empty window.
+
+    Windows take at most max_bytes of memory (about 0.75KB for a count or
+    sum window and 3.9KB for a distinct one with the defaults); the least
+    recently used is dropped to make room, which only forgets the recent
+    history of a quiet account until it is seeded again.
+    """
+
+    def __init__(self, max_bytes=VELOCITY_MAX_BYTES, buckets=VELOCITY_BUCKETS, precision=VELOCITY_HLL_PRECISION,
+                 queued=None, ttl=VELOCITY_STATE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.buckets = buckets
+        self.precision = precision
+        self.registers = 1 << precision
+        self.queued = queued  # (account, as_of) -> [(transaction, queued at)] not committed yet, for seeds
+        self._alpha = _hll_alpha(self.registers)
+        self._windows = OrderedDict()  # (rule id, account) -> VelocityWindow, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._windows)
+
+    def memory_bytes(self):
+        return self._bytes
+
+    def _window_bytes(self, window):
+        registers = window.registers.shape[1] if window.registers is not None else 0
+        return self.buckets * (8 + 4 + 8 + registers) + WINDOW_OVERHEAD_BYTES
+
+    def _new_window(self, rule, loaded_at=None):
+        return VelocityWindow(self.buckets, self.registers if rule.velocity.function == 'distinct' else 0, loaded_at)
+
+    def _fresh(self, window, now):
+        return window is not None and window.loaded_at is not None and now - window.loaded_at < self.ttl
+
+    def _store(self, key, window):
+        # the caller holds the lock; returns the window kept for the key, which a fresh seed replaces
+        existing = self._windows.get(key)
+        if existing is not None:
+            self._windows.move_to_end(key)
+            if window.loaded_at is None or self._fresh(existing, time.monotonic()):
+                return existing
+            self._windows[key] = window
+            self._bytes += self._window_bytes(window) - self._window_bytes(existing)
+            return window
+        size = self._window_bytes(window)
+        while self._windows and self._bytes + size > self.max_bytes:
+            _, dropped = self._windows.popitem(last=False)
+            self._bytes -= self._window_bytes(dropped)
+        self._windows[key] = window
+        self._bytes += size
+        return window
+
+    def _window(self, rule, account):
+        key = (rule.id, account)
+        window = self._windows.get(key)
+        if window is not None:
+            self._windows.move_to_end(key)
+            return window
+        return self._store(key, self._new_window(rule))
+
+    def _seed_event(self, window, spec, timestamp, value):
+        epoch = int(timestamp // (spec.window_seconds / self.buckets))
+        slot = epoch % self.buckets
+        if window.epochs[slot] > epoch:
+            return
+        if window.epochs[slot] != epoch:
+            window.epochs[slot] = epoch
+            window.counts[slot] = 0
+            window.sums[slot] = 0.0
+            if window.registers is not None:
+                window.registers[slot] = 0
+        self._add(window, slot, value)
+
+    def _seed_many(self, db, rule, accounts, as_of):
+        """
+        :param accounts: Up to SEED_CHUNK_SIZE source accounts, as strings.
+        :param as_of: Leave out queued transactions from this unix time on, None includes all of them.
+        :return: {account: VelocityWindow}
+        """
+        spec = rule.velocity
+        loaded_at = time.monotonic()
+        windows = {account: self._new_window(rule, loaded_at) for account in accounts}
+        events = {account: [] for account in accounts}
+        now = time.time()
+        if spec.column is None or spec.column in TRANSACTION_COLUMNS:
+            rows = db.fetch_records(spec.seed_query(len(accounts)), (*accounts, spec.window_seconds), strict=True)
+            for account, value, age in rows:
+                account = str(account)
+                if account in events and value is not None:
+                    events[account].append((now - float(age), spec.value_of({spec.column: value})))
+            if self.queued is not None:
+                for account in accounts:
+                    for data, queued_at in self.queued(account, as_of):
+                        value = spec.value_of(data)
+                        if value is not None:
+                            events[account].append((queued_at, value))
+
+        for account, window in windows.items():
+            # a bucket only takes events of its own epoch, so they go in by time
+            for timestamp, value in sorted(events[account], key=lambda event: event[0]):
+                self._seed_event(window, spec, timestamp, value)
+        return windows
+
+    def missing(self, rules, account):
+        """
+        :return: The velocity rules among rules whose window for the account is not seeded or is past the TTL.
+        """
+        account = str(account)
+        now = time.monotonic()
+        with self._lock:
+            return [rule for rule in rules
+                    if rule.velocity is not None and not self._fresh(self._windows.get((rule.id, account)), now)]
+
+    def prime(self, db, rule, account, as_of=None):
+        # seeds the rule's window for the account so observe() finds it
+        self.prime_many(db, [rule], [account], as_of)
+
+    def prime_many(self, db, rules, accounts, as_of=None):
+        """
+        Seeds every velocity rule's window for every account that has none,
+        or whose window is past the TTL, with one query per rule per
+        SEED_CHUNK_SIZE accounts.
+
+        :param as_of: Leave out queued transactions from this unix time on, None includes all of them.
+        """
+        accounts = list(dict.fromkeys(str(account) for account in accounts))
+        for rule in rules:
+            if rule.velocity is None:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                unseeded = [account for account in accounts
+                            if not self._fresh(self._windows.get((rule.id, account)), now)]
+            for start in range(0, len(unseeded), SEED_CHUNK_SIZE):
+                seeded = self._seed_many(db, rule, unseeded[start:start + SEED_CHUNK_SIZE], as_of)
+                with self._lock:
+                    for account, window in seeded.items():
+                        self._store((rule.id, account), window)
+
+    def _add(self, window, slot, value):
+        window.counts[slot] += 1
+        if window.registers is None:
+            window.sums[slot] += value
+            return
+        hashed = hash(str(value)) & HASH_MASK
+        index = hashed & (self.registers - 1)
+        rest = hashed >> self.precision
+        rank = (rest & -rest).bit_length() if rest else 65 - self.precision
+        if window.registers[slot, index] < rank:
+            window.registers[slot, index] = rank
+
+    def _distinct(self, window, live):
+        registers = self.registers
+        if not live:
+            return 0.0
+        merged = window.registers[live].max(axis=0)
+        zeros = registers - np.count_nonzero(merged)
+        if zeros == registers:
+            return 0.0
+        estimate = self._alpha * registers * registers / INVERSE_POWERS[merged].sum()
+        if estimate <= 2.5 * registers and zeros:
+            estimate = registers * math.log(registers / zeros)
+        return float(round(estimate))
+
+    def observe(self, rule, data, now=None):
+        """
+        Adds the transaction to the rule's window for its source account,
+        as primed; a window that was not primed starts empty.
+
+        :param rule: A compiled rule with a velocity spec.
+        :param data: The transaction, with lowercased keys.
+        :param now: Unix time of the transaction, defaults to the current time.
+        :return: The window's count, sum or distinct count including the transaction.
+        """
+        spec = rule.velocity
+        value = spec.value_of(data)
+        now = time.time() if now is None else now
+        epoch = int(now // (spec.window_seconds / self.buckets))
+        slot = epoch % self.buckets
+        account = str(data['sourceaccountnumber'])
+
+        with self._lock:
+            window = self._window(rule, account)
+            if value is not None:
+                if window.epochs[slot] != epoch:
+                    window.epochs[slot] = epoch
+                    window.counts[slot] = 0
+                    window.sums[slot] = 0.0
+                    if window.registers is not None:
+                        window.registers[slot] = 0
+                self._add(window, slot, value)
+
+            oldest = epoch - self.buckets
+            live = [index for index, bucket_epoch in enumerate(window.epochs) if oldest < bucket_epoch <= epoch]
+            if spec.function == 'distinct':
+                return self._distinct(window, live)
+            if spec.function == 'sum':
+                return sum(window.sums[index] for index in live)
+            return float(sum(window.counts[index] for index in live))
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self._bytes = 0
+
+
+velocity_engine = VelocityEngine(queued=aggregate_engine.queued_rows)
@@ -0,0 +1,19 @@
+from datetime import datetime
+
+CONDITIONAL_MAP = {
+    "GreaterThan": lambda x, y: x > y,
+    "LessThan": lambda x, y: x < y,
+    "EqualTo": lambda x, y: x == y,
+    "GreaterThanOrEqualTo": lambda x, y: x >= y,
+    "LessThanOrEqualTo": lambda x, y: x <= y,
+    "NotEqualTo": lambda x, y: x != y
+}
+
+TYPE_VALIDATION_MAP = {
+    'float': lambda v: float(v),
+    'int': lambda v: int(v),
+    'datetime': lambda v: datetime.strptime(v, "%Y-%m-%d %H:%M:%S"),
+    'vachar': lambda v: str(v),
+    'string': lambda v: str(v),
+    'str': lambda v: str(v),
+}
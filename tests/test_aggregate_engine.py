@@ -0,0 +1,102 @@
+import pytest
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.models.compiled_rule import CompiledRule
+from src.services.aggregate_engine import AggregateEngine
+
+SUM_LAST_HOUR = ("select sum(amount) from kd_hk_transactions where amount > 0 "
+                 "and datetimecreated >= dateadd(hour, -1, getdate()) and sourceaccountnumber = ?")
+MAX_EVER = "select max(amount) from kd_hk_transactions where destinationbankcode = '044' and sourceaccountnumber = ?"
+
+
+def aggregate_rule(rule_id, expression):
+    return CompiledRule.from_fields(rule_id, 'amount', True, 'GreaterThan', 'float', None, f'rule {rule_id}', '',
+                                    expression)
+
+
+class CountingDatabase(SqliteDatabaseManager):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def fetch_records(self, query, params, strict=False):
+        self.reads += 1
+        return super().fetch_records(query, params, strict)
+
+
+@pytest.fixture
+def db():
+    db = CountingDatabase()
+    db.multiple_inserts("insert into kd_hk_transactions (SourceAccountNumber, DestinationAccountNumber, Amount, "
+                        "DestinationBankCode) values (?, 'd', ?, ?)",
+                        [('a', 100.0, '044'), ('a', 50.0, '058'), ('b', 10.0, '044')])
+    db.single_inserts("insert into kd_hk_transactions (SourceAccountNumber, DestinationAccountNumber, Amount, "
+                      "DestinationBankCode, DateTimeCreated) values ('a', 'd', 1000.0, '044', "
+                      "datetime('now', '-2 hours'))", ())
+    yield db
+    db.close()
+
+
+def transaction(account, amount, bank='044'):
+    return {'sourceaccountnumber': account, 'destinationaccountnumber': 'd', 'amount': amount,
+            'destinationbankcode': bank}
+
+
+def test_state_is_seeded_once_then_updated_in_memory(db):
+    engine = AggregateEngine(ttl=3600)
+    rule = aggregate_rule(1, SUM_LAST_HOUR)
+    # the two-hour-old row is outside the window
+    assert engine.value(db, rule, 'a') == 150.0
+    engine.observe([rule], transaction('a', 25.0))
+    assert engine.value(db, rule, 'a') == 175.0
+    assert db.reads == 1
+
+
+def test_predicates_filter_observed_transactions(db):
+    engine = AggregateEngine(ttl=3600)
+    rule = aggregate_rule(2, MAX_EVER)
+    assert engine.value(db, rule, 'a') == 1000.0
+    engine.observe([rule], transaction('a', 5000.0, bank='058'))
+    assert engine.value(db, rule, 'a') == 1000.0
+    engine.observe([rule], transaction('a', 2000.0))
+    assert engine.value(db, rule, 'a') == 2000.0
+
+
+def test_queued_transactions_count_until_committed(db):
+    engine = AggregateEngine(ttl=3600)
+    rule = aggregate_rule(1, SUM_LAST_HOUR)
+    row = ('c', 'd', 40.0, '044')
+    engine.queued([row])
+    assert engine.value(db, rule, 'c') == 40.0
+    assert engine.pending() == 1
+    engine.committed([row])
+    assert engine.pending() == 0
+
+
+def test_states_are_reseeded_after_the_ttl(db):
+    engine = AggregateEngine(ttl=0)
+    rule = aggregate_rule(1, SUM_LAST_HOUR)
+    assert engine.value(db, rule, 'b') == 10.0
+    # another worker's transaction, which this process never observed
+    db.single_inserts("insert into kd_hk_transactions (SourceAccountNumber, DestinationAccountNumber, Amount, "
+                      "DestinationBankCode) values ('b', 'd', 5.0, '044')", ())
+    assert engine.value(db, rule, 'b') == 15.0
+
+
+def test_prime_many_seeds_every_account_with_one_query_per_rule(db):
+    engine = AggregateEngine(ttl=3600)
+    rules = [aggregate_rule(1, SUM_LAST_HOUR), aggregate_rule(2, MAX_EVER)]
+    engine.prime_many(db, rules, ['a', 'b', 'z'])
+    assert db.reads == 2
+    assert engine.missing(rules, 'z') == []
+    assert [engine.value(db, rule, 'b') for rule in rules] == [10.0, 10.0]
+    assert engine.value(db, rules[0], 'z') is None
+    assert db.reads == 2
+
+
+def test_least_recently_used_account_is_dropped(db):
+    engine = AggregateEngine(max_accounts=1, ttl=3600)
+    rule = aggregate_rule(1, SUM_LAST_HOUR)
+    engine.value(db, rule, 'a')
+    engine.value(db, rule, 'b')
+    assert engine.missing([rule], 'a') == [rule]
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from flask import Flask, g
+
+from src.services import anomaly_engine_service
+from src.services.anomaly_engine_service import AnomalyEngine
+
+
+class FakeDatabase:
+    """Keeps kd_hk_anomalies rows unique by (user_id, timestamp), rolling back a batch that breaks that."""
+
+    def __init__(self):
+        self.rows = []
+
+    def _duplicate(self, row, rows):
+        return any(row[0] == other[0] and row[2] == other[2] for other in rows)
+
+    def multiple_inserts(self, query, params):
+        batch = []
+        for row in params:
+            if self._duplicate(row, self.rows + batch):
+                return -1
+            batch.append(row)
+        self.rows.extend(batch)
+        return 0
+
+    def single_inserts(self, query, params):
+        if self._duplicate(params, self.rows):
+            return None
+        self.rows.append(params)
+        return 0
+
+    async def multiple_inserts_async(self, query, params):
+        return self.multiple_inserts(query, params)
+
+    async def run_in_executor(self, func, *args):
+        return func(*args)
+
+
+def record(user, minute):
+    return {'user_id': user, 'alert_type': 'amount', 'timestamp': f'2024-01-01T10:{minute:02d}:00',
+            'risk_score': 0.5}
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(anomaly_engine_service, 'ANOMALY_BATCH_CHUNK_SIZE', 3)
+    app = Flask(__name__)
+    with app.app_context():
+        g.db_manager = FakeDatabase()
+        g.write_behind = None
+        yield AnomalyEngine()
+
+
+def test_records_are_saved_in_chunks(engine):
+    res = engine.save_records([record('a', minute) for minute in range(7)])
+    assert res.message == '7 of 7 records saved'
+    assert len(engine.db.rows) == 7
+
+
+def test_duplicate_fails_only_its_own_record(engine):
+    engine.save_records([record('a', 1)])
+    res = engine.save_records([record('a', 0), record('a', 1), record('a', 2), {'user_id': 'a'}])
+    assert res.message == '2 of 4 records saved'
+    assert [status['isSuccessful'] for status in res.data] == [True, False, True, False]
+    assert res.data[1]['message'] == 'Failed to save record'
+    assert len(engine.db.rows) == 3
+
+
+def test_async_save_retries_rolled_back_chunks_by_row(engine):
+    engine.save_records([record('a', 1)])
+    res = asyncio.run(engine.save_records_async([record('a', minute) for minute in range(6)]))
+    assert res.message == '5 of 6 records saved'
+    assert len(engine.db.rows) == 6
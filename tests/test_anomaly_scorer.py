@@ -0,0 +1,97 @@
+from src.services.anomaly_scorer import StreamingAnomalyScorer
+
+
+def scorer(**kwargs):
+    options = dict(max_accounts=100, alpha=0.1, min_observations=5, counterparties=4, new_counterparty_weight=1.0)
+    options.update(kwargs)
+    return StreamingAnomalyScorer(**options)
+
+
+def feed(target, account, amounts, start=1000.0, gap=60.0, counterparty='d'):
+    for index, amount in enumerate(amounts):
+        result = target.score(account, amount, counterparty, now=start + index * gap)
+    return result
+
+
+def test_no_score_before_min_observations():
+    target = scorer()
+    for index in range(5):
+        assert target.score('a', 10 ** index, 'd', now=1000 + index).score == 0.0
+
+
+def test_ewma_follows_the_amounts():
+    target = scorer(alpha=0.5)
+    feed(target, 'a', [100, 200])
+    slot = target._slots['a']
+    assert target._amount_mean[slot] == 150.0
+    # (1 - a) * (0 + a * delta^2) with delta 100
+    assert target._amount_var[slot] == 2500.0
+
+
+def test_amount_spike_scores_high():
+    target = scorer()
+    feed(target, 'a', [100, 120, 90, 110, 100, 95, 105, 100])
+    result = target.score('a', 5000, 'd', now=2000)
+    assert result.alert_type == 'amount_spike'
+    assert result.amount_z > 10
+
+
+def test_typical_amount_scores_low():
+    target = scorer()
+    feed(target, 'a', [100, 120, 90, 110, 100, 95, 105, 100])
+    result = target.score('a', 104, 'd', now=2000)
+    assert result.score < 1
+
+
+def test_steady_amount_does_not_spike_on_a_cent():
+    target = scorer()
+    feed(target, 'a', [5000] * 5)
+    result = target.score('a', 5000.01, 'd', now=2000)
+    assert result.amount_z < 1
+    assert result.score < 1
+
+
+def test_steady_pace_does_not_spike_on_a_few_seconds():
+    target = scorer()
+    feed(target, 'a', [100] * 6, gap=60.0)
+    # the last of the six was at 1300
+    result = target.score('a', 100, 'd', now=1355)
+    assert result.interval_z < 1
+    assert result.score < 1
+
+
+def test_steady_amount_still_spikes_on_a_large_change():
+    target = scorer()
+    feed(target, 'a', [5000] * 5)
+    assert target.score('a', 10000, 'd', now=2000).alert_type == 'amount_spike'
+
+
+def test_faster_than_usual_is_a_velocity_spike():
+    target = scorer()
+    now = 1000.0
+    for gap in (600, 660, 540, 600, 630, 570, 600, 610):
+        now += gap
+        target.score('a', 100, 'd', now=now)
+    result = target.score('a', 100, 'd', now=now + 1)
+    assert result.alert_type == 'velocity_spike'
+    assert result.interval_z > 3
+
+
+def test_new_counterparty_adds_its_weight():
+    target = scorer(new_counterparty_weight=0.5)
+    feed(target, 'a', [100] * 6, counterparty='known')
+    assert not target.score('a', 100, 'known', now=5000).new_counterparty
+    result = target.score('a', 100, 'other', now=5060)
+    assert result.new_counterparty
+    assert result.score >= 0.5
+
+
+def test_least_recently_seen_slot_is_reused():
+    target = scorer(max_accounts=2)
+    feed(target, 'a', [100] * 6)
+    feed(target, 'b', [100] * 6)
+    feed(target, 'c', [100])
+    assert len(target) == 2
+    assert 'a' not in target._slots
+    # a starts over, so it is not scored yet
+    assert target.score('a', 10 ** 6, 'd', now=9000).score == 0.0
@@ -0,0 +1,82 @@
+import queue
+from datetime import datetime
+
+import pytest
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.models.compiled_rule import CompiledRule
+from src.services import backtest_service
+from src.services.backtest_service import BUCKET_FORMATS, RULE_FIELDS, BacktestService, _replay_partition
+from src.services.schema_cache import SchemaCache
+
+LARGE = {'dataPoint': 'amount', 'conditional': 'GreaterThan', 'checkValue': '1000', 'name': 'large'}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(backtest_service, 'schema_cache', SchemaCache())
+    db = SqliteDatabaseManager()
+    db.multiple_inserts("insert into kd_hk_transactions (SourceAccountNumber, DestinationAccountNumber, Amount, "
+                        "DestinationBankCode, DateTimeCreated) values (?, 'd', ?, '044', ?)",
+                        [('a', 500.0, '2024-01-01 10:00:00'), ('a', 2000.0, '2024-01-01 11:00:00'),
+                         ('b', 3000.0, '2024-01-02 09:00:00'), ('c', 10.0, '2024-01-02 10:00:00')])
+    db.single_inserts("insert into kd_hk_rules (DataPoint, IsExpression, Conditional, CheckValue, Expression, "
+                      "CheckValueDatatype, DataPointDataType, RuleName) values ('amount', 1, 'GreaterThan', '1', "
+                      "'select count(*) from kd_hk_transactions where sourceaccountnumber=?', 'float', 'float', "
+                      "'db')", ())
+    yield db
+    db.close()
+
+
+def test_definition_is_replayed_across_workers_without_writing_reports(db):
+    result = BacktestService(db).run(definitions=[LARGE], workers=2)
+    assert result['transactions'] == 4
+    rule = result['rules'][0]
+    assert (rule['id'], rule['name'], rule['hits'], rule['hitRate']) == (-1, 'large', 2, 0.5)
+    assert [(bucket['bucket'], bucket['transactions'], bucket['hits']) for bucket in rule['hitRateOverTime']] == \
+        [('2024-01-01', 2, 1), ('2024-01-02', 2, 1)]
+    assert sorted(sample['sourceaccountnumber'] for sample in rule['samples']) == ['a', 'b']
+    assert db.fetch_record("select count(*) from kd_hk_report", ())[0] == 0
+
+
+def test_since_and_until_bound_the_replay(db):
+    result = BacktestService(db).run(definitions=[LARGE], workers=1, since='2024-01-01 10:30:00',
+                                     until='2024-01-02 09:30:00')
+    assert result['transactions'] == 2
+    assert result['rules'][0]['hits'] == 2
+
+
+def test_rules_that_need_the_database_are_skipped(db):
+    result = BacktestService(db).run(rule_ids=[1], workers=1)
+    assert result['rules'] == []
+    assert result['skipped'] == [{'id': 1, 'name': 'db', 'reason': 'expression needs the database to evaluate'}]
+
+
+def test_unknown_rules_and_invalid_definitions_are_refused(db):
+    service = BacktestService(db)
+    with pytest.raises(ValueError):
+        service.resolve_rules(rule_ids=[99])
+    with pytest.raises(ValueError):
+        service.resolve_rules(definitions=[{**LARGE, 'dataPoint': 'nope'}])
+    with pytest.raises(ValueError):
+        service.run(definitions=[LARGE], bucket='week')
+
+
+def test_partition_slides_aggregate_and_velocity_windows_on_datetimecreated():
+    aggregate = CompiledRule.from_fields(
+        1, 'amount', True, 'GreaterThan', 'float', None, 'sum', '',
+        "select sum(amount) from kd_hk_transactions where datetimecreated >= dateadd(hour, -1, getdate()) "
+        "and sourceaccountnumber = ?")
+    velocity = CompiledRule.from_fields(2, 'amount', True, 'GreaterThan', 'float', 1.0, 'count', '',
+                                        'velocity count(*) over 1 hour')
+    columns = ('id', 'datetimecreated', 'sourceaccountnumber', 'amount')
+    tasks, results = queue.Queue(), queue.Queue()
+    tasks.put([(1, datetime(2024, 1, 1, 10), 'a', 80.0), (2, datetime(2024, 1, 1, 10, 30), 'a', 100.0),
+               (3, datetime(2024, 1, 1, 11, 20), 'a', 150.0)])
+    tasks.put(None)
+    _replay_partition([{name: getattr(rule, name) for name in RULE_FIELDS} for rule in (aggregate, velocity)],
+                      columns, BUCKET_FORMATS['hour'], 10, tasks, results)
+    tally = results.get_nowait()
+    # by 11:20 the 80.0 at 10:00 is out of both windows: 150 > 100 and two transactions within the hour
+    assert tally.hits == {1: 2, 2: 2}
+    assert tally.buckets == {'2024-01-01T10:00': [2, 1, 1], '2024-01-01T11:00': [1, 1, 1]}
@@ -0,0 +1,124 @@
+import threading
+
+import pyodbc
+import pytest
+
+from src.infra import db_repo
+from src.infra.db_repo import DatabaseManager, is_connection_error
+
+
+class FakeConnection:
+    def __init__(self, error=None):
+        self.error = error
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=()):
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def executemany(self, query, params):
+        return self.execute(query)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def connect(conn_str):
+        created.append(FakeConnection())
+        return created[-1]
+
+    monkeypatch.setattr(db_repo.pyodbc, 'connect', connect)
+    return created
+
+
+def manager(**kwargs):
+    options = dict(pool_size=2, min_pool_size=1, checkout_timeout=0.05, health_check_interval=3600)
+    options.update(kwargs)
+    return DatabaseManager('server', 'db', 'user', 'password', **options)
+
+
+def test_connections_are_reused(connections):
+    db = manager()
+    for _ in range(5):
+        assert db.fetch_records('select 1', ()) == [(1,)]
+    assert len(connections) == 1
+    assert db.pool_stats()['checkouts'] == 5
+    db.close()
+
+
+def test_checkout_times_out_when_every_connection_is_in_use(connections):
+    db = manager(pool_size=1)
+    held = db._get_connection()
+    assert db._get_connection() is None
+    assert db.single_inserts('insert', ()) == -1
+    assert db.pool_stats()['checkout_timeouts'] == 2
+    db._return_connection(held)
+    assert db.single_inserts('insert', ()) == 0
+    db.close()
+
+
+def test_waiting_checkout_gets_the_returned_connection(connections):
+    db = manager(pool_size=1, checkout_timeout=5)
+    held = db._get_connection()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(db._get_connection()))
+    waiter.start()
+    db._return_connection(held)
+    waiter.join(timeout=5)
+    assert got == [held]
+    db.close()
+
+
+@pytest.mark.parametrize('error, broken', [
+    (pyodbc.OperationalError('08S01', 'link failure'), True),
+    (pyodbc.InterfaceError('IM002', 'no driver'), True),
+    (pyodbc.Error('08001', 'cannot connect'), True),
+    (pyodbc.IntegrityError('23000', 'Violation of UNIQUE KEY constraint'), False),
+    (pyodbc.ProgrammingError('42000', 'Incorrect syntax'), False),
+])
+def test_only_connection_errors_discard_the_connection(connections, error, broken):
+    assert is_connection_error(error) is broken
+    db = manager()
+    connections[0].error = error
+    assert db.single_inserts('insert', ()) is None
+    assert connections[0].closed is broken
+    assert db.pool_stats()['evictions'] == (1 if broken else 0)
+    db.close()
+
+
+def test_health_refill_counts_checked_out_connections(connections):
+    db = manager(pool_size=2, min_pool_size=2)
+    held = [db._get_connection(), db._get_connection()]
+    db._initialize_pool()
+    assert db.pool_stats()['total'] == 2
+    assert len(connections) == 2
+    for connection in held:
+        db._return_connection(connection)
+    db.close()
+
+
+def test_duplicate_in_a_batch_fails_the_whole_batch(connections):
+    db = manager()
+    connections[0].error = pyodbc.IntegrityError(
+        '23000', "Violation of UNIQUE KEY constraint 'ix'. Cannot insert duplicate key")
+    # the batch was rolled back, so callers must not count any of its rows as written
+    assert db.multiple_inserts('insert', [(1,), (2,)]) == -1
+    assert not connections[0].closed
+    db.close()
@@ -0,0 +1,110 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.infra.db_repo import DatabaseError
+from src.models.compiled_rule import CompiledRule
+from src.services import expression_evaluation
+from src.services.expression_evaluation import ExpressionEvaluation
+from src.services.expression_result_cache import ExpressionResultCache
+from src.services.rule_cache import CompiledRuleSet
+from src.services.velocity_engine import VelocityEngine
+
+EXPRESSION = "select count(*) from kd_hk_report where payloadtype = 'x' and sourceaccountnumber=?"
+
+
+class FakeDatabase:
+    """Answers expression result reads and velocity seeds on an executor, after `release` is set."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = False
+
+    def submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def fetch_records(self, query, params, strict=False):
+        self.release.wait(5)
+        if self.fail:
+            raise DatabaseError('database unreachable')
+        if 'datediff' in query:
+            return [('a', 1, 30)]
+        return [(1, '3')]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(expression_evaluation, 'expression_result_cache', ExpressionResultCache(ttl=3600))
+    monkeypatch.setattr(expression_evaluation, 'velocity_engine', VelocityEngine())
+    db = FakeDatabase()
+    yield db
+    db.release.set()
+    db.executor.shutdown()
+
+
+@pytest.fixture
+def rules():
+    return CompiledRuleSet([CompiledRule.from_fields(1, 'amount', True, 'GreaterThan', 'float', None, 'rule one', '',
+                                                     EXPRESSION)])
+
+
+def test_results_are_collected_within_the_deadline(db, rules):
+    evaluation = ExpressionEvaluation(db, rules, 'a', deadline_ms=5000).wait()
+    assert evaluation.results == {1: '3'}
+    assert evaluation.to_dict()['complete']
+
+
+def test_lookup_past_the_deadline_leaves_its_rules_unfinished(db, rules):
+    db.release.clear()
+    evaluation = ExpressionEvaluation(db, rules, 'a', deadline_ms=20).wait()
+    assert evaluation.unfinished == {1}
+    report = evaluation.to_dict()
+    assert not report['complete']
+    assert report['unfinishedRules'] == [1]
+
+
+def test_late_lookup_still_warms_the_cache(db, rules):
+    db.release.clear()
+    ExpressionEvaluation(db, rules, 'a', deadline_ms=20).wait()
+    db.release.set()
+    db.executor.shutdown(wait=True)
+    assert expression_evaluation.expression_result_cache.peek('a') == {1: '3'}
+
+
+def test_failed_lookup_leaves_its_rules_unfinished(db, rules):
+    db.fail = True
+    evaluation = ExpressionEvaluation(db, rules, 'a', deadline_ms=5000).wait()
+    assert evaluation.unfinished == {1}
+    assert evaluation.results == {}
+
+
+def test_cached_results_need_no_lookup(db, rules):
+    expression_evaluation.expression_result_cache.load(db, 'a')
+    db.fail = True
+    evaluation = ExpressionEvaluation(db, rules, 'a', deadline_ms=5000)
+    assert evaluation.results == {1: '3'}
+    assert not evaluation.wait().unfinished
+
+
+def velocity_rules():
+    return CompiledRuleSet([CompiledRule.from_fields(2, 'amount', True, 'GreaterThan', 'float', 5.0, 'velocity', '',
+                                                     'velocity count(*) over 1 hour')])
+
+
+def test_velocity_windows_are_primed_before_the_rules_are_evaluated(db):
+    rules = velocity_rules()
+    assert not ExpressionEvaluation(db, rules, 'a', deadline_ms=5000).wait().unfinished
+    engine = expression_evaluation.velocity_engine
+    assert engine.missing(rules.value_matrix.remaining, 'a') == []
+    # the seeded row plus this transaction, without a query on the request thread
+    db.fail = True
+    assert engine.observe(rules.value_matrix.remaining[0], {'sourceaccountnumber': 'a'}) == 2.0
+
+
+def test_velocity_prime_past_the_deadline_leaves_its_rule_unfinished(db):
+    db.release.clear()
+    evaluation = ExpressionEvaluation(db, velocity_rules(), 'a', deadline_ms=20).wait()
+    assert evaluation.unfinished == {2}
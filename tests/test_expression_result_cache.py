@@ -0,0 +1,80 @@
+import pytest
+
+from src.infra.db_repo import DatabaseError
+from src.services.expression_result_cache import ExpressionResultCache
+
+
+class FakeDatabase:
+    """kd_hk_expression_result as (account, rule id, result) rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.online = True
+        self.queries = []
+
+    def fetch_records(self, query, params, strict=False):
+        self.queries.append(params)
+        if not self.online:
+            raise DatabaseError('database unreachable')
+        if len(params) == 1 and 'SourceAccountNumber in' not in query:
+            return [(rule_id, result) for account, rule_id, result in self.rows if account == params[0]]
+        return [row for row in self.rows if row[0] in params]
+
+
+@pytest.fixture
+def db():
+    return FakeDatabase([('a', 1, '10'), ('a', 2, '20'), ('b', 1, '5')])
+
+
+def test_account_results_are_read_with_one_query_and_cached(db):
+    cache = ExpressionResultCache(max_accounts=10, ttl=3600)
+    assert cache.get(db, 'a') == {1: '10', 2: '20'}
+    assert cache.get(db, 'a') == {1: '10', 2: '20'}
+    assert len(db.queries) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_accounts_without_results_are_cached_too(db):
+    cache = ExpressionResultCache(max_accounts=10, ttl=3600)
+    assert cache.get(db, 'z') == {}
+    assert cache.peek('z') == {}
+    assert len(db.queries) == 1
+
+
+def test_failed_read_is_raised_and_not_cached(db):
+    cache = ExpressionResultCache(max_accounts=10, ttl=3600)
+    db.online = False
+    with pytest.raises(DatabaseError):
+        cache.get(db, 'a')
+    assert cache.peek('a') is None
+    db.online = True
+    assert cache.get(db, 'a') == {1: '10', 2: '20'}
+
+
+def test_get_many_loads_only_the_misses_in_one_query(db):
+    cache = ExpressionResultCache(max_accounts=10, ttl=3600)
+    cache.get(db, 'a')
+    found = cache.get_many(db, ['a', 'b', 'c', 'b'])
+    assert found == {'a': {1: '10', 2: '20'}, 'b': {1: '5'}, 'c': {}}
+    assert len(db.queries) == 2
+    assert sorted(db.queries[1]) == ['b', 'c']
+
+
+def test_least_recently_used_account_is_dropped(db):
+    cache = ExpressionResultCache(max_accounts=2, ttl=3600)
+    for account in ('a', 'b', 'a', 'c'):
+        cache.get(db, account)
+    assert cache.peek('b') is None
+    assert cache.peek('a') is not None
+
+
+def test_entries_expire_and_inserted_accounts_are_invalidated(db):
+    cache = ExpressionResultCache(max_accounts=10, ttl=0)
+    cache.get(db, 'a')
+    assert cache.peek('a') is None
+
+    cache = ExpressionResultCache(max_accounts=10, ttl=3600)
+    cache.get_many(db, ['a', 'b'])
+    cache.invalidate_transactions([('a', 'd', 1.0, '044')])
+    assert cache.peek('a') is None
+    assert cache.peek('b') == {1: '5'}
@@ -0,0 +1,140 @@
+import pytest
+
+from src.models.compiled_rule import CompiledRule
+from src.services import expression_scheduler
+from src.services.expression_scheduler import (HIGH_WATERMARK_QUERY, INSERT_WATERMARK_QUERY, LOW_WATERMARK_QUERY,
+                                               RECOMPUTE_QUERY, WATERMARKS_QUERY, ExpressionRecomputeScheduler)
+from src.services.rule_cache import CompiledRuleSet
+from src.services.expression_triggers import (EXISTING_TRIGGERS_QUERY, TRIGGER_RULES_QUERY, create_trigger_ddl,
+                                              drop_trigger_ddl)
+
+EXPRESSION = ("select count(distinct destinationaccountnumber) from kd_hk_transactions "
+              "where amount > 0 and sourceaccountnumber=?")
+
+
+class FakeDatabase:
+    def __init__(self, watermarks=(), moved=1):
+        self.watermarks = list(watermarks)
+        self.moved = moved
+        self.writes = []
+        self.high_watermark_params = None
+
+    def fetch_records(self, query, params, strict=False):
+        if query == WATERMARKS_QUERY:
+            return self.watermarks
+        if query == TRIGGER_RULES_QUERY:
+            return [(1, 'rule_one_1', EXPRESSION, 1)]
+        if query == EXISTING_TRIGGERS_QUERY:
+            return []
+        raise AssertionError(query)
+
+    def fetch_record(self, query, params):
+        if query == HIGH_WATERMARK_QUERY:
+            self.high_watermark_params = params
+            return (500,)
+        if query == LOW_WATERMARK_QUERY:
+            return (120,)
+        raise AssertionError(query)
+
+    def single_inserts(self, query, params):
+        self.writes.append((query, params))
+        return 0
+
+    def single_insert_return_id(self, query, params):
+        self.writes.append((query, params))
+        return self.moved
+
+    def single_insert_no_param(self, query):
+        self.writes.append((query, None))
+
+
+class RuleSetCache:
+    def __init__(self, rules):
+        self.rule_set = CompiledRuleSet(rules)
+
+    def get(self, db):
+        return self.rule_set
+
+
+def expression_rule(rule_id, shadow=False):
+    return CompiledRule.from_fields(rule_id, 'amount', True, 'GreaterThan', 'float', None, f'rule {rule_id}', '',
+                                    EXPRESSION, shadow=shadow)
+
+
+@pytest.fixture
+def rules(monkeypatch):
+    rules = [expression_rule(1)]
+    monkeypatch.setattr(expression_scheduler, 'rule_set_cache', RuleSetCache(rules))
+    return rules
+
+
+def scheduler(db, **kwargs):
+    target = ExpressionRecomputeScheduler(db, interval=3600, lock_path=None, **kwargs)
+    target.close()
+    return target
+
+
+def test_first_run_stores_a_watermark_and_recomputes_behind_the_safety_lag(rules):
+    db = FakeDatabase()
+    assert scheduler(db, safety_lag=15).run_once() == [1]
+    assert db.high_watermark_params == (15,)
+    assert db.writes[0] == (INSERT_WATERMARK_QUERY, (1, 120, 1))
+    query, params = db.writes[1]
+    assert query.startswith(RECOMPUTE_QUERY.split('merge')[0])
+    # watermark compare-and-set, then the MERGE over (120, 500]
+    assert params == (500, 1, 120, 120, 500, 1, 1)
+
+
+def test_watermark_and_last_run_come_from_the_table(rules):
+    db = FakeDatabase(watermarks=[(1, 300, 10)])
+    target = scheduler(db)
+    # recomputed 10 seconds ago, limit is the interval
+    assert target.run_once() == []
+    assert target.staleness()[0][1] >= 10
+
+    db.watermarks = [(1, 300, 4000)]
+    assert target.run_once() == [1]
+    assert db.writes[-1][1] == (500, 1, 300, 300, 500, 1, 1)
+
+
+def count(counter, rule_id):
+    return dict(counter.samples()).get((str(rule_id),), 0)
+
+
+def test_watermark_moved_by_another_host_is_a_skip_not_a_recompute(rules):
+    db = FakeDatabase(watermarks=[(1, 300, 4000)], moved=0)
+    skips = expression_scheduler.expression_recompute_skips
+    failures = expression_scheduler.expression_recompute_failures
+    skipped, failed = count(skips, 1), count(failures, 1)
+    assert scheduler(db).run_once() == []
+    assert count(skips, 1) == skipped + 1
+    assert count(failures, 1) == failed
+
+
+def test_failed_recompute_is_counted(rules):
+    db = FakeDatabase(watermarks=[(1, 300, 4000)], moved=None)
+    failures = expression_scheduler.expression_recompute_failures
+    failed = count(failures, 1)
+    assert scheduler(db).run_once() == []
+    assert count(failures, 1) == failed + 1
+
+
+def test_shadow_rules_are_recomputed(monkeypatch):
+    monkeypatch.setattr(expression_scheduler, 'rule_set_cache', RuleSetCache([expression_rule(2, shadow=True)]))
+    db = FakeDatabase(watermarks=[(2, 300, None)])
+    assert scheduler(db).run_once() == [2]
+
+
+def test_triggers_are_never_dropped(rules):
+    db = FakeDatabase()
+    scheduler(db).run_once()
+    assert not any('drop trigger' in query.lower() for query, _ in db.writes)
+
+
+def test_trigger_ddl_binds_the_account_per_inserted_row():
+    ddl = create_trigger_ddl("rule_one_1", EXPRESSION)
+    assert 'CREATE TRIGGER [rule_one_1]' in ddl
+    assert 'ON [kd_hk_transactions]' in ddl
+    assert 'sourceaccountnumber = @SourceAccountNumber)' in ddl
+    assert "WHERE TriggerName = 'rule_one_1'" in ddl
+    assert drop_trigger_ddl('a]b') == 'drop trigger if exists [a]]b]'
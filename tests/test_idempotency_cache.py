@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+
+from flask import Flask, g
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.dto.response_dto import ResponseDto
+from src.services import rule_engine_service
+from src.services.idempotency_cache import REPLAYED_HEADER, IdempotencyCache
+from src.services.rule_cache import RuleSetCache
+from src.services.rule_engine_service import TRANSACTION_INSERT_QUERY, RuleEngine
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.rows = {}
+
+    def put(self, query, params):
+        self.rows.setdefault(query, []).append(params)
+
+
+def test_client_key_wins_over_the_payload():
+    cache = IdempotencyCache()
+    assert cache.key_for('abc', {'amount': 1}) == cache.key_for('abc', {'amount': 2})
+
+
+def test_disabled_cache_has_no_keys():
+    assert IdempotencyCache(max_entries=0).key_for('abc', {}) is None
+
+
+def test_transaction_reference_is_the_key_without_a_client_key():
+    cache = IdempotencyCache(reference_field='transactionreference')
+    assert cache.key_for(None, {'transactionreference': 'T1', 'amount': 1}) == \
+        cache.key_for(None, {'transactionreference': 'T1', 'amount': 2})
+    assert cache.key_for(None, {'transactionreference': 'T1'}) != cache.key_for(None, {'transactionreference': 'T2'})
+
+
+def test_payloads_are_not_hashed_unless_enabled():
+    data = {'sourceaccountnumber': '1', 'amount': 5000}
+    assert IdempotencyCache(hash_payloads=False).key_for(None, data) is None
+    hashed = IdempotencyCache(hash_payloads=True)
+    assert hashed.key_for(None, data) == hashed.key_for(None, dict(data))
+    assert hashed.key_for(None, data) != hashed.key_for(None, {**data, 'amount': 5001})
+
+
+def test_duplicate_waits_for_the_owner_and_replays_its_verdict():
+    cache = IdempotencyCache(wait_seconds=2)
+    future, owner = cache.begin('k')
+    assert owner
+    duplicate, duplicate_owner = cache.begin('k')
+    assert duplicate is future and not duplicate_owner
+
+    threading.Timer(0.05, cache.finish, ('k', future, ResponseDto(True, 'Success', {'faulted': []}, 200))).start()
+    replayed = cache.replay(duplicate)
+    assert replayed.isSuccessful and replayed.data == {'faulted': []}
+    assert replayed.headers[REPLAYED_HEADER] == 'true'
+
+
+def test_failed_verdict_is_not_kept():
+    cache = IdempotencyCache()
+    future, _ = cache.begin('k')
+    cache.finish('k', future, ResponseDto(False, 'An error occured', False, 500))
+    assert cache.begin('k')[1]
+
+
+def test_result_not_kept_is_still_handed_to_waiting_duplicates():
+    cache = IdempotencyCache(wait_seconds=1)
+    future, _ = cache.begin('k')
+    duplicate, _ = cache.begin('k')
+    cache.finish('k', future, ResponseDto(True, 'Success', True, 200), keep=False)
+    assert cache.replay(duplicate).data is True
+    assert cache.begin('k')[1]
+
+
+def test_in_progress_after_the_wait():
+    cache = IdempotencyCache(wait_seconds=0.01)
+    cache.begin('k')
+    future, _ = cache.begin('k')
+    assert cache.replay(future).statuscode == 409
+    assert asyncio.run(cache.replay_async(future)).statuscode == 409
+    # the owner's future is left alone
+    assert not future.cancelled()
+
+
+def test_entries_expire_and_are_bounded():
+    cache = IdempotencyCache(max_entries=2, ttl=0.05)
+    for key in ('a', 'b', 'c'):
+        future, _ = cache.begin(key)
+        cache.finish(key, future, ResponseDto(True, 'Success', None, 200))
+    assert cache.begin('a')[1]
+    assert not cache.begin('c')[1]
+    time.sleep(0.06)
+    assert cache.begin('c')[1]
+
+
+def shared_caches(**kwargs):
+    # two workers: separate in-process maps over the same kd_hk_idempotency
+    return IdempotencyCache(wait_seconds=0.2, poll_seconds=0.01, **kwargs), \
+        IdempotencyCache(wait_seconds=0.2, poll_seconds=0.01, **kwargs)
+
+
+def test_retry_on_another_worker_replays_the_stored_verdict():
+    db = SqliteDatabaseManager()
+    first, second = shared_caches()
+    assert first.claim(db, 'key:k') == (True, None)
+    first.store(db, 'key:k', ResponseDto(True, 'Success', True, 200, extra={'evaluation': {'complete': True}}))
+
+    claimed, replayed = second.claim(db, 'key:k')
+    assert not claimed
+    assert replayed.data is True and replayed.extra == {'evaluation': {'complete': True}}
+    assert replayed.headers[REPLAYED_HEADER] == 'true'
+    db.close()
+
+
+def test_retry_on_another_worker_waits_for_the_owner():
+    db = SqliteDatabaseManager()
+    first, second = shared_caches()
+    first.claim(db, 'key:k')
+    assert second.claim(db, 'key:k')[1].statuscode == 409
+
+    threading.Timer(0.05, first.store, (db, 'key:k', ResponseDto(True, 'Success', False, 200))).start()
+    assert IdempotencyCache(wait_seconds=2, poll_seconds=0.01).claim(db, 'key:k')[1].data is False
+    db.close()
+
+
+def test_failed_verdict_gives_the_shared_key_up():
+    db = SqliteDatabaseManager()
+    first, second = shared_caches()
+    first.claim(db, 'key:k')
+    first.store(db, 'key:k', ResponseDto(False, 'An error occured', False, 500))
+    assert second.claim(db, 'key:k') == (True, None)
+    db.close()
+
+
+def test_expired_claim_is_taken_over():
+    db = SqliteDatabaseManager()
+    first, second = shared_caches(claim_seconds=-1)
+    first.claim(db, 'key:k')
+    assert second.claim(db, 'key:k') == (True, None)
+    db.close()
+
+
+def test_unshared_or_unreachable_table_evaluates_locally():
+    db = SqliteDatabaseManager()
+    assert IdempotencyCache(shared=False).claim(db, 'key:k') == (False, None)
+    db.fetch_records('drop table kd_hk_idempotency', ())
+    assert IdempotencyCache().claim(db, 'key:k') == (False, None)
+    db.close()
+
+
+def test_rule_check_retry_reaching_a_second_worker_is_not_evaluated_again(monkeypatch):
+    db = SqliteDatabaseManager()
+    db.single_inserts("insert into kd_hk_rules (DataPoint, Conditional, CheckValue, CheckValueDatatype, RuleName) "
+                      "values ('amount', 'GreaterThan', '1000', 'float', 'large')", ())
+    monkeypatch.setattr(rule_engine_service, 'rule_set_cache', RuleSetCache(refresh_interval=3600))
+    transaction = {'SourceAccountNumber': 'a', 'DestinationAccountNumber': 'd1', 'Amount': 2000,
+                   'DestinationBankCode': '044'}
+    app = Flask(__name__)
+    with app.test_request_context():
+        g.db_manager = db
+        g.write_behind = RecordingQueue()
+        verdicts = []
+        for worker in shared_caches():
+            monkeypatch.setattr(rule_engine_service, 'idempotency_cache', worker)
+            verdicts.append(RuleEngine().rule_check(transaction, 'retry-1'))
+        assert verdicts[0].data is True and verdicts[1].data is True
+        assert verdicts[1].headers[REPLAYED_HEADER] == 'true'
+        assert len(g.write_behind.rows[TRANSACTION_INSERT_QUERY]) == 1
+    db.close()
@@ -0,0 +1,53 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from flask import Flask
+
+from src.controllers.responses import error_response, json_response
+from src.dto.response_dto import ResponseDto
+from src.infra import json_codec
+from src.infra.json_codec import RawJson, get_encoder
+
+ENCODERS = ['stdlib'] + (['orjson'] if json_codec.orjson is not None else [])
+
+
+@pytest.mark.parametrize('name', ENCODERS)
+def test_encoders_agree_on_dates_decimals_and_raw_json(name):
+    value = {
+        'created': datetime(2024, 1, 2, 3, 4, 5),
+        'day': date(2024, 1, 2),
+        'amount': Decimal('10.10'),
+        'payload': RawJson('{"sourceaccountnumber":"123","amount":5}'),
+        7: 'non-string key'
+    }
+    decoded = json.loads(get_encoder(name).dumps(value))
+    assert decoded == {
+        'created': '2024-01-02T03:04:05',
+        'day': '2024-01-02',
+        'amount': '10.10',
+        'payload': {'sourceaccountnumber': '123', 'amount': 5},
+        '7': 'non-string key'
+    }
+
+
+def test_unknown_types_are_rejected():
+    for name in ENCODERS:
+        with pytest.raises(TypeError):
+            get_encoder(name).dumps({'value': object()})
+
+
+def test_json_response_carries_status_headers_and_extra_fields():
+    with Flask(__name__).app_context():
+        response = json_response(ResponseDto(True, 'ok', [1], 201, headers={'ETag': '"x"'},
+                                             extra={'evaluation': {'complete': True}}))
+        assert response.status_code == 201
+        assert response.mimetype == 'application/json'
+        assert response.headers['ETag'] == '"x"'
+        assert response.get_json() == {'isSuccessful': True, 'message': 'ok', 'data': [1], 'statuscode': 201,
+                                       'evaluation': {'complete': True}}
+
+        error = error_response('bad', 400)
+        assert error.status_code == 400
+        assert error.get_json()['isSuccessful'] is False
@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+from src.infra.metrics import MetricsRegistry
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def worker_file(directory, pid, samples):
+    with open(os.path.join(directory, f'metrics_{pid}.json'), 'w', encoding='utf-8') as metrics_file:
+        json.dump(samples, metrics_file)
+
+
+def registry(directory=None):
+    target = MetricsRegistry()
+    requests = target.counter('requests_total', 'Requests.', ('endpoint',))
+    latency = target.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    target.gauge('pending', 'Pending rows.', lambda: 2)
+    target.gauge('staleness_seconds', 'Staleness.', lambda: [(('r1',), 30)], ('rule',), multiprocess_mode='min')
+    if directory:
+        target._directory = directory
+    return target, requests, latency
+
+
+def test_process_local_render():
+    target, requests, latency = registry()
+    requests.inc('check', amount=3)
+    latency.observe(0.5)
+    text = target.render()
+    assert 'requests_total{endpoint="check"} 3' in text
+    assert 'latency_seconds_bucket{le="1.0"} 1' in text
+    assert 'latency_seconds_count 1' in text
+    assert 'pending 2' in text
+
+
+def test_shared_render_merges_live_and_exited_workers(tmp_path):
+    target, requests, latency = registry(str(tmp_path))
+    requests.inc('check', amount=3)
+    latency.observe(0.05)
+
+    # the test runner's parent is alive, the finished subprocess is not
+    worker_file(tmp_path, os.getppid(), {
+        'requests_total': [[['check'], 4], [['batch'], 1]],
+        'latency_seconds': [[[], [0, 1, 0, 0.5]]],
+        'pending': [[[], 5]],
+        'staleness_seconds': [[['r1'], 10]]
+    })
+    dead = exited_pid()
+    worker_file(tmp_path, dead, {'requests_total': [[['check'], 10]], 'pending': [[[], 100]]})
+
+    text = target.render()
+    assert 'requests_total{endpoint="check"} 17' in text
+    assert 'requests_total{endpoint="batch"} 1' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1.0"} 2' in text
+    assert 'latency_seconds_sum 0.55' in text
+    # gauges of exited workers are dropped
+    assert 'pending 7' in text
+    assert 'staleness_seconds{rule="r1"} 10' in text
+
+    # the exited worker's file is folded into metrics_exited.json, and its counts are still reported
+    assert not os.path.exists(tmp_path / f'metrics_{dead}.json')
+    assert os.path.exists(tmp_path / 'metrics_exited.json')
+    assert 'requests_total{endpoint="check"} 17' in target.render()
+
+
+def test_share_writes_this_process(tmp_path):
+    target, requests, _ = registry()
+    target.share(str(tmp_path), interval=3600)
+    requests.inc('check')
+    target._close()
+    with open(tmp_path / f'metrics_{os.getpid()}.json', encoding='utf-8') as metrics_file:
+        assert json.load(metrics_file)['requests_total'] == [[['check'], 1]]
@@ -0,0 +1,88 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask, g
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.services import rule_engine_service
+from src.services.rule_engine_service import RuleEngine
+
+
+@pytest.fixture
+def engine():
+    db = SqliteDatabaseManager()
+    db.multiple_inserts("insert into kd_hk_rules (DataPoint, Conditional, CheckValue, CheckValueDatatype, RuleName) "
+                        "values ('amount', 'GreaterThan', ?, 'float', ?)", [('1', 'one'), ('2', 'two')])
+    start = datetime(2024, 1, 1)
+    # three rows share each DateInserted, so pages have to break ties on Id
+    db.multiple_inserts("insert into kd_hk_report (RuleId, PayloadType, PayloadDetails, DateInserted) "
+                        "values (?, 'Transaction', ?, ?)",
+                        [(1 + index % 2, json.dumps({'n': index}), start + timedelta(minutes=index // 3))
+                         for index in range(25)])
+    db.multiple_inserts("insert into kd_hk_anomalies (user_id, alert_type, risk_score, timestamp) "
+                        "values (?, 'amount', 0.5, ?)",
+                        [(str(index), start + timedelta(minutes=index // 2)) for index in range(11)])
+    app = Flask(__name__)
+    with app.app_context():
+        g.db_manager = db
+        g.write_behind = None
+        yield RuleEngine(), db
+    db.close()
+
+
+def newest_first(db, query):
+    return [row[0] for row in db.fetch_records(query, ())]
+
+
+def page_through(engine, cursor_key, rows_key):
+    seen, args = [], {'limit': '4'}
+    while True:
+        res = engine.get_report(args)
+        assert res.isSuccessful
+        seen.extend(row['id'] if rows_key == 'rules' else row['userId'] for row in res.data[rows_key])
+        cursor = res.data['next' + cursor_key[0].upper() + cursor_key[1:]]
+        if not cursor:
+            return seen
+        args = {'limit': '4', cursor_key: cursor}
+
+
+def test_report_pages_cover_every_row_once(engine):
+    engine, db = engine
+    assert page_through(engine, 'rulesCursor', 'rules') == newest_first(
+        db, "select Id from kd_hk_report order by DateInserted desc, Id desc")
+
+
+def test_anomaly_pages_cover_every_row_once(engine):
+    engine, db = engine
+    assert page_through(engine, 'anomaliesCursor', 'anomalies') == newest_first(
+        db, "select user_id from kd_hk_anomalies order by timestamp desc, id desc")
+
+
+def test_last_full_page_has_a_cursor_to_an_empty_page(engine):
+    engine, _ = engine
+    res = engine.get_report({'limit': '25'})
+    assert len(res.data['rules']) == 25
+    last = engine.get_report({'limit': '25', 'rulesCursor': res.data['nextRulesCursor']})
+    assert last.data['rules'] == [] and last.data['nextRulesCursor'] is None
+
+
+def test_invalid_cursor_is_rejected(engine):
+    engine, _ = engine
+    res = engine.get_report({'rulesCursor': 'not-a-cursor'})
+    assert res.statuscode == 400
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 25, 100])
+def test_export_pages_through_every_row(engine, monkeypatch, chunk_size):
+    engine, db = engine
+    monkeypatch.setattr(rule_engine_service, 'REPORT_EXPORT_CHUNK_SIZE', chunk_size)
+    generator, error = engine.export_report({})
+    assert error is None
+    exported = json.loads(b''.join(generator))
+    assert [row['id'] for row in exported] == newest_first(
+        db, "select Id from kd_hk_report order by DateInserted desc, Id desc")
+    assert exported[0]['payloadDetails'] == {'n': 24}
+
+    generator, _ = engine.export_report({'type': 'anomalies'})
+    assert len(json.loads(b''.join(generator))) == 11
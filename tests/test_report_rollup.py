@@ -0,0 +1,106 @@
+from datetime import datetime
+
+import pytest
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.services.report_rollup import ROLLUP_INSERT_QUERY, ROLLUP_UPDATE_QUERY, ReportRollup
+
+NOW = datetime(2024, 1, 2, 10, 30)
+# both hosts found no row and insert it without looking again
+UNGUARDED_INSERT_QUERY = "insert into kd_hk_report_rollup (RuleId, Bucket, BucketStart, Hits) values (?, ?, ?, 0)"
+
+
+class RacingDatabase(SqliteDatabaseManager):
+    """Runs another host's flush between this host's existence check and its insert."""
+
+    def __init__(self):
+        super().__init__()
+        self.other = None
+        self.fail_query = None
+
+    def multiple_inserts(self, query, params):
+        if query == self.fail_query:
+            self.fail_query = None
+            return -1
+        if query == ROLLUP_INSERT_QUERY and self.other is not None:
+            other, self.other = self.other, None
+            other.flush()
+            return super().multiple_inserts(UNGUARDED_INSERT_QUERY, [row[:3] for row in params])
+        return super().multiple_inserts(query, params)
+
+
+@pytest.fixture
+def db():
+    db = RacingDatabase()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def hosts(db):
+    # no lock file: the two rollups stand for processes on different hosts
+    rollups = [ReportRollup(db, interval=3600), ReportRollup(db, interval=3600)]
+    yield rollups
+    for rollup in rollups:
+        rollup.close()
+
+
+def rollup_rows(db):
+    return sorted(db.fetch_records("select RuleId, Bucket, BucketStart, Hits from kd_hk_report_rollup", ()))
+
+
+def account_rows(db):
+    return sorted(db.fetch_records(
+        "select RuleId, BucketStart, SourceAccountNumber, Hits from kd_hk_report_rollup_account", ()))
+
+
+def reports(*accounts):
+    return [(1, f'{{"sourceaccountnumber": "{account}"}}') for account in accounts]
+
+
+def test_flushes_add_to_the_hour_day_and_account_rows(db, hosts):
+    rollup = hosts[0]
+    rollup.record(reports('a', 'b'), now=NOW)
+    rollup.flush()
+    rollup.record(reports('a'), now=NOW)
+    rollup.flush()
+    assert rollup_rows(db) == [(1, 'day', datetime(2024, 1, 2), 3), (1, 'hour', datetime(2024, 1, 2, 10), 3)]
+    assert account_rows(db) == [(1, datetime(2024, 1, 2), 'a', 2), (1, datetime(2024, 1, 2), 'b', 1)]
+    assert rollup.pending() == 0
+
+
+def test_failed_update_keeps_the_counts_for_the_next_flush(db, hosts):
+    rollup = hosts[0]
+    rollup.record(reports('a'), now=NOW)
+    db.fail_query = ROLLUP_UPDATE_QUERY
+    rollup.flush()
+    # the rows were created with 0 hits; the counts were not lost or added
+    assert [row[3] for row in rollup_rows(db)] == [0, 0]
+    assert rollup.pending() == 2
+    rollup.flush()
+    assert [row[3] for row in rollup_rows(db)] == [1, 1]
+    assert rollup.pending() == 0
+
+
+def test_row_created_by_another_host_mid_flush_is_counted_once(db, hosts):
+    first, second = hosts
+    first.record(reports('a', 'a'), now=NOW)
+    second.record(reports('a'), now=NOW)
+    db.other = second
+    first.flush()
+    # the unique index rolled the first host's batch back instead of adding a second row
+    assert rollup_rows(db) == [(1, 'day', datetime(2024, 1, 2), 1), (1, 'hour', datetime(2024, 1, 2, 10), 1)]
+    assert account_rows(db) == [(1, datetime(2024, 1, 2), 'a', 3)]
+    assert first.pending() == 2
+
+    first.flush()
+    assert rollup_rows(db) == [(1, 'day', datetime(2024, 1, 2), 3), (1, 'hour', datetime(2024, 1, 2, 10), 3)]
+    assert first.pending() == 0
+
+
+def test_reports_without_an_account_only_count_towards_the_rule(db, hosts):
+    rollup = hosts[0]
+    rollup.record([(1, '{}'), (1, 'not json')], now=NOW)
+    rollup.flush()
+    assert [row[3] for row in rollup_rows(db)] == [2, 2]
+    assert account_rows(db) == []
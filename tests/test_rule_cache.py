@@ -0,0 +1,72 @@
+import pytest
+
+from src.infra.db_repo import DatabaseError
+from src.services.rule_cache import RuleSetCache
+
+
+def rule_row(rule_id, check_value='100'):
+    # select * from kd_hk_rules column order
+    return (rule_id, 'Amount', 0, 'GreaterThan', check_value, None, None, 1, 'float', '', None, f'rule {rule_id}',
+            None, 0)
+
+
+class FakeDatabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.online = True
+        self.reads = 0
+
+    def fetch_records(self, query, params, strict=False):
+        self.reads += 1
+        if not self.online:
+            if strict:
+                raise DatabaseError('database unreachable')
+            return []
+        return list(self.rows)
+
+
+def test_rules_are_compiled_once_and_served_from_memory():
+    db = FakeDatabase([rule_row(1), rule_row(2)])
+    cache = RuleSetCache(refresh_interval=3600)
+    first = cache.get(db)
+    assert cache.get(db) is first
+    assert db.reads == 1
+    assert len(first.value_matrix) == 2
+
+
+def test_first_load_fails_closed():
+    db = FakeDatabase([rule_row(1)])
+    db.online = False
+    cache = RuleSetCache(refresh_interval=3600)
+    # an empty set would pass every transaction, so the failure is raised instead
+    with pytest.raises(DatabaseError):
+        cache.get(db)
+    db.online = True
+    assert cache.get(db)
+
+
+def test_failed_reload_keeps_the_previous_set_until_the_retry():
+    db = FakeDatabase([rule_row(1)])
+    cache = RuleSetCache(refresh_interval=3600, retry_interval=3600)
+    previous = cache.get(db)
+    cache.invalidate()
+    db.online = False
+    assert cache.get(db) is previous
+    # the retry is scheduled retry_interval later, not on the next call
+    assert cache.get(db) is previous
+    assert db.reads == 2
+
+
+def test_invalid_rows_are_skipped():
+    db = FakeDatabase([rule_row(1), rule_row(2, check_value='not a number')])
+    rule_set = RuleSetCache(refresh_interval=3600).get(db)
+    assert len(rule_set.value_matrix) == 1
+
+
+def test_invalidate_reloads_from_the_database():
+    db = FakeDatabase([rule_row(1)])
+    cache = RuleSetCache(refresh_interval=3600)
+    cache.get(db)
+    db.rows = [rule_row(1), rule_row(2)]
+    cache.invalidate()
+    assert len(cache.get(db).value_matrix) == 2
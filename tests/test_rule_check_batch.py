@@ -0,0 +1,70 @@
+import pytest
+from flask import Flask, g
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.services import rule_engine_service
+from src.services.rule_cache import RuleSetCache
+from src.services.rule_engine_service import REPORT_INSERT_QUERY, TRANSACTION_INSERT_QUERY, RuleEngine
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.rows = {}
+
+    def put(self, query, params):
+        self.rows.setdefault(query, []).append(params)
+
+    def put_many(self, query, rows):
+        for params in rows:
+            self.put(query, params)
+
+
+def transaction(account, amount):
+    return {'SourceAccountNumber': account, 'DestinationAccountNumber': 'd1', 'Amount': amount,
+            'DestinationBankCode': '044'}
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    db = SqliteDatabaseManager()
+    db.multiple_inserts("insert into kd_hk_rules (DataPoint, Conditional, CheckValue, CheckValueDatatype, RuleName) "
+                        "values ('amount', 'GreaterThan', ?, 'float', ?)", [('1000', 'large'), ('5000', 'huge')])
+    monkeypatch.setattr(rule_engine_service, 'rule_set_cache', RuleSetCache(refresh_interval=3600))
+    app = Flask(__name__)
+    with app.test_request_context():
+        g.db_manager = db
+        g.write_behind = RecordingQueue()
+        yield RuleEngine()
+    db.close()
+
+
+def test_each_transaction_gets_its_own_verdict(engine):
+    res = engine.rule_check_batch([transaction('a', 10), transaction('b', 2000), {'amount': 1},
+                                   transaction('c', 9000)])
+    assert res.statuscode == 200
+    verdicts = res.data
+    assert [verdict['index'] for verdict in verdicts] == [0, 1, 2, 3]
+    assert [verdict['data'] for verdict in verdicts] == [False, True, None, True]
+    assert not verdicts[2]['isSuccessful']
+    assert verdicts[1]['faultedRules'] == [1]
+    assert sorted(verdicts[3]['faultedRules']) == [1, 2]
+
+
+def test_reports_and_transactions_are_queued_in_bulk(engine):
+    engine.rule_check_batch([transaction('a', 10), transaction('b', 2000), {'amount': 1}])
+    queued = engine.write_behind.rows
+    assert [row[0] for row in queued[REPORT_INSERT_QUERY]] == [1]
+    # the invalid item is neither evaluated nor recorded
+    assert [row[0] for row in queued[TRANSACTION_INSERT_QUERY]] == ['a', 'b']
+
+
+@pytest.mark.parametrize('payload', [[], {'amount': 1}, None])
+def test_batch_must_be_a_non_empty_list(engine, payload):
+    res = engine.rule_check_batch(payload)
+    assert res.statuscode == 400
+
+
+def test_batch_size_is_limited(engine, monkeypatch):
+    monkeypatch.setattr(rule_engine_service, 'RULE_CHECK_BATCH_MAX_SIZE', 2)
+    res = engine.rule_check_batch([transaction('a', 1)] * 3)
+    assert res.statuscode == 400
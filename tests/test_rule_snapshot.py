@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pytest
+
+from src.infra.rule_snapshot import RuleSnapshot
+from src.models.compiled_rule import CompiledRule
+from src.services.rule_cache import CompiledRuleSet, RuleSetCache
+from src.services.value_rule_matrix import DataPointColumns
+
+VELOCITY = 'velocity count(*) over 10 minutes'
+
+
+def rule_row(rule_id, check_value='100', shadow=0):
+    return (rule_id, 'Amount', 0, 'GreaterThan', check_value, None, None, 1, 'float', '', None, f'rule {rule_id}',
+            None, shadow)
+
+
+class FakeDatabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.reads = 0
+
+    def fetch_records(self, query, params, strict=False):
+        self.reads += 1
+        return list(self.rows)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'rules.snapshot')
+
+
+def test_published_rules_read_back_with_typed_thresholds(path):
+    rules = [
+        CompiledRule.from_fields(1, 'amount', False, 'GreaterThan', 'float', 100.0, 'value', 'd'),
+        CompiledRule.from_fields(2, 'count', False, 'EqualTo', 'int', 3, 'count', ''),
+        CompiledRule.from_fields(3, 'created', False, 'GreaterThan', 'datetime', datetime(2024, 1, 2, 3, 4), 'date', ''),
+        CompiledRule.from_fields(4, 'amount', True, 'GreaterThan', 'float', 5.0, 'velocity', '', VELOCITY),
+        CompiledRule.from_fields(5, 'amount', False, 'GreaterThan', 'float', 7.0, 'shadow', '', shadow=True),
+    ]
+    snapshot = RuleSnapshot(path)
+    snapshot.publish(CompiledRuleSet(rules), 7)
+
+    version, _, read_rules, columns = snapshot.read(CompiledRule.from_fields, DataPointColumns)
+    assert version == 7
+    rule_set = CompiledRuleSet(read_rules, columns)
+    by_id = {rule.id: rule for rule in list(rule_set) + list(rule_set.shadow)}
+    assert by_id[4].velocity.window_seconds == 600
+    assert [rule.id for rule in rule_set.shadow] == [5]
+    # matrix rules come back as threshold arrays, not rule objects
+    assert set(by_id) == {4, 5}
+    assert rule_set.value_matrix.faulted({'amount': 150.0, 'count': 3, 'created': '2024-01-02 03:05:00'}) == [1, 2, 3]
+    assert rule_set.value_matrix.faulted({'amount': 50.0, 'count': 2, 'created': '2024-01-02 03:04:00'}) == []
+
+
+def test_second_worker_adopts_the_snapshot_without_reading_the_database(path):
+    db = FakeDatabase([rule_row(1), rule_row(2, '500')])
+    publisher = RuleSetCache(refresh_interval=3600, snapshot=RuleSnapshot(path))
+    reader = RuleSetCache(refresh_interval=3600, snapshot=RuleSnapshot(path))
+
+    published = publisher.get(db)
+    adopted = reader.get(db)
+    assert db.reads == 1
+    assert reader.version == publisher.version
+    assert adopted.value_matrix.faulted({'amount': 200.0}) == published.value_matrix.faulted({'amount': 200.0})
+
+
+def test_invalidation_publishes_a_new_version_the_others_pick_up(path):
+    db = FakeDatabase([rule_row(1)])
+    publisher = RuleSetCache(refresh_interval=3600, snapshot=RuleSnapshot(path))
+    reader = RuleSetCache(refresh_interval=3600, snapshot=RuleSnapshot(path))
+    publisher.get(db)
+    reader.get(db)
+
+    db.rows = [rule_row(1), rule_row(2, '50')]
+    publisher.invalidate()
+    publisher.get(db)
+    assert db.reads == 2
+    assert reader.get(db).value_matrix.faulted({'amount': 75.0}) == [2]
+    assert db.reads == 2
+
+
+def test_stale_snapshot_is_not_adopted(path):
+    db = FakeDatabase([rule_row(1)])
+    RuleSetCache(refresh_interval=3600, snapshot=RuleSnapshot(path)).get(db)
+    # a snapshot older than the refresh interval is read from the database again
+    reader = RuleSetCache(refresh_interval=0, snapshot=RuleSnapshot(path))
+    reader.get(db)
+    assert db.reads == 2
@@ -0,0 +1,80 @@
+import pytest
+from flask import Flask, g
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.controllers.rules_engine_controller import rules
+from src.services import rule_engine_service
+from src.services.schema_cache import SchemaCache
+
+
+class CountingDatabase(SqliteDatabaseManager):
+    def __init__(self):
+        super().__init__()
+        self.schema_reads = 0
+        self.online = True
+
+    def get_columns_of_table(self, table_name):
+        self.schema_reads += 1
+        return super().get_columns_of_table(table_name) if self.online else None
+
+
+@pytest.fixture
+def db():
+    db = CountingDatabase()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    cache = SchemaCache(ttl=3600)
+    monkeypatch.setattr(rule_engine_service, 'schema_cache', cache)
+    app = Flask(__name__)
+    app.register_blueprint(rules, url_prefix='/api/rule')
+
+    @app.before_request
+    def database():
+        g.db_manager = db
+        g.write_behind = None
+
+    return app.test_client()
+
+
+def test_columns_are_read_once_per_ttl(db):
+    cache = SchemaCache(ttl=3600)
+    schema = cache.get(db, 'kd_hk_transactions')
+    assert cache.get(db, 'kd_hk_transactions') is schema
+    assert db.schema_reads == 1
+    assert 'Amount' in schema.columns
+
+
+def test_last_known_schema_is_served_while_the_database_is_down(db):
+    cache = SchemaCache(ttl=3600)
+    schema = cache.get(db, 'kd_hk_transactions')
+    cache.invalidate()
+    db.online = False
+    assert cache.get(db, 'kd_hk_transactions') is schema
+
+
+def test_unchanged_schema_keeps_its_validators_and_last_modified(db):
+    cache = SchemaCache(ttl=3600)
+    schema = cache.get(db, 'kd_hk_transactions')
+    cache.invalidate('kd_hk_transactions')
+    reloaded = cache.get(db, 'kd_hk_transactions')
+    assert reloaded is not schema
+    assert (reloaded.etag, reloaded.last_modified) == (schema.etag, schema.last_modified)
+    assert db.schema_reads == 2
+
+
+def test_datapoints_answers_a_matching_etag_with_304(client):
+    first = client.get('/api/rule/datapoints')
+    assert first.status_code == 200
+    assert 'Amount' in first.get_json()['data']['datapoints']
+    etag = first.headers['ETag']
+
+    again = client.get('/api/rule/datapoints', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    since = client.get('/api/rule/datapoints', headers={'If-Modified-Since': first.headers['Last-Modified']})
+    assert since.status_code == 304
+    assert client.get('/api/rule/datapoints', headers={'If-None-Match': '"other"'}).status_code == 200
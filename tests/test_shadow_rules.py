@@ -0,0 +1,110 @@
+import pytest
+from flask import Flask, g
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.services import rule_engine_service
+from src.services.rule_engine_service import RuleEngine
+from src.services.schema_cache import SchemaCache
+from src.services.shadow_rules import STATS_INSERT_QUERY, ShadowRuleStatsStore, load_stats
+
+
+class FakeDatabase:
+    """Keeps kd_hk_shadow_rule_stats rows as lists keyed by rule id."""
+
+    def __init__(self):
+        self.online = True
+        self.rows = {}
+
+    def multiple_inserts(self, query, params):
+        if not self.online:
+            return -1
+        for row in params:
+            if query == STATS_INSERT_QUERY:
+                self.rows.setdefault(row[0], [0, 0, 0, 0.0, 0.0])
+            else:
+                evaluations, hits, errors, seconds, max_seconds, _, rule_id = row
+                stats = self.rows[rule_id]
+                stats[:4] = [stats[0] + evaluations, stats[1] + hits, stats[2] + errors, stats[3] + seconds]
+                stats[4] = max(stats[4], max_seconds)
+        return 0
+
+    def single_inserts(self, query, params):
+        self.rows.pop(params[0], None)
+        return 0
+
+    def fetch_records(self, query, params, strict=False):
+        return [(rule_id, *stats) for rule_id, stats in self.rows.items()]
+
+
+@pytest.fixture
+def store():
+    store = ShadowRuleStatsStore(FakeDatabase(), interval=3600)
+    yield store
+    store.close()
+
+
+def test_flush_adds_to_the_stored_totals(store):
+    store.record(7, 'hit', 0.002)
+    store.record(7, 'miss', 0.004)
+    store.flush()
+    store.record(7, 'error', 0.001)
+    store.flush()
+
+    stats = load_stats(store.db)[7]
+    assert (stats.evaluations, stats.hits, stats.errors) == (3, 1, 1)
+    assert stats.max_seconds == 0.004
+    assert stats.to_dict()['hitRate'] == pytest.approx(1 / 3)
+    assert store.pending() == 0
+
+
+def test_failed_flush_keeps_the_counts(store):
+    store.record(7, 'hit', 0.002)
+    store.db.online = False
+    store.flush()
+    assert store.pending() == 1
+
+    store.record(7, 'miss', 0.003)
+    store.db.online = True
+    store.flush()
+    stats = load_stats(store.db)[7]
+    assert (stats.evaluations, stats.hits) == (2, 1)
+
+
+def test_forget_drops_pending_and_stored_stats(store):
+    store.record(7, 'hit', 0.002)
+    store.flush()
+    store.record(7, 'hit', 0.002)
+    store.forget(7)
+    store.flush()
+    assert load_stats(store.db) == {}
+
+
+def test_rules_are_created_before_the_shadow_migration_unless_shadowed(monkeypatch):
+    db = SqliteDatabaseManager()
+    # kd_hk_rules as it was before migrations/003_shadow_rules.sql
+    db.fetch_records('alter table kd_hk_rules drop column IsShadow', ())
+    monkeypatch.setattr(rule_engine_service, 'schema_cache', SchemaCache())
+    rule = {'dataPoint': 'Amount', 'checkValue': '1000', 'conditional': 'GreaterThan', 'description': '', 'name': 'large'}
+    app = Flask(__name__)
+    with app.test_request_context():
+        g.db_manager = db
+        g.write_behind = None
+        engine = RuleEngine()
+        assert engine.set_value_type_rule(rule).statuscode == 200
+        assert engine.set_value_type_rule({**rule, 'shadow': True}).statuscode == 400
+    assert db.fetch_records('select RuleName from kd_hk_rules', ()) == [('large',)]
+    db.close()
+
+
+def test_shadow_rules_are_created_with_the_flag(monkeypatch):
+    db = SqliteDatabaseManager()
+    monkeypatch.setattr(rule_engine_service, 'schema_cache', SchemaCache())
+    rule = {'dataPoint': 'Amount', 'checkValue': '1000', 'conditional': 'GreaterThan', 'description': '',
+            'name': 'large', 'shadow': True}
+    app = Flask(__name__)
+    with app.test_request_context():
+        g.db_manager = db
+        g.write_behind = None
+        assert RuleEngine().set_value_type_rule(rule).statuscode == 200
+    assert db.fetch_records('select IsShadow from kd_hk_rules', ()) == [(1,)]
+    db.close()
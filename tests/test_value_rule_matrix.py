@@ -0,0 +1,91 @@
+import math
+import random
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from src.models.compiled_rule import CompiledRule
+from src.services.value_rule_matrix import OPERATOR_CODES, ValueRuleMatrix
+
+
+def value_rule(rule_id, conditional, threshold, data_point='amount', data_type='float'):
+    return CompiledRule.from_fields(rule_id, data_point, False, conditional, data_type, threshold,
+                                    f'rule {rule_id}', '')
+
+
+def expected(rules, data):
+    faulted = []
+    for rule in rules:
+        if rule.data_point not in data:
+            continue
+        try:
+            if rule.faulted_by(data[rule.data_point]):
+                faulted.append(rule.id)
+        except (ValueError, TypeError):
+            continue
+    return sorted(faulted)
+
+
+def test_matches_per_rule_comparison_for_every_conditional():
+    rng = random.Random(7)
+    # few distinct thresholds, so ties and EqualTo runs are common
+    rules = [value_rule(index, rng.choice(list(OPERATOR_CODES)), float(rng.randint(0, 20)))
+             for index in range(1, 400)]
+    matrix = ValueRuleMatrix(rules)
+    assert not matrix.remaining
+    assert len(matrix) == len(rules)
+
+    transactions = [{'amount': rng.choice([rng.randint(-1, 21), rng.uniform(-1, 21)])} for _ in range(200)]
+    for data, faulted in zip(transactions, matrix.faulted_batch(transactions)):
+        assert sorted(faulted) == expected(rules, data)
+
+
+def test_nan_is_only_unequal():
+    rules = [value_rule(1, 'GreaterThan', 5.0), value_rule(2, 'LessThan', 5.0), value_rule(3, 'EqualTo', 5.0),
+             value_rule(4, 'NotEqualTo', 5.0), value_rule(5, 'NotEqualTo', 7.0)]
+    assert sorted(ValueRuleMatrix(rules).faulted({'amount': math.nan})) == [4, 5]
+
+
+def test_missing_and_invalid_values_fault_nothing():
+    matrix = ValueRuleMatrix([value_rule(1, 'GreaterThan', 5.0), value_rule(2, 'NotEqualTo', 5.0)])
+    assert matrix.faulted_batch([{}, {'amount': 'abc'}, {'amount': None}]) == [[], [], []]
+
+
+def test_int_and_datetime_columns():
+    rules = [value_rule(1, 'GreaterThanOrEqualTo', 10, data_type='int'),
+             value_rule(2, 'LessThan', datetime(2024, 1, 2), data_point='datetimecreated', data_type='datetime')]
+    matrix = ValueRuleMatrix(rules)
+    assert len(matrix.columns) == 2
+    assert matrix.faulted({'amount': '10', 'datetimecreated': '2024-01-01 12:00:00'}) == [1, 2]
+    assert matrix.faulted({'amount': '9', 'datetimecreated': '2024-01-02 00:00:00'}) == []
+
+
+def test_rules_outside_the_matrix_are_remaining():
+    expression = CompiledRule.from_fields(1, 'amount', True, 'GreaterThan', 'float', None, 'expr', '',
+                                          'select sum(amount) from kd_hk_transactions where sourceaccountnumber=?')
+    string_rule = value_rule(2, 'EqualTo', 'abc', data_type='string')
+    nan_rule = value_rule(3, 'GreaterThan', math.nan)
+    matrix = ValueRuleMatrix([expression, string_rule, nan_rule, value_rule(4, 'GreaterThan', 1.0)])
+    assert [rule.id for rule in matrix.remaining] == [1, 2, 3]
+    assert len(matrix) == 1
+
+
+def test_from_columns_keeps_results():
+    rules = [value_rule(index, conditional, float(index % 5))
+             for index, conditional in enumerate(OPERATOR_CODES, start=1)]
+    matrix = ValueRuleMatrix(rules)
+    rebuilt = ValueRuleMatrix.from_columns(
+        [type(column)(column.data_point, column.data_type,
+                      [(code, thresholds.copy(), np.asarray(ids, dtype=np.int64)) for code, thresholds, ids in column.ranges])
+         for column in matrix.columns], [])
+    for amount in (0, 1.5, 3, 4, 10):
+        assert sorted(rebuilt.faulted({'amount': amount})) == sorted(matrix.faulted({'amount': amount}))
+        assert all(isinstance(rule_id, int) for rule_id in rebuilt.faulted({'amount': amount}))
+
+
+@pytest.mark.parametrize('conditional', list(OPERATOR_CODES))
+def test_threshold_boundaries(conditional):
+    matrix = ValueRuleMatrix([value_rule(1, conditional, 100.0)])
+    for amount in (99.99, 100, 100.01):
+        assert matrix.faulted({'amount': amount}) == expected([value_rule(1, conditional, 100.0)], {'amount': amount})
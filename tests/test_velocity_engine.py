@@ -0,0 +1,161 @@
+import time
+
+from benchmarks.sqlite_db import SqliteDatabaseManager
+from src.models.compiled_rule import CompiledRule
+from src.services.aggregate_engine import AggregateEngine
+from src.services.rule_engine_service import TRANSACTION_INSERT_QUERY
+from src.services.velocity_engine import WINDOW_OVERHEAD_BYTES, VelocityEngine
+
+
+class FakeDatabase:
+    """Answers velocity seed queries with (account, value, age in seconds) rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def fetch_records(self, query, params, strict=False):
+        self.queries += 1
+        accounts = params[:-1]
+        return [row for row in self.rows if row[0] in accounts and row[2] < params[-1]]
+
+
+def velocity_rule(rule_id, expression):
+    return CompiledRule.from_fields(rule_id, 'amount', True, 'GreaterThan', 'float', 0.0, f'rule {rule_id}', '',
+                                    expression)
+
+
+def test_count_and_sum_slide_out_of_the_window():
+    engine = VelocityEngine(buckets=10)
+    count = velocity_rule(1, 'velocity count(*) over 100 seconds')
+    total = velocity_rule(2, 'velocity sum(amount) over 100 seconds')
+    for second in range(0, 50, 10):
+        assert engine.observe(count, {'sourceaccountnumber': 'a', 'amount': 5}, now=1000 + second) == second // 10 + 1
+        engine.observe(total, {'sourceaccountnumber': 'a', 'amount': 5}, now=1000 + second)
+
+    assert engine.observe(total, {'sourceaccountnumber': 'a', 'amount': 5}, now=1050) == 30.0
+    # the first five transactions are more than 100 seconds old by now
+    assert engine.observe(count, {'sourceaccountnumber': 'a', 'amount': 5}, now=1160) == 1.0
+
+
+def test_accounts_have_their_own_windows():
+    engine = VelocityEngine()
+    rule = velocity_rule(1, 'velocity count(*) over 1 hour')
+    engine.observe(rule, {'sourceaccountnumber': 'a'}, now=1000)
+    assert engine.observe(rule, {'sourceaccountnumber': 'b'}, now=1001) == 1.0
+    assert engine.observe(rule, {'sourceaccountnumber': 'a'}, now=1002) == 2.0
+
+
+def test_missing_column_is_not_counted():
+    engine = VelocityEngine()
+    rule = velocity_rule(1, 'velocity sum(amount) over 1 hour')
+    engine.observe(rule, {'sourceaccountnumber': 'a', 'amount': 10}, now=1000)
+    assert engine.observe(rule, {'sourceaccountnumber': 'a'}, now=1001) == 10.0
+
+
+def test_distinct_is_exact_for_small_counts_and_ignores_repeats():
+    engine = VelocityEngine(precision=12)
+    rule = velocity_rule(1, 'velocity count(distinct destinationaccountnumber) over 1 hour')
+    for index in range(30):
+        result = engine.observe(rule, {'sourceaccountnumber': 'a', 'destinationaccountnumber': index % 10},
+                                now=1000 + index)
+    assert result == 10.0
+
+
+def test_distinct_estimate_is_within_hyperloglog_error():
+    engine = VelocityEngine(precision=10)
+    rule = velocity_rule(1, 'velocity count(distinct destinationaccountnumber) over 1 day')
+    for index in range(20000):
+        result = engine.observe(rule, {'sourceaccountnumber': 'a', 'destinationaccountnumber': f'd{index}'},
+                                now=1000 + index * 0.001)
+    # 1.04 / sqrt(1024) is about 3.3%; allow three standard errors
+    assert abs(result - 20000) / 20000 < 0.1
+
+
+def test_least_recently_used_window_is_dropped_past_max_bytes():
+    window_bytes = 12 * 20 + WINDOW_OVERHEAD_BYTES
+    engine = VelocityEngine(max_bytes=2 * window_bytes, buckets=12)
+    rule = velocity_rule(1, 'velocity count(*) over 1 hour')
+    for account in ('a', 'b', 'a', 'c'):
+        engine.observe(rule, {'sourceaccountnumber': account}, now=1000)
+    assert len(engine) == 2
+    assert engine.memory_bytes() == 2 * window_bytes
+    # b was dropped, so its history is gone
+    assert engine.observe(rule, {'sourceaccountnumber': 'b'}, now=1001) == 1.0
+
+
+def test_distinct_windows_count_their_registers():
+    engine = VelocityEngine(buckets=12, precision=8)
+    rule = velocity_rule(1, 'velocity count(distinct destinationaccountnumber) over 1 hour')
+    engine.observe(rule, {'sourceaccountnumber': 'a', 'destinationaccountnumber': 'd'}, now=1000)
+    assert engine.memory_bytes() == 12 * (20 + 256) + WINDOW_OVERHEAD_BYTES
+
+
+def test_missing_window_is_primed_from_the_database():
+    db = FakeDatabase([('a', 1, 30), ('a', 1, 120), ('a', 1, 7200), ('b', 1, 10)])
+    engine = VelocityEngine()
+    rule = velocity_rule(1, 'velocity count(*) over 1 hour')
+    assert engine.missing([rule], 'a') == [rule]
+    engine.prime(db, rule, 'a')
+    assert engine.missing([rule], 'a') == []
+    # the two rows of a within the hour, then this one
+    assert engine.observe(rule, {'sourceaccountnumber': 'a'}) == 3.0
+    assert engine.observe(rule, {'sourceaccountnumber': 'a'}) == 4.0
+    assert db.queries == 1
+
+
+def test_observe_never_queries_and_an_unprimed_window_starts_empty():
+    engine = VelocityEngine()
+    rule = velocity_rule(1, 'velocity count(*) over 1 hour')
+    assert engine.observe(rule, {'sourceaccountnumber': 'a'}) == 1.0
+    # still reported as missing, so the next check primes it
+    assert engine.missing([rule], 'a') == [rule]
+
+
+def test_seed_includes_queued_transactions():
+    queued_at = time.time() - 5
+    engine = VelocityEngine(queued=lambda account, as_of: [({'amount': 40.0}, queued_at)] if account == 'a' else [])
+    rule = velocity_rule(1, 'velocity sum(amount) over 10 minutes')
+    db = FakeDatabase([('a', 25.0, 60)])
+    engine.prime(db, rule, 'a')
+    assert engine.observe(rule, {'sourceaccountnumber': 'a', 'amount': 5}) == 70.0
+
+
+def test_prime_many_seeds_every_account_with_one_query():
+    db = FakeDatabase([('a', 'x', 30), ('a', 'y', 60), ('b', 'x', 30)])
+    engine = VelocityEngine(precision=12)
+    rule = velocity_rule(1, 'velocity count(distinct destinationaccountnumber) over 1 hour')
+    engine.prime_many(db, [rule], ['a', 'b', 'a'])
+    assert db.queries == 1
+    assert engine.observe(rule, {'sourceaccountnumber': 'a', 'destinationaccountnumber': 'x'}) == 2.0
+    assert engine.observe(rule, {'sourceaccountnumber': 'b', 'destinationaccountnumber': 'z'}) == 2.0
+    engine.prime_many(db, [rule], ['a', 'b'])
+    assert db.queries == 1
+
+
+def test_workers_converge_on_the_database_count_after_the_ttl():
+    db = SqliteDatabaseManager()
+    insert = TRANSACTION_INSERT_QUERY
+    db.multiple_inserts(insert, [('a', 'd', 10.0, '044'), ('a', 'd', 10.0, '044')])
+    rule = velocity_rule(1, 'velocity count(*) over 1 hour')
+    # two workers, each with its own windows and its own queue of uncommitted transactions
+    queues = [AggregateEngine(), AggregateEngine()]
+    workers = [VelocityEngine(queued=queue.queued_rows, ttl=0.05) for queue in queues]
+    for worker in workers:
+        worker.prime(db, rule, 'a')
+
+    transaction = {'sourceaccountnumber': 'a', 'destinationaccountnumber': 'd', 'amount': 10.0,
+                   'destinationbankcode': '044'}
+    assert workers[0].observe(rule, transaction) == 3.0
+    queues[0].queued([('a', 'd', 10.0, '044')])
+    db.multiple_inserts(insert, [('a', 'd', 10.0, '044')])
+    # the second worker does not see the first one's transaction until its window is re-seeded
+    assert workers[1].observe(rule, transaction) == 3.0
+    queues[1].queued([('a', 'd', 10.0, '044')])
+
+    time.sleep(0.06)
+    assert workers[1].missing([rule], 'a') == [rule]
+    workers[1].prime(db, rule, 'a')
+    # both committed rows, the first worker's, and its own from the queue it has not committed yet
+    assert workers[1].observe(rule, transaction) == 5.0
+    db.close()
@@ -0,0 +1,142 @@
+import json
+import os
+
+import pytest
+
+from src.infra.write_behind import WriteBehindQueue
+
+QUERY = 'insert into t (a) values (?)'
+
+
+class FakeDatabase:
+    """Stores inserted rows; rows whose value is 'bad' are rejected while the database is up."""
+
+    def __init__(self):
+        self.online = True
+        self.rows = []
+
+    def multiple_inserts(self, query, params):
+        if not self.online or any(row[0] == 'bad' for row in params):
+            return -1
+        self.rows.extend(params)
+        return 0
+
+    def single_inserts(self, query, params):
+        if not self.online:
+            return -1
+        if params[0] == 'bad':
+            return 1
+        self.rows.append(params)
+        return 0
+
+    def fetch_record(self, query, params):
+        return (1,) if self.online else None
+
+
+@pytest.fixture
+def queue(tmp_path):
+    db = FakeDatabase()
+    write_behind = WriteBehindQueue(db, max_size=3, batch_size=2, flush_interval=0.01, spill_dir=str(tmp_path),
+                                    replay_interval=3600)
+    yield db, write_behind
+    write_behind.close()
+
+
+def lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as spill_file:
+        return [json.loads(line) for line in spill_file if line.strip()]
+
+
+def test_rows_are_written_and_listeners_notified(queue):
+    db, write_behind = queue
+    committed = []
+    write_behind.add_listener(QUERY, committed.extend)
+    write_behind.put_many(QUERY, [(1,), (2,), (3,)])
+    write_behind.flush()
+    assert sorted(db.rows) == [(1,), (2,), (3,)]
+    assert sorted(committed) == [(1,), (2,), (3,)]
+    assert write_behind.flushed == 3
+
+
+def test_rejected_row_is_quarantined_and_the_rest_written(queue):
+    db, write_behind = queue
+    write_behind._write([(QUERY, (1,)), (QUERY, ('bad',)), (QUERY, (2,))])
+    assert db.rows == [(1,), (2,)]
+    assert lines(write_behind.quarantine_path) == [[QUERY, ['bad']]]
+    assert write_behind.quarantined == 1
+    assert lines(write_behind.spill_path) == []
+
+
+def test_listeners_only_get_committed_rows_of_a_failed_batch(queue):
+    db, write_behind = queue
+    committed = []
+    write_behind.add_listener(QUERY, committed.extend)
+    write_behind._write([(QUERY, (1,)), (QUERY, ('bad',)), (QUERY, (2,))])
+    assert committed == [(1,), (2,)]
+    assert write_behind.flushed == 2
+
+
+def test_unreachable_database_spills_and_replay_writes_them(queue):
+    db, write_behind = queue
+    db.online = False
+    write_behind._write([(QUERY, (1,)), (QUERY, (2,)), (QUERY, (3,))])
+    assert lines(write_behind.spill_path) == [[QUERY, [1]], [QUERY, [2]], [QUERY, [3]]]
+    assert write_behind.spilled == 3
+
+    write_behind._replay_spilled()
+    assert len(lines(write_behind.spill_path)) == 3
+
+    db.online = True
+    write_behind._replay_spilled()
+    assert db.rows == [(1,), (2,), (3,)]
+    assert write_behind.replayed == 3
+    assert lines(write_behind.spill_path) == []
+
+
+def test_replay_keeps_rows_that_fail_again(queue):
+    db, write_behind = queue
+    db.online = False
+    write_behind._write([(QUERY, (1,)), (QUERY, (2,)), (QUERY, (3,))])
+
+    calls = []
+    original = db.multiple_inserts
+
+    def fail_after_first_chunk(query, params):
+        calls.append(params)
+        if len(calls) > 1:
+            db.online = False
+        return original(query, params)
+
+    db.online = True
+    db.multiple_inserts = fail_after_first_chunk
+    write_behind._replay_spilled()
+    assert db.rows == [(1,), (2,)]
+    assert lines(write_behind.spill_path) == [[QUERY, [3]]]
+
+
+def test_spill_files_of_other_workers_are_replayed(queue, tmp_path):
+    db, write_behind = queue
+    with open(tmp_path / 'write_behind_99999.jsonl', 'w', encoding='utf-8') as spill_file:
+        spill_file.write(json.dumps([QUERY, [7]]) + '\n')
+    with open(tmp_path / 'write_behind_quarantine_99999.jsonl', 'w', encoding='utf-8') as spill_file:
+        spill_file.write(json.dumps([QUERY, ['bad']]) + '\n')
+    write_behind._replay_spilled()
+    assert db.rows == [(7,)]
+    assert lines(tmp_path / 'write_behind_quarantine_99999.jsonl') == [[QUERY, ['bad']]]
+
+
+def test_full_buffer_spills(tmp_path):
+    db = FakeDatabase()
+    write_behind = WriteBehindQueue(db, max_size=1, batch_size=10, flush_interval=0.01, spill_dir=str(tmp_path),
+                                    replay_interval=3600)
+    # stop the flush thread so the buffer stays full
+    write_behind._stopped.set()
+    write_behind._thread.join()
+
+    write_behind.put_many(QUERY, [(index,) for index in range(5)])
+    assert write_behind.pending() == 1
+    assert lines(write_behind.spill_path) == [[QUERY, [index]] for index in range(1, 5)]
+    write_behind.flush()
+    assert db.rows == [(0,)]